@@ -26,6 +26,9 @@ except ImportError:
 from collections import deque
 from datetime import datetime, timedelta
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vla_dispatcher'))
+import legacy_packet
+
 
 
 __version__ = '0.0'
@@ -35,12 +38,12 @@ __all__ = ['Communicate', '__version__', '__revision__', '__date__', '__all__']
 
 
 # Maximum number of bytes to receive from FRB and MCS
-FRB_RCV_BYTES = 4*40
+FRB_RCV_BYTES = legacy_packet.PACKET_SIZE
 MCS_RCV_BYTES = 16*1024
 
 
 # Kill packet indicator
-FIRST_BYTE_KILL = struct.pack('>l', 4)
+FIRST_BYTE_KILL = struct.pack('>l', legacy_packet.TYPE_KILL)
 
 
 def usage(exitCode=None):
@@ -352,41 +355,28 @@ class Communicate(object):
 		     DM for a VLA_FRB_TRIGGER)
 		"""
 		
-		# Unpack 40 4-byte intgers
-		data = struct.unpack('>40l', rawData)
+		# Unpack the 40 4-byte integers
+		data = legacy_packet.decode_packet(rawData)
 		
 		# Figure out the notification type
-		notifyType = data[0]
-		if notifyType == 2:
-			notifyType = "Test"
-		elif notifyType == 3:
-			notifyType = "Iamalive"
-		elif notifyType == 4:
-			notifyType = "Kill"
-		elif notifyType == 11:
-			notifyType = "VLA_FRB_SESSION"
-		elif notifyType == 12:
-			notifyType = "VLA_FRB_TRIGGER"
-		else:
-			notifyType = "Unknown"
-			
+		notifyType = data['type_name']
+		
 		# Serial number
-		sn = data[1]
+		sn = data['serial']
 		
 		# Event name
-		eventName = "%s #%i" % (notifyType, data[4])
+		eventName = "%s #%i" % (notifyType, data['event'])
 		
 		# Event timestamp
-		jd = data[5] + 40000 + data[6]/100.0/SECS_IN_DAY + MJD_OFFSET
-		eventTimestamp = utcjd_to_unix(jd)
+		eventTimestamp = data['event_t']
 		
 		# Event position and uncertainty
-		eventRA = data[7] / 10000.0
-		eventDec = data[8] / 10000.0
-		eventAdd = data[9]
+		eventRA = data['ra']
+		eventDec = data['dec']
+		eventAdd = data['duration']
 		
 		# Validation
-		if data[39] != 10:
+		if not data['valid']:
 			self.logger.warning("Packet '%s' with size %i B may be invalid because of an invalid terminator", rawData, len(rawData))
 			
 		return notifyType, sn, eventName, eventTimestamp, eventRA, eventDec, eventAdd
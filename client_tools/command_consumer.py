@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Stand-in for fcn_server that accepts the commands pushed by
+`dispatcher.py --push` and prints them.  Useful for testing a deployment
+and for benchmarking the hand-off.
+"""
+
+import os
+import sys
+import time
+import argparse
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vla_dispatcher'))
+import json_backend
+from socket_sink import CommandConsumer
+
+
+def main(args):
+    def show(command):
+        now = time.time()
+        print("%s  %s serial# %s for %s, received %.3f ms after dispatch" % (time.strftime("%Y-%m-%d %H:%M:%S"),
+                                                                              command['notice_type'],
+                                                                              command['event_id'],
+                                                                              command.get('project_id'),
+                                                                              (now - command['dispatch_t'])*1e3))
+        if args.verbose:
+            print(json_backend.dumps(command))
+        sys.stdout.flush()
+
+    consumer = CommandConsumer(args.address, handler=show)
+    print("Listening on %s" % consumer.address)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        consumer.stop()
+        print("Received %i commands" % len(consumer.commands))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Receive and print the commands pushed by the VLA dispatcher',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('address', type=str,
+                        help="address to listen on, 'unix:/path' or 'host:port'")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='print the full command')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    main(args)
@@ -0,0 +1,250 @@
+"""
+Crash-safe checkpointing of the dispatcher state.
+
+The state is a set of named tables (e.g. 'last_scan' and 'dispatched')
+mapping JSON-friendly keys to JSON-friendly values.  It is kept on disk as
+two files:
+ * <path> is a snapshot of all of the tables.  It is written to a
+   temporary file, synced, and renamed over the old snapshot so that a
+   crash leaves either the old or the new snapshot in place.
+ * <path>.wal is a write-ahead log with one JSON record per line for
+   every change made since the snapshot.  Each record is flushed and
+   synced as it is written.  A partial last line left by a crash is
+   ignored when the log is replayed.
+A new snapshot is taken every snapshot_interval seconds or after max_wal
+records, whichever comes first, after which the log is truncated.  If we
+die between the rename and the truncation the log is replayed over the
+new snapshot, which is harmless since every record is a plain set or
+delete that the snapshot already includes.
+"""
+
+import os
+import time
+import logging
+
+import json_backend
+
+logger = logging.getLogger(__name__)
+
+"""
+Snapshot format version.
+"""
+CHECKPOINT_VERSION = 1
+
+
+def _key(key):
+    # JSON turns tuples into lists; turn them back so they can be used as
+    # dictionary keys
+    if isinstance(key, list):
+        return tuple(_key(k) for k in key)
+    return key
+
+
+class StateCheckpoint(object):
+    """
+    Snapshot plus write-ahead log for a set of named tables.
+    """
+
+    def __init__(self, path, snapshot_interval=60.0, max_wal=1000, fsync=True):
+        self.path = path
+        self.wal_path = path + '.wal'
+        self.snapshot_interval = snapshot_interval
+        self.max_wal = max_wal
+        self.fsync = fsync
+
+        self.tables = {}                # name -> {key: (value, time)}
+        self._wal = None
+        self._wal_records = 0
+        self._last_snapshot = time.time()
+
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+    def _sync(self, fh):
+        fh.flush()
+        if self.fsync:
+            os.fsync(fh.fileno())
+
+    def load(self):
+        """
+        Read the snapshot and replay the write-ahead log.  Returns the
+        tables as a dictionary of name -> list of (key, value, time) in the
+        order they were last changed.
+        """
+
+        self.tables = {}
+        try:
+            with open(self.path, 'r') as fh:
+                snapshot = json_backend.loads(fh.read())
+            if snapshot.get('version') != CHECKPOINT_VERSION:
+                raise ValueError("unknown checkpoint version %s" % snapshot.get('version'))
+            for name,entries in snapshot['tables'].items():
+                table = self.tables.setdefault(name, {})
+                for key,value,updated in entries:
+                    table[_key(key)] = (value, updated)
+        except (IOError, OSError):
+            pass
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring unreadable checkpoint '%s': %s", self.path, str(e))
+            self.tables = {}
+
+        replayed = 0
+        try:
+            with open(self.wal_path, 'r+') as fh:
+                good = 0
+                while True:
+                    line = fh.readline()
+                    if not line:
+                        break
+                    try:
+                        if not line.endswith('\n'):
+                            raise ValueError
+                        record = json_backend.loads(line)
+                    except ValueError:
+                        # Cut off the partial record so that new records
+                        # are not appended to it
+                        logger.warning("Dropping truncated record at the end of '%s'", self.wal_path)
+                        fh.seek(good)
+                        fh.truncate()
+                        break
+                    self._apply(record)
+                    replayed += 1
+                    good = fh.tell()
+        except (IOError, OSError):
+            pass
+        self._wal_records = replayed
+
+        state = {}
+        for name,table in self.tables.items():
+            entries = [(key, value, updated) for key,(value, updated) in table.items()]
+            entries.sort(key=lambda x: x[2])
+            state[name] = entries
+        return state
+
+    def _apply(self, record):
+        table = self.tables.setdefault(record['table'], {})
+        key = _key(record['key'])
+        if record['op'] == 'set':
+            table[key] = (record['value'], record['t'])
+        else:
+            table.pop(key, None)
+
+    def _append(self, record):
+        if self._wal is None:
+            self._wal = open(self.wal_path, 'a')
+        self._wal.write(json_backend.dumps(record) + '\n')
+        self._sync(self._wal)
+        self._wal_records += 1
+
+    def set(self, table, key, value, now=None):
+        """Record that key in table now has value."""
+
+        if now is None:
+            now = time.time()
+        self._apply({'op': 'set', 'table': table, 'key': key, 'value': value, 't': now})
+        self._append({'op': 'set', 'table': table, 'key': key, 'value': value, 't': now})
+
+    def delete(self, table, key):
+        """Record that key has been removed from table."""
+
+        if key not in self.tables.get(table, {}):
+            return
+        self._apply({'op': 'del', 'table': table, 'key': key})
+        self._append({'op': 'del', 'table': table, 'key': key})
+
+    def snapshot(self):
+        """
+        Write all of the tables to the snapshot file and truncate the
+        write-ahead log.
+        """
+
+        t0 = time.time()
+        tables = {}
+        for name,table in self.tables.items():
+            tables[name] = [[key, value, updated] for key,(value, updated) in table.items()]
+        data = json_backend.dumps({'version': CHECKPOINT_VERSION, 't': t0, 'tables': tables})
+
+        tmpname = self.path + '.tmp'
+        with open(tmpname, 'w') as fh:
+            fh.write(data)
+            self._sync(fh)
+        os.rename(tmpname, self.path)
+        if self.fsync:
+            # Make sure the rename itself is on disk before dropping the log
+            fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        if self._wal is not None:
+            self._wal.close()
+        self._wal = open(self.wal_path, 'w')
+        self._sync(self._wal)
+        self._wal_records = 0
+        self._last_snapshot = time.time()
+        logger.debug("Wrote checkpoint '%s' (%i B) in %.3f ms", self.path, len(data), (self._last_snapshot - t0)*1e3)
+
+    def maybe_snapshot(self, force=False):
+        """
+        Take a snapshot if the log has grown past max_wal records or
+        snapshot_interval seconds have passed since the last one.
+        """
+
+        if not force and not self._wal_records:
+            return False
+        if force \
+           or self._wal_records >= self.max_wal \
+           or time.time() - self._last_snapshot >= self.snapshot_interval:
+            self.snapshot()
+            return True
+        return False
+
+    def close(self):
+        """Take a final snapshot and close the log."""
+
+        self.maybe_snapshot(force=True)
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+
+
+# Some tests.
+def _test_checkpoint():
+    """Round trip through the log, a snapshot, and a torn log record."""
+    import shutil
+    import tempfile
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'state.json')
+        cp = StateCheckpoint(path, max_wal=100)
+        assert cp.load() == {}
+        cp.set('last_scan', ('1', 'A'), {'scan': 1}, now=1.0)
+        cp.set('last_scan', ('1', 'B'), {'scan': 5}, now=2.0)
+        cp.set('last_scan', ('1', 'A'), {'scan': 2}, now=3.0)
+        cp.delete('last_scan', ('1', 'B'))
+
+        # Log only
+        state = StateCheckpoint(path).load()
+        assert state == {'last_scan': [(('1', 'A'), {'scan': 2}, 3.0)]}, state
+
+        # Snapshot plus log, with a torn record at the end
+        cp.snapshot()
+        cp.set('dispatched', ('1', 'A'), {'event_id': 7}, now=4.0)
+        with open(cp.wal_path, 'a') as fh:
+            fh.write('{"op": "set", "tab')
+        state = StateCheckpoint(path).load()
+        assert state['last_scan'] == [(('1', 'A'), {'scan': 2}, 3.0)], state
+        assert state['dispatched'] == [(('1', 'A'), {'event_id': 7}, 4.0)], state
+        cp = StateCheckpoint(path)
+        cp.load()
+        cp.delete('dispatched', ('1', 'A'))
+        state = StateCheckpoint(path).load()
+        assert state['dispatched'] == [], state
+        cp.close()
+        assert os.path.getsize(cp.wal_path) == 0
+        assert StateCheckpoint(path).load() == state
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,263 @@
+"""
+Priority queue for commands waiting to be handed over.
+
+When a consumer falls behind, commands are not handed over in the order
+they were made but by how actionable they are:
+ 0. ELWA_CANCEL, ELWA_UPDATE and ELWA_SCAN_END, about sessions the
+    stations may already be acting on, oldest event first
+ 1. ELWA_SESSION, earliest deadline (event_t + event_duration) first, and
+    ELWA_REMINDER by scan start
+ 2. ELWA_READY and ELWA_DONE, oldest event first
+Ties go in the order the commands were queued.
+
+An ELWA_SESSION whose deadline passed more than grace seconds before it
+reaches the head of the queue describes a scan that is long over.  It is
+dropped, or with stale='mark' flagged with 'stale': true and held back
+until nothing else is waiting.  stale='keep' sends it anyway, e.g. when
+replaying old obsdocs.  The grace period is there because a session is
+normally only sent once the next scan's obsdoc arrives, which can be
+after the end of the window the dispatcher computes.  The other types
+are never stale.
+
+An ELWA_UPDATE or ELWA_CANCEL for a session that is still queued replaces
+it: the update is sent as the session with its final duration, and a
+cancelled session is not sent at all.
+
+When the queue is full the lowest priority command, which may be the one
+being queued, is dropped.
+"""
+
+import time
+import heapq
+import logging
+
+logger = logging.getLogger(__name__)
+
+"""
+Priority class of each notice type; lower goes first.
+"""
+NOTICE_PRIORITY = {'ELWA_CANCEL': 0,
+                   'ELWA_UPDATE': 0,
+                   'ELWA_SCAN_END': 0,
+                   'ELWA_SESSION': 1,
+                   'ELWA_REMINDER': 1,
+                   'ELWA_READY': 2,
+                   'ELWA_DONE': 2}
+"""
+What to do with stale sessions.
+"""
+STALE_POLICIES = ('drop', 'mark', 'keep')
+
+
+def _session_key(command):
+    return (command.get('subarray_id'), command.get('project_id'), command.get('event_id'))
+
+
+class CommandQueue(object):
+    """
+    Deadline-ordered queue of commands.  Not thread-safe.
+    """
+
+    def __init__(self, max_size=None, stale='drop', grace=60.0):
+        if stale not in STALE_POLICIES:
+            raise ValueError("stale must be one of %s, not '%s'" % (', '.join(STALE_POLICIES), stale))
+        self.max_size = max_size
+        self.stale = stale
+        self.grace = grace
+
+        self._heap = []         # [priority, order, seq, queued, command, alive]
+        self._stale = []        # marked stale sessions, oldest first
+        self._sessions = {}     # (subarray_id, project_id, event_id) -> queued session entry
+        self._seq = 0
+        self._live = 0
+
+        self.pushed = 0
+        self.popped = 0
+        self.dropped_stale = 0
+        self.dropped_full = 0
+        self.marked_stale = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return self._live + len(self._stale)
+
+    @staticmethod
+    def deadline(command):
+        """Time after which a session is no longer worth sending, or None."""
+
+        if command['notice_type'] != 'ELWA_SESSION':
+            return None
+        return command['event_t'] + max(command['event_duration'], 0)
+
+    def _kill(self, entry):
+        entry[-1] = False
+        self._live -= 1
+        if entry[4]['notice_type'] == 'ELWA_SESSION':
+            self._sessions.pop(_session_key(entry[4]), None)
+
+    def _add(self, command, queued):
+        priority = NOTICE_PRIORITY.get(command['notice_type'], 2)
+        order = self.deadline(command)
+        if order is None:
+            order = command['event_t']
+        self._seq += 1
+        entry = [priority, order, self._seq, queued, command, True]
+        heapq.heappush(self._heap, entry)
+        self._live += 1
+        if command['notice_type'] == 'ELWA_SESSION':
+            self._sessions[_session_key(command)] = entry
+        return entry
+
+    def push(self, command, now=None):
+        """
+        Queue a command.  Returns the command dropped to make room, if
+        any, which may be command itself.
+        """
+
+        if now is None:
+            now = time.time()
+        self.pushed += 1
+
+        # Fold corrections into a session that has not gone out yet
+        if command['notice_type'] in ('ELWA_UPDATE', 'ELWA_CANCEL'):
+            session = self._sessions.get(_session_key(command))
+            if session is not None:
+                self._kill(session)
+                self.coalesced += 1
+                if command['notice_type'] == 'ELWA_CANCEL':
+                    return None
+                command = dict(command, notice_type='ELWA_SESSION')
+                command.pop('provisional', None)
+                now = session[3]
+
+        entry = self._add(command, now)
+        if self.max_size is not None and len(self) > self.max_size:
+            return self._drop_lowest()
+        return None
+
+    def _drop_lowest(self):
+        self.dropped_full += 1
+        if self._stale:
+            return self._stale.pop(0)[1]
+        lowest = max(entry for entry in self._heap if entry[-1])
+        self._kill(lowest)
+        return lowest[4]
+
+    def pop(self, now=None):
+        """
+        Return the (time queued, command) to hand over next, or None if
+        there is nothing to send.
+        """
+
+        if now is None:
+            now = time.time()
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            if not entry[-1]:
+                continue
+            self._kill(entry)
+            queued, command = entry[3], entry[4]
+            deadline = self.deadline(command)
+            if self.stale != 'keep' and deadline is not None and deadline + self.grace < now:
+                if self.stale == 'drop':
+                    self.dropped_stale += 1
+                    logger.info("Dropping stale %s serial# %s, its scan ended %.1f s ago", command['notice_type'],
+                                command['event_id'], now - deadline)
+                    continue
+                command['stale'] = True
+                self.marked_stale += 1
+                self._stale.append((queued, command))
+                continue
+            self.popped += 1
+            return queued, command
+        if self._stale:
+            self.popped += 1
+            return self._stale.pop(0)
+        return None
+
+    def metrics(self):
+        return {'backlog': len(self),
+                'pushed': self.pushed,
+                'popped': self.popped,
+                'dropped_stale': self.dropped_stale,
+                'dropped_full': self.dropped_full,
+                'marked_stale': self.marked_stale,
+                'coalesced': self.coalesced}
+
+
+# Some tests.
+def _command(notice_type, event_id, event_t, duration=-1, project='23A-123'):
+    return {'notice_type': notice_type, 'event_id': event_id, 'event_t': event_t,
+            'event_duration': duration, 'project_id': project, 'subarray_id': '1'}
+
+
+def _test_command_queue():
+    """Ordering, stale sessions, coalescing and the size limit."""
+
+    now = 1000.0
+    queue = CommandQueue(grace=60.0)
+    queue.push(_command('ELWA_READY', 1, now - 500), now=now)
+    queue.push(_command('ELWA_SESSION', 2, now - 400, 100), now=now)      # over
+    queue.push(_command('ELWA_SESSION', 9, now - 400, 350), now=now)      # over, within grace
+    queue.push(_command('ELWA_SESSION', 3, now - 100, 600), now=now)
+    queue.push(_command('ELWA_SESSION', 4, now - 50, 60), now=now)
+    queue.push(_command('ELWA_DONE', 5, now - 10), now=now)
+    queue.push(_command('ELWA_CANCEL', 6, now - 20), now=now)
+    order = []
+    while queue:
+        order.append(queue.pop(now)[1]['event_id'])
+    assert order == [6, 9, 4, 3, 1, 5], order
+    assert queue.dropped_stale == 1 and queue.pop(now) is None
+
+    queue = CommandQueue(stale='keep')
+    queue.push(_command('ELWA_SESSION', 2, now - 400, 100), now=now)
+    assert queue.pop(now)[1]['event_id'] == 2
+
+    # Marked stale sessions wait for everything else
+    queue = CommandQueue(stale='mark')
+    queue.push(_command('ELWA_SESSION', 2, now - 400, 100), now=now)
+    queue.push(_command('ELWA_DONE', 5, now - 10), now=now)
+    first, second = queue.pop(now)[1], queue.pop(now)[1]
+    assert first['event_id'] == 5 and second['event_id'] == 2 and second['stale']
+    assert queue.marked_stale == 1 and len(queue) == 0
+
+    # Corrections fold into a queued session
+    queue = CommandQueue()
+    provisional = _command('ELWA_SESSION', 7, now, 300)
+    provisional['provisional'] = True
+    queue.push(provisional, now=now - 1)
+    queue.push(_command('ELWA_UPDATE', 7, now, 120), now=now)
+    queued, command = queue.pop(now)
+    assert command['notice_type'] == 'ELWA_SESSION' and command['event_duration'] == 120
+    assert 'provisional' not in command and queued == now - 1 and queue.coalesced == 1
+    queue.push(_command('ELWA_SESSION', 8, now, 300), now=now)
+    queue.push(_command('ELWA_CANCEL', 8, now), now=now)
+    assert len(queue) == 0 and queue.pop(now) is None
+
+    # A full queue sheds its least urgent command
+    queue = CommandQueue(max_size=2)
+    assert queue.push(_command('ELWA_DONE', 1, now), now=now) is None
+    assert queue.push(_command('ELWA_SESSION', 2, now, 60), now=now) is None
+    assert queue.push(_command('ELWA_SESSION', 3, now, 30), now=now)['event_id'] == 1
+    assert queue.push(_command('ELWA_READY', 4, now), now=now)['event_id'] == 4
+    assert [queue.pop(now)[1]['event_id'] for i in range(2)] == [3, 2] and queue.dropped_full == 2
+
+
+def _bench_command_queue(count=100000):
+    """Push then drain count sessions."""
+    import random
+
+    random.seed(42)
+    now = time.time()
+    commands = [_command('ELWA_SESSION', i, now + random.uniform(-60, 3600), random.uniform(30, 600))
+                for i in range(count)]
+    queue = CommandQueue()
+    t0 = time.time()
+    for command in commands:
+        queue.push(command, now=now)
+    t1 = time.time()
+    while queue.pop(now) is not None:
+        pass
+    t2 = time.time()
+    print("%i commands: %.2f us per push, %.2f us per pop, %i stale" % (count, (t1 - t0)/count*1e6,
+                                                                      (t2 - t1)/count*1e6, queue.dropped_stale))
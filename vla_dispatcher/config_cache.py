@@ -0,0 +1,265 @@
+"""
+On-disk cache of the VLA configuration documents referenced by the
+obsdoc configUrl.
+
+Documents are stored as <configId>.xml in a cache directory and fetched
+in a background thread so that the dispatcher never waits on the
+network.  The directory is kept below a size limit by removing the least
+recently used documents; a document's modification time is bumped every
+time it is looked up.
+
+A configId whose fetch failed is not tried again until retry_interval
+seconds have passed, doubling with every further failure up to
+max_retry_interval, so an unreachable server costs one thread per
+backoff period rather than one per obsdoc.
+"""
+
+import os
+import re
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+logger = logging.getLogger(__name__)
+
+_filename_pat = re.compile(r'[^A-Za-z0-9._-]')
+
+
+class ConfigCache(object):
+    """
+    Size-bounded LRU cache of configuration documents keyed by configId.
+    """
+
+    def __init__(self, cache_dir, max_bytes=64*1024**2, timeout=10.0, retry_interval=30.0,
+                 max_retry_interval=3600.0, max_failed=1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.max_failed = max_failed
+
+        self._lock = threading.Lock()
+        self._inflight = set()
+        self._known = set()
+        self._failed = OrderedDict()    # name -> (time to retry after, consecutive failures)
+
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.failures = 0
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.xml'):
+                self._known.add(name[:-4])
+
+    def path_for(self, configId):
+        """Return the path a configId is (or would be) cached at."""
+
+        return os.path.join(self.cache_dir, _filename_pat.sub('_', configId) + '.xml')
+
+    def get(self, configId):
+        """
+        Return the local path of the cached document for configId, or None
+        if it has not been fetched yet.
+        """
+
+        if configId is None:
+            return None
+        path = self.path_for(configId)
+        try:
+            os.utime(path, None)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def prefetch(self, configId, url):
+        """
+        Start fetching the document at url into the cache unless it is
+        already cached, being fetched, or failed too recently to try again.
+        Returns immediately, True if a fetch was started.
+        """
+
+        if configId is None or url is None:
+            return False
+        path = self.path_for(configId)
+        name = os.path.basename(path)[:-4]
+        with self._lock:
+            if name in self._known or name in self._inflight:
+                return False
+            if name in self._failed and time.time() < self._failed[name][0]:
+                return False
+            self._inflight.add(name)
+
+        thread = threading.Thread(target=self._fetch, args=(configId, url, path, name))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _fetch(self, configId, url, path, name):
+        t0 = time.time()
+        try:
+            fh = urlopen(url, timeout=self.timeout)
+            try:
+                data = fh.read()
+            finally:
+                fh.close()
+
+            # Write to a temporary file in the cache directory and rename it
+            # into place so readers never see a partial document
+            fd, tmpname = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(data)
+            os.rename(tmpname, path)
+
+            with self._lock:
+                self._known.add(name)
+                self._failed.pop(name, None)
+                self.fetches += 1
+            logger.info("Cached configuration %s (%i B) in %.3f s", configId, len(data), time.time() - t0)
+            self._evict()
+
+        except Exception as e:
+            with self._lock:
+                self.failures += 1
+                retry, count = self._failed.pop(name, (0.0, 0))
+                delay = min(self.retry_interval * 2**count, self.max_retry_interval)
+                self._failed[name] = (time.time() + delay, count + 1)
+                while len(self._failed) > self.max_failed:
+                    self._failed.popitem(last=False)
+            logger.warning("Failed to fetch configuration %s from %s: %s; not retrying for %.0f s", configId, url,
+                           str(e), delay)
+
+        finally:
+            with self._lock:
+                self._inflight.discard(name)
+
+    def _evict(self):
+        """Remove the least recently used documents until the cache fits."""
+
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.xml'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+
+        entries.sort()
+        while total > self.max_bytes and len(entries) > 1:
+            mtime, size, name = entries.pop(0)
+            try:
+                os.unlink(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            with self._lock:
+                self._known.discard(name[:-4])
+            total -= size
+            logger.debug("Evicted cached configuration %s", name)
+
+    def wait(self, timeout=None):
+        """Wait until there are no fetches in progress.  Mostly for testing."""
+
+        t0 = time.time()
+        while self._inflight:
+            if timeout is not None and time.time() - t0 > timeout:
+                return False
+            time.sleep(0.01)
+        return True
+
+
+# Some tests.
+def _test_config_cache():
+    """Fetch from a local HTTP stand-in and check caching and eviction."""
+    try:
+        from SimpleHTTPServer import SimpleHTTPRequestHandler
+        from BaseHTTPServer import HTTPServer
+    except ImportError:
+        from http.server import SimpleHTTPRequestHandler, HTTPServer
+
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    srcdir = tempfile.mkdtemp()
+    cachedir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(srcdir)
+    server = HTTPServer(('127.0.0.1', 0), QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        for i in range(3):
+            with open('config%i' % i, 'wb') as fh:
+                fh.write(b'<config>' + b'x'*1000 + b'</config>')
+        base = 'http://127.0.0.1:%i/' % server.server_address[1]
+
+        cache = ConfigCache(cachedir, max_bytes=2500)
+        assert cache.get('TEST_0001') is None
+        assert cache.prefetch('TEST_0001', base + 'config0')
+        assert cache.wait(10)
+        path = cache.get('TEST_0001')
+        assert path is not None
+        with open(path, 'rb') as fh:
+            assert fh.read().startswith(b'<config>')
+        # Already cached, so nothing to do
+        assert not cache.prefetch('TEST_0001', base + 'config0')
+
+        # Two more documents push the least recently used one out
+        time.sleep(0.05)
+        cache.prefetch('TEST_0002', base + 'config1')
+        cache.wait(10)
+        time.sleep(0.05)
+        cache.get('TEST_0001')
+        time.sleep(0.05)
+        cache.prefetch('TEST_0003', base + 'config2')
+        cache.wait(10)
+        assert cache.get('TEST_0001') is not None
+        assert cache.get('TEST_0002') is None
+        assert cache.get('TEST_0003') is not None
+
+        # Fetch failures are counted, not raised
+        cache.prefetch('TEST_0004', base + 'missing')
+        cache.wait(10)
+        assert cache.failures == 1
+        assert cache.get('TEST_0004') is None
+
+        # and not retried until the backoff, which doubles, has passed
+        cache.retry_interval = 0.2
+        assert not cache.prefetch('TEST_0004', base + 'missing')
+        cache._failed['TEST_0004'] = (0.0, 1)
+        assert cache.prefetch('TEST_0004', base + 'missing')
+        cache.wait(10)
+        assert cache.failures == 2
+        retry, count = cache._failed['TEST_0004']
+        assert count == 2 and 0.3 < retry - time.time() <= 0.4
+        assert not cache.prefetch('TEST_0004', base + 'missing')
+        with open('missing', 'wb') as fh:
+            fh.write(b'<config/>')
+        time.sleep(0.45)
+        assert cache.prefetch('TEST_0004', base + 'missing')
+        cache.wait(10)
+        assert cache.get('TEST_0004') is not None and 'TEST_0004' not in cache._failed
+    finally:
+        server.shutdown()
+        os.chdir(cwd)
+        shutil.rmtree(srcdir)
+        shutil.rmtree(cachedir)
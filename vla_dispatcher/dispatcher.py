@@ -20,8 +20,9 @@ Still to do;
 """
 
 import os
-import json
+import sys
 import time
+import signal
 import logging
 import argparse
 import asyncore
@@ -33,14 +34,33 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)-7s] %(
 logger = logging.getLogger(__name__)
 
 import mcaf_library
+import json_backend
+import config_cache
+import obsdocxml_parser
+import quarantine
+import state_store
+import checkpoint
+import sinks
+import socket_sink
+import fanout
+import rules
+import file_waiter
+import command_queue
+import event_ids
+import timer_wheel
 
 # GLOBAL VARIABLES
 workdir = os.getcwd() # assuming we start in workdir
-dispatched = {}       # Keep global list of dispatched commands
-last_scan = {}
 
+# Longest time in seconds the receive loop waits for an obsdoc before
+# checking the rules file and doing its housekeeping
+LOOP_TIMEOUT = 1.0
 
-ScanInfo = namedtuple('ScanInfo', ['time', 'ra', 'dec', 'intent', 'id', 'source'])
+
+ScanInfo = namedtuple('ScanInfo', ['time', 'ra', 'dec', 'intent', 'id', 'source', 'metadata', 'rules', 'scan'])
+# Names of the trigger rules the scan matched and the scan number; none for
+# state checkpointed before these were kept
+ScanInfo.__new__.__defaults__ = ((), None)
 
 
 class FRBController(object):
@@ -49,37 +69,498 @@ class FRBController(object):
     notable scans.
     """
     
-    def __init__(self, intent='', project='', dispatch=False, command_file='incoming.json', verbose=False):
+    def __init__(self, intent='', project='', dispatch=False, command_file='incoming.json', verbose=False,
+                 full_metadata=False, config_cache=None, state_ttl=None, state_max_entries=None,
+                 done_on_evict=False, checkpoint=None, lookahead=False, default_duration=300.0,
+                 sink=None, ruleset=None, scan_end=False, reminder=None, project_timeout=None):
         # Mode can be project, intent
         self.intent = intent
         self.project = project
+        # Without a rule set the intent and project make up a single rule
+        # that sends to the default sink
+        self.rules = ruleset
+        if self.rules is None:
+            self.rules = rules.RuleSet.from_filter(intent=intent, project=project)
         self.dispatch = dispatch
         self.command_file = command_file
+        self.sink = sink
+        if self.sink is None:
+            self.sink = sinks.CommandFileSink(self.command_file)
+        # A command file sink may hold commands back, so it tells us when
+        # each one is really written
+        self._file_sink = getattr(self.sink, 'primary', self.sink)
+        if hasattr(self._file_sink, 'on_written'):
+            self._file_sink.on_written = self._command_written
+        else:
+            self._file_sink = None
+        # Stations the sink was made with, i.e. from --station, stay put;
+        # those from the rules come and go with the rules
+        self._fixed_stations = set()
+        self._rule_stations = {}
+        if isinstance(self.sink, fanout.FanoutSink):
+            self._fixed_stations = set(self.sink.station_names)
+            self._sync_stations(self._station_urls(self.rules))
         self.verbose = verbose
+        self.full_metadata = full_metadata
+        self.config_cache = config_cache
+        self.done_on_evict = done_on_evict
+        self.lookahead = lookahead
+        self.default_duration = default_duration
+        self.scan_end = scan_end
+        self.reminder = reminder
+        self.project_timeout = project_timeout
+        
+        # Time-driven events: scan ends, pre-start reminders and project
+        # timeouts.  Timers are kept by (kind, key) so that they can be
+        # moved when a newer obsdoc changes the picture.
+        self.timers = timer_wheel.TimerWheel()
+        self._timers = {}
+        
+        # Last scan seen, keyed by (subarrayId, projectID).  Projects whose
+        # FINISH never arrives are aged out rather than kept forever.
+        self.last_scan = state_store.ScanStateStore(ttl=state_ttl, max_entries=state_max_entries,
+                                                    on_evict=self._scan_evicted)
+        self.metrics_interval = 600.0
+        self._last_metrics = time.time()
+        
+        # Last command dispatched, keyed by (subarrayId, projectID)
+        self.dispatched = {}
+        
+        # Recent scan durations, keyed by (subarrayId, projectID), used for
+        # the provisional durations in lookahead mode
+        self.durations = {}
+        self.max_durations = 5
+        
+        self.checkpoint = checkpoint
+        
+        # Event IDs, reserved in blocks through the checkpoint so that they
+        # keep increasing across restarts
+        self.event_ids = event_ids.EventIdAllocator(checkpoint=self.checkpoint)
+        
+        if self.checkpoint is not None:
+            self._restore()
+            
+    def _restore(self):
+        """
+        Reload last_scan, dispatched, the pending scan ends and reminders,
+        and the event ID counter from the checkpoint so that a restart
+        does not lose track of the projects in progress or reuse an event
+        ID.
+        """
+        
+        t0 = time.time()
+        now = t0
+        state = self.checkpoint.load()
+        for key,value,updated in state.get('last_scan', []):
+            self.last_scan.set(key, ScanInfo(**value), now=updated)
+            if self.project_timeout is not None:
+                self._set_timer('timeout', key, updated + self.project_timeout, self._project_timed_out, key)
+        for key,value,updated in state.get('dispatched', []):
+            self.dispatched[key] = value
+        for (kind,key),value,updated in state.get('timed', []):
+            # A scan end is still worth sending late, a reminder for a scan
+            # that has started is not
+            enabled = self.scan_end if kind == 'end' else self.reminder is not None
+            if not enabled or (kind == 'reminder' and value['command']['event_t'] <= now):
+                self.checkpoint.delete('timed', (kind, key))
+                continue
+            self._set_timer(kind, key, value['deadline'], self._send_timed, kind, key, value['command'],
+                            tuple(value['rules']))
+        for key,value,updated in state.get(event_ids.CHECKPOINT_TABLE, []):
+            self.event_ids.restore(value)
+        logger.info("Restored %i projects, %i dispatched commands and %i timers from '%s' in %.1f ms" % (len(self.last_scan),
+                                                                                                        len(self.dispatched),
+                                                                                                        len(self.timers),
+                                                                                                        self.checkpoint.path,
+                                                                                                        (time.time() - t0)*1e3))
+        
+    def _set_scan(self, key, scanInfo):
+        now = time.time()
+        self.last_scan.set(key, scanInfo, now=now)
+        if self.checkpoint is not None:
+            self.checkpoint.set('last_scan', key, dict(scanInfo._asdict()), now=now)
+            
+    def _forget(self, key):
+        self.last_scan.pop(key, None)
+        self.dispatched.pop(key, None)
+        self.durations.pop(key, None)
+        self._cancel_timer('timeout', key)
+        self._cancel_timer('reminder', key)
+        if self.checkpoint is not None:
+            self.checkpoint.delete('last_scan', key)
+            self.checkpoint.delete('dispatched', key)
+            
+    def _scan_evicted(self, key, scanInfo, reason):
+        """
+        Called by the state store when a project is aged out.  Optionally
+        tells the stations the project is done since its FINISH was never
+        seen.
+        """
+        
+        subarrayId, projectID = key
+        self._forget(key)
+        logger.warning("*** Dropping state for project %s (subarray %s) by %s eviction" % (projectID, subarrayId, reason))
+        if self.dispatch and self.done_on_evict:
+            eventID = self.event_ids.next()
+            logger.info("Dispatching synthetic DONE command for obs serial# %s." % eventID)
+            self._send_command({'notice_type':    'ELWA_DONE',
+                                'event_id':       eventID,
+                                'project_id':     projectID,
+                                'subarray_id':    subarrayId,
+                                'scan_id':        -1,
+                                'scan_intent':    scanInfo.intent,
+                                'event_t':        time.time(),
+                                'event_source':   scanInfo.source,
+                                'event_ra':       -1,
+                                'event_dec':      -1,
+                                'event_duration': -1,
+                                'config_url':     None,
+                                'synthetic':      reason},
+                               self._project_rules(projectID))
+            
+    def _set_timer(self, kind, key, deadline, callback, *args):
+        self._cancel_timer(kind, key)
+        self._timers[(kind, key)] = self.timers.schedule(deadline, callback, *args)
+        
+    def _cancel_timer(self, kind, key):
+        timer = self._timers.pop((kind, key), None)
+        if timer is not None:
+            self.timers.cancel(timer)
+            if self.checkpoint is not None:
+                self.checkpoint.delete('timed', (kind, key))
+        
+    def _project_timed_out(self, key):
+        """
+        Timer callback for a project that has had no obsdoc for
+        project_timeout seconds.
+        """
+        
+        self._timers.pop(('timeout', key), None)
+        scanInfo = self.last_scan.pop(key, None)
+        if scanInfo is not None:
+            self._scan_evicted(key, scanInfo, 'timeout')
+            
+    def _set_timed(self, kind, key, deadline, command, ruleNames):
+        """
+        Arrange for command to be sent at deadline, checkpointing it so
+        that it is still sent after a restart.
+        """
+        
+        self._set_timer(kind, key, deadline, self._send_timed, kind, key, command, ruleNames)
+        if self.checkpoint is not None:
+            self.checkpoint.set('timed', (kind, key), {'deadline': deadline,
+                                                      'command':  command,
+                                                      'rules':    list(ruleNames)})
+            
+    def _send_timed(self, kind, key, command, ruleNames):
+        """
+        Timer callback that sends a command made in advance.
+        """
+        
+        self._timers.pop((kind, key), None)
+        if self.checkpoint is not None:
+            self.checkpoint.delete('timed', (kind, key))
+        logger.info("Dispatching %s command for obs serial# %s." % (command['notice_type'][5:], command['event_id']))
+        self._send_command(command, ruleNames)
+        
+    def _schedule_scan_end(self, command, ruleNames):
+        """
+        Arrange for an ELWA_SCAN_END when the session in command is due to
+        end, replacing the one for an earlier version of the session.
+        """
+        
+        key = (command['subarray_id'], command['project_id'], command['event_id'])
+        self._cancel_timer('end', key)
+        if command['notice_type'] == 'ELWA_CANCEL' or command['event_duration'] <= 0:
+            return
+        endTime = command['event_t'] + command['event_duration']
+        if endTime <= time.time():
+            return
+        endCommand = dict(command, notice_type='ELWA_SCAN_END', event_t=endTime, event_duration=0)
+        for field in ('dispatch_t', 'lead_time', 'provisional', 'rules'):
+            endCommand.pop(field, None)
+        self._set_timed('end', key, endTime, endCommand, ruleNames)
+        
+    def _project_rules(self, projectID):
+        """
+        Names of the rules whose project predicate projectID passes.  These
+        get the project-wide READY and DONE commands.
+        """
+        
+        return tuple(rule.name for rule in self.rules.match_project(projectID))
+        
+    def _station_urls(self, ruleset):
+        """
+        The stations of ruleset that we look after, by name.  A station
+        from --station wins over one of the same name in the rules.
+        """
+        
+        if not isinstance(self.sink, fanout.FanoutSink):
+            return {}
+        return dict((name, url) for name,url in ruleset.stations if name not in self._fixed_stations)
+        
+    def _sync_stations(self, stations):
+        """
+        Start, stop and move the stations from the rules to match
+        stations.  A station whose URL changed is restarted with the
+        commands it had not sent yet.
+        """
+        
+        for name,url in sorted(self._rule_stations.items()):
+            newUrl = stations.get(name)
+            if newUrl == url:
+                continue
+            queue = self.sink.remove_station(name)
+            del self._rule_stations[name]
+            if newUrl is None:
+                logger.info("Removing station %s at %s, dropping %i queued commands" % (name, url, len(queue)))
+            else:
+                logger.info("Moving station %s from %s to %s" % (name, url, newUrl))
+                self.sink.add_station(name, newUrl, queue=queue)
+                self._rule_stations[name] = newUrl
+        for name,url in sorted(stations.items()):
+            if name not in self._rule_stations:
+                logger.info("Adding station %s at %s" % (name, url))
+                self.sink.add_station(name, url)
+                self._rule_stations[name] = url
+                
+    def set_rules(self, ruleset):
+        """
+        Switch to a new rule set, starting, stopping and moving the
+        stations it defines to match.  Raises ValueError, leaving the
+        current rules and stations in place, if a rule sends to a sink
+        that does not exist or a station URL is not valid.
+        
+        The rules are only ever swapped from the receive loop between
+        obsdocs, so an obsdoc is always handled by one rule set.  Scans
+        already in last_scan keep the names of the rules they matched and
+        are sent to whatever sinks those rules have in the new set.
+        """
+        
+        stations = self._station_urls(ruleset)
+        for url in stations.values():
+            fanout.check_station_url(url)
+        ruleset.check_sinks(list(self._fixed_stations) + list(stations))
+        self._sync_stations(stations)
+        old, self.rules = self.rules, ruleset
+        logger.info("Switched from %i to %i trigger rules" % (len(old), len(ruleset)))
+        
+    def poll(self):
+        """
+        Housekeeping to do while waiting for obsdocs: run the timers that
+        are due, let the sink resend or collect acknowledgements, age out
+        old projects, and report metrics and checkpoint the state when
+        they are due.
+        """
+        
+        self.timers.advance()
+        if hasattr(self.sink, 'poll'):
+            self.sink.poll()
+        self.last_scan.expire()
+        self.report_metrics()
+        if self.checkpoint is not None:
+            self.checkpoint.maybe_snapshot()
+            
+    def next_timeout(self):
+        """Seconds until the next timer is due, or None if there are none."""
+        
+        return self.timers.next_timeout()
+        
+    def _record_duration(self, key, duration):
+        durations = self.durations.setdefault(key, [])
+        durations.append(duration)
+        del durations[:-self.max_durations]
+        
+    def provisional_duration(self, key):
+        """
+        Return the duration to announce for a scan that has just started:
+        the median of the recent scans of the same project, or
+        default_duration if there are none yet.
+        """
+        
+        durations = sorted(self.durations.get(key, []))
+        if not durations:
+            return self.default_duration
+        return durations[len(durations)//2]
+        
+    def _make_command(self, config, eventType, eventID, eventIntent, eventTime, eventRA, eventDec, eventDur,
+                      eventURL, eventMetadata, eventScan=None, eventSource=None):
+        """
+        Build a command for a scan.  The scan number and source default to
+        those of config; commands about the previous scan pass its own.
+        """
+        
+        if eventScan is None:
+            eventScan = config.scan
+        if eventSource is None:
+            eventSource = config.source
+        command = {'notice_type':    eventType,
+                   'event_id':       eventID,
+                   'project_id':     config.projectID,
+                   'subarray_id':    config.subarrayId,
+                   'scan_id':        eventScan,
+                   'scan_intent':    eventIntent,
+                   'event_t':        eventTime,
+                   'event_source':   eventSource,
+                   'event_ra':       eventRA,
+                   'event_dec':      eventDec,
+                   'event_duration': eventDur,
+                   'config_url':     eventURL}
+        if self.config_cache is not None:
+            configPath = self.config_cache.get(config.Id)
+            if configPath is not None:
+                command['config_path'] = os.path.abspath(configPath)
+        if eventMetadata is not None:
+            command['scan_metadata'] = eventMetadata
+        return command
+        
+    def _send_command(self, command, ruleNames):
+        """
+        Hand a command over to the sinks of the rules called ruleNames.
+        """
+        
+        command['rules'] = list(ruleNames)
+        targets = self.rules.sinks_for(ruleNames)
+        if isinstance(self.sink, fanout.FanoutSink):
+            if not targets:
+                logger.info("No sinks for %s serial# %s, not sending" % (command['notice_type'], command['event_id']))
+                return
+            size = self.sink.send(command, targets=targets)
+        elif sinks.DEFAULT_SINK in targets:
+            size = self.sink.send(command)
+        else:
+            logger.info("No sinks for %s serial# %s, not sending" % (command['notice_type'], command['event_id']))
+            return
+        if self._file_sink is None or sinks.DEFAULT_SINK not in targets:
+            self._command_written(command, size)
+            
+        if self.scan_end and command['notice_type'] in ('ELWA_SESSION', 'ELWA_UPDATE', 'ELWA_CANCEL'):
+            self._schedule_scan_end(command, ruleNames)
+            
+    def _command_written(self, command, size):
+        """
+        Log the lead time of a command that has been handed over and keep
+        track of the last one for its project.  The command file sink
+        calls this when it writes a command that it had queued.
+        """
+        
+        dispatchTime = command['dispatch_t']
+        logger.info("Lead time for %s serial# %s is %.3f s" % (command['notice_type'], command['event_id'], command['lead_time']))
+        logger.info("Done, wrote %i bytes.\n" % size)
+        
+        key = (command['subarray_id'], command['project_id'])
+        if command['notice_type'] == 'ELWA_DONE':
+            self.dispatched.pop(key, None)
+            if self.checkpoint is not None:
+                self.checkpoint.delete('dispatched', key)
+        elif command['notice_type'] != 'ELWA_SCAN_END':
+            last = {'notice_type': command['notice_type'],
+                    'event_id':    command['event_id'],
+                    'scan_id':     command['scan_id'],
+                    'dispatch_t':  dispatchTime}
+            self.dispatched[key] = last
+            if self.checkpoint is not None:
+                self.checkpoint.set('dispatched', key, last, now=dispatchTime)
+        
+    def report_metrics(self, force=False):
+        """
+        Log the state store and sink metrics if metrics_interval seconds
+        have passed since the last report.
+        """
+        
+        now = time.time()
+        if not force and now - self._last_metrics < self.metrics_interval:
+            return
+        self._last_metrics = now
+        logger.info("Timers: %i pending, %i fired" % (len(self.timers), self.timers.fired))
+        metrics = self.last_scan.metrics()
+        logger.info("Scan state: %i entries (~%i B), %i expired, %i dropped for size" % (metrics['entries'],
+                                                                                       metrics['bytes'],
+                                                                                       metrics['evicted_ttl'],
+                                                                                       metrics['evicted_size']))
+        if hasattr(self.sink, 'metrics'):
+            metrics = self.sink.metrics()
+            if 'mode' in metrics:
+                logger.info("Command hand-off (%s): %i sent, waited %.3f s last, %.3f s mean, %.3f s max" % (metrics['mode'],
+                                                                                                             metrics['sent'],
+                                                                                                             metrics['wait_last'],
+                                                                                                             metrics['wait_mean'],
+                                                                                                             metrics['wait_max']))
+            if 'backlog' in metrics:
+                logger.info("Command queue: %i waiting, %i stale dropped, %i stale marked, %i coalesced" % (metrics['backlog'],
+                                                                                                            metrics['dropped_stale'],
+                                                                                                            metrics['marked_stale'],
+                                                                                                            metrics['coalesced']))
+            for name,station in sorted(metrics.get('stations', {}).items()):
+                logger.info("Station %s: %i delivered, %i failed, %i dropped, %i stale, %i skipped, %i queued; latency %.3f s last, %.3f s mean, %.3f s max" % (name,
+                                                                                                                                                                station['delivered'],
+                                                                                                                                                                station['failed'],
+                                                                                                                                                                station['dropped'],
+                                                                                                                                                                station['dropped_stale'],
+                                                                                                                                                                station['skipped'],
+                                                                                                                                                                station['backlog'],
+                                                                                                                                                                station['latency_last'],
+                                                                                                                                                                station['latency_mean'],
+                                                                                                                                                                station['latency_max']))
         
     def add_obsdoc(self, obsdoc):
         config = mcaf_library.MCAST_Config(obsdoc=obsdoc)
+        if hasattr(self.sink, 'poll'):
+            self.sink.poll()
+        last_scan = self.last_scan
+        last_scan.expire()
+        self.report_metrics()
 
         # Add last entry
         do_dispatch = False
-        if self.project == '' or self.project in config.projectID:
-            try:
-                logger.info(last_scan[config.projectID])
-            except KeyError:
-                logger.info(config.projectID)
+        projectRules = self._project_rules(config.projectID)
+        if projectRules:
+            # Subarrays of the same project run independent scan sequences
+            # so each one is tracked separately
+            key = (config.subarrayId, config.projectID)
+            lastScan = last_scan.get(key)
+            if lastScan is not None:
+                logger.info(lastScan)
+            else:
+                logger.info("%s (subarray %s)" % (config.projectID, config.subarrayId))
+                
+            # Start pulling the configuration document to local disk the first
+            # time we see its configId, normally with the first scan, so that
+            # consumers do not have to fetch it.  Once it is cached or being
+            # fetched this does nothing, and after a failed fetch nothing
+            # until its retry backoff has passed.
+            if self.config_cache is not None:
+                self.config_cache.prefetch(config.Id, config.obsdoc.configUrl)
                 
             # check that we have already scan information in last_scan
-            if config.projectID in list(last_scan.keys()):
-                if self.intent in last_scan[config.projectID].intent:
+            if lastScan is not None:
+                if lastScan.rules:
                     eventType = 'ELWA_SESSION'
-                    eventTime = last_scan[config.projectID].time
-                    eventRA   = last_scan[config.projectID].ra
-                    eventDec  = last_scan[config.projectID].dec
+                    eventTime = lastScan.time
+                    eventRA   = lastScan.ra
+                    eventDec  = lastScan.dec
                     eventDur  = config.startTime_unix - eventTime  - 30.0 # subtract expected delay 
-                    eventIntent = last_scan[config.projectID].intent
-                    eventID   = last_scan[config.projectID].id
+                    eventIntent = lastScan.intent
+                    eventID   = lastScan.id
+                    eventScan = lastScan.scan
+                    eventSource = lastScan.source
                     eventURL  = config.obsdoc.configUrl
-                    if eventDur >= 0:
+                    eventMetadata = lastScan.metadata
+                    eventRules = lastScan.rules
+                    if self.lookahead:
+                        # The stations were already told about this scan when
+                        # it started; now that we know how long it was either
+                        # confirm the duration or call it off
+                        do_dispatch = True
+                        if eventDur >= 0:
+                            eventType = 'ELWA_UPDATE'
+                            self._record_duration(key, eventDur)
+                        else:
+                            eventType = 'ELWA_CANCEL'
+                        logger.info("Will dispatch %s for %s with duration %s" % (eventType,
+                                                                                 config.projectID,
+                                                                                 eventDur))
+                    elif eventDur >= 0:
                         do_dispatch = True
                         logger.info("Will dispatch %s for position %s %s" % (config.projectID,
                                                                              eventRA,
@@ -95,8 +576,11 @@ class FRBController(object):
                     eventDec = -1
                     eventDur = -1
                     eventIntent = config.scan_intent
-                    eventID = int(time.strftime("%m%d%H%M", time.gmtime()), 10)
+                    eventID = self.event_ids.next()
+                    eventScan = eventSource = None
                     eventURL  = config.obsdoc.configUrl
+                    eventMetadata = config.to_dict() if self.full_metadata else None
+                    eventRules = projectRules
                     do_dispatch = True
                     
                 elif config.source == "FINISH":
@@ -108,8 +592,11 @@ class FRBController(object):
                     eventDec = -1
                     eventDur = -1
                     eventIntent = config.scan_intent
-                    eventID = int(time.strftime("%m%d%H%M", time.gmtime()), 10)
+                    eventID = self.event_ids.next()
+                    eventScan = eventSource = None
                     eventURL  = config.obsdoc.configUrl
+                    eventMetadata = config.to_dict() if self.full_metadata else None
+                    eventRules = projectRules
                     do_dispatch = True
                     
                 else:
@@ -123,61 +610,84 @@ class FRBController(object):
                                                                                   config.projectID))
                 
             if self.dispatch and do_dispatch:
-                # Wait until last command disappears (i.e. cmd file is deleted by server)
-                if os.path.exists(self.command_file):
-                    logger.info("Waiting for cmd queue to clear...")
-                while os.path.exists(self.command_file):
-                    time.sleep(1)
-                    
                 # Enqueue command
-                if eventDur > 0:
+                if eventType in ('ELWA_UPDATE', 'ELWA_CANCEL'):
+                    logger.info("Dispatching %s command for obs serial# %s." % (eventType[5:], eventID))
+                elif eventDur > 0:
                     logger.info("Dispatching SESSION command for obs serial# %s." % eventID)
                 else:
                     logger.info("Dispatching READY/DONE command for obs serial# %s." % eventID)
-                with open(self.command_file, 'w') as fh:
-                    json.dump({'notice_type':    eventType,
-                               'event_id':       eventID,
-                               'project_id':     config.projectID,
-                               'scan_id':        config.scan,
-                               'scan_intent':    eventIntent,
-                               'event_t':        eventTime,
-                               'event_source':   config.source,
-                               'event_ra':       eventRA,
-                               'event_dec':      eventDec,
-                               'event_duration': eventDur,
-                               'config_url':     eventURL}, fh)
-                logger.info("Done, wrote %i bytes.\n" % os.path.getsize(self.command_file))
+                command = self._make_command(config, eventType, eventID, eventIntent, eventTime, eventRA, eventDec,
+                                             eventDur, eventURL, eventMetadata, eventScan, eventSource)
+                self._send_command(command, eventRules)
                 
             # add or update last scan
             eventTime = config.startTime_unix
             eventRA   = config.ra_deg
             eventDec  = config.dec_deg
             eventIntent = config.scan_intent
-            eventID = int(time.strftime("%m%d%H%M", time.gmtime()), 10)
+            eventID = self.event_ids.next()
             eventSource = config.source
-            last_scan[config.projectID] = ScanInfo(time=eventTime,
-                                                   ra=eventRA, dec=eventDec,
-                                                   intent=eventIntent,
-                                                   id=eventID, source=eventSource)
+            eventMetadata = config.to_dict() if self.full_metadata else None
+            eventRules = tuple(rule.name for rule in self.rules.match(config))
+            self._set_scan(key, ScanInfo(time=eventTime,
+                                         ra=eventRA, dec=eventDec,
+                                         intent=eventIntent,
+                                         id=eventID, source=eventSource,
+                                         metadata=eventMetadata,
+                                         rules=eventRules,
+                                         scan=config.scan))
+            if self.project_timeout is not None:
+                self._set_timer('timeout', key, time.time() + self.project_timeout, self._project_timed_out, key)
             
             if config.source == "FINISH":
                 logger.info("*** Project %s finish scan (source=%s)" % (config.projectID,
                                                                         config.source))
                 # Remove last_scan information when observation finishes
-                del last_scan[config.projectID]
+                self._forget(key)
             else:
-                logger.info("*** Scan %d (%s) contains desired project (%s=%s)." % (config.scan,
-                                                                                    config.scan_intent,
-                                                                                    config.projectID,
-                                                                                    self.project))
+                logger.info("*** Scan %d (%s) contains desired project (%s), matching rules %s." % (config.scan,
+                                                                                                   config.scan_intent,
+                                                                                                   config.projectID,
+                                                                                                   ', '.join(eventRules) or 'none'))
                 logger.info("*** Position of source %s is (%s, %s) and start time (%s; unixtime %s)." % (config.source,
                                                                                                          config.ra_str,
                                                                                                          config.dec_str,
                                                                                                          str(config.startTime),
                                                                                                          str(config.startTime_unix)))
+                
+                if self.lookahead and self.dispatch and eventRules:
+                    # Tell the stations about the scan now rather than when
+                    # the next obsdoc arrives, with our best guess at how
+                    # long it will be
+                    eventDur = self.provisional_duration(key)
+                    logger.info("Dispatching provisional SESSION command for obs serial# %s (%.0f s)." % (eventID, eventDur))
+                    command = self._make_command(config, 'ELWA_SESSION', eventID, eventIntent, eventTime, eventRA,
+                                                 eventDec, eventDur, config.obsdoc.configUrl, eventMetadata)
+                    command['provisional'] = True
+                    self._send_command(command, eventRules)
+                    
+                # Remind the stations shortly before the scan starts; a newer
+                # obsdoc for the project replaces the reminder
+                self._cancel_timer('reminder', key)
+                if self.reminder is not None and self.dispatch and eventRules and \
+                   eventTime - self.reminder > time.time():
+                    command = self._make_command(config, 'ELWA_REMINDER', eventID, eventIntent, eventTime, eventRA,
+                                                 eventDec, -1, config.obsdoc.configUrl, eventMetadata)
+                    self._set_timed('reminder', key, eventTime - self.reminder, command, eventRules)
+                    
+        if self.checkpoint is not None:
+            self.checkpoint.maybe_snapshot()
             
 
-def monitor(intent, project, dispatch, command_file, verbose):
+def monitor(intent, project, dispatch, command_file, verbose, xml_backend=None,
+            quarantine_dir=None, full_metadata=False, config_cache_dir=None,
+            config_cache_size=64, state_ttl=86400.0, state_max_entries=1000,
+            done_on_evict=False, state_file=None, checkpoint_interval=60.0, lookahead=False,
+            default_duration=300.0, spool_dir=None, spool_retention=86400.0, spool_fsync=False,
+            push=None, push_buffer=1000, stations=None, station_queue=100, rules_file=None,
+            rules_check_interval=5.0, stale='drop', stale_grace=60.0, scan_end=False, reminder=None,
+            project_timeout=None):
     """
     Monitor of mcaf observation files.
     Scans that match intent and project are searched (unless --dispatch).
@@ -190,12 +700,66 @@ def monitor(intent, project, dispatch, command_file, verbose):
     else:
         logger.setLevel(logging.INFO)
         
+    # Load the trigger rules, adding any stations they define to those
+    # from the command line
+    ruleset = None
+    stations = list(stations or [])
+    fixed_stations = list(stations)
+    if rules_file is not None:
+        ruleset = rules.RuleSet.from_file(rules_file)
+        names = set(name for name,url in stations)
+        for name,url in ruleset.stations:
+            if name not in names:
+                stations.append((name, url))
+        ruleset.check_sinks([name for name,url in stations])
+        
+    # Select the XML backend and measure what it costs per obsdoc
+    xml_backend = obsdocxml_parser.select_xml_backend(xml_backend)
+    xml_cost = obsdocxml_parser.benchmark_xml_backend()
+    
     # Report start-up information
     logger.info('* * * * * * * * * * * * * * * * * * * * *')
     logger.info('* * * VLA Dispatcher is now running * * *')
     logger.info('* * * * * * * * * * * * * * * * * * * * *')
-    logger.info('*   Looking for intent = \'%s\'', intent)
-    logger.info('*               project = \'%s\'',  project)
+    if ruleset is not None:
+        logger.info('*   Trigger rules from \'%s\' (reloaded on change or SIGHUP):', rules_file)
+        for rule in ruleset.rules:
+            logger.info('*     %s', rule)
+    else:
+        logger.info('*   Looking for intent = \'%s\'', intent)
+        logger.info('*               project = \'%s\'',  project)
+    logger.info('*   XML backend = %s (%.1f us per obsdoc)', xml_backend, xml_cost*1e6)
+    if full_metadata:
+        logger.info('*   Including full scan metadata in commands (JSON via %s)', json_backend.JSON_backend_name)
+    if config_cache_dir is not None:
+        logger.info('*   Caching configuration documents in \'%s\' (up to %i MB)', config_cache_dir, config_cache_size)
+    logger.info('*   Project state expires after %.0f s idle, at most %i entries%s', state_ttl, state_max_entries,
+                '; sending ELWA_DONE on expiry' if done_on_evict else '')
+    if push is not None:
+        logger.info('*   Pushing commands to %s (up to %i unacknowledged)', push, push_buffer)
+    elif spool_dir is not None:
+        logger.info('*   Spooling commands to \'%s\' (acknowledged commands kept %.0f s%s)', spool_dir,
+                    spool_retention, ', synced' if spool_fsync else '')
+    else:
+        logger.info('*   Writing commands to \'%s\'', command_file)
+    if stale != 'keep':
+        logger.info('*   Queued sessions over for more than %.0f s are %s', stale_grace,
+                    'dropped' if stale == 'drop' else 'marked stale and sent last')
+    for name,url in fixed_stations:
+        logger.info('*   Also sending commands to station %s at %s', name, url)
+    if lookahead:
+        logger.info('*   Lookahead mode: SESSION at scan start, %.0f s until scans have been timed', default_duration)
+    if scan_end:
+        logger.info('*   Sending ELWA_SCAN_END when dispatched sessions end')
+    if reminder is not None:
+        logger.info('*   Sending ELWA_REMINDER %.0f s before matching scans start', reminder)
+    if project_timeout is not None:
+        logger.info('*   Projects time out after %.0f s without an obsdoc%s', project_timeout,
+                    '; sending ELWA_DONE' if done_on_evict else '')
+    if state_file is not None:
+        logger.info('*   Checkpointing state to \'%s\' every %.0f s', state_file, checkpoint_interval)
+    if quarantine_dir is not None:
+        logger.info('*   Unparseable obsdocs will be saved to \'%s\'', quarantine_dir)
     logger.debug('*   Running in verbose mode')
     if dispatch:
         logger.info('*   Running in dispatch mode. Will dispatch obs commands.')
@@ -204,14 +768,75 @@ def monitor(intent, project, dispatch, command_file, verbose):
     logger.info('* * * * * * * * * * * * * * * * * * * * *')
     
     # This starts the receiving/handling loop
+    cache = None
+    if config_cache_dir is not None:
+        cache = config_cache.ConfigCache(config_cache_dir, max_bytes=config_cache_size*1024**2)
+    state = None
+    if state_file is not None:
+        state = checkpoint.StateCheckpoint(state_file, snapshot_interval=checkpoint_interval)
+    if push is not None:
+        sink = socket_sink.SocketSink(push, max_buffer=push_buffer)
+    elif spool_dir is not None:
+        sink = sinks.SpoolSink(spool_dir, retention=spool_retention, fsync=spool_fsync)
+    else:
+        sink = sinks.CommandFileSink(command_file, stale=stale, stale_grace=stale_grace)
+    if stations or ruleset is not None:
+        sink = fanout.FanoutSink(sink, fixed_stations, max_queue=station_queue, stale=stale, stale_grace=stale_grace)
+    # Hand over queued commands as soon as the command file is consumed
+    if hasattr(sink, 'wakeup_fd') and sink.wakeup_fd() is not None:
+        file_waiter.WakeupDispatcher(sink.wakeup_fd(), sink.poll)
     controller = FRBController(intent=intent, project=project, dispatch=dispatch,
-                               command_file=command_file, verbose=verbose)
-    obsdoc_client = mcaf_library.ObsdocClient(controller)
+                               command_file=command_file, verbose=verbose,
+                               full_metadata=full_metadata, config_cache=cache,
+                               state_ttl=state_ttl, state_max_entries=state_max_entries,
+                               done_on_evict=done_on_evict, checkpoint=state,
+                               lookahead=lookahead, default_duration=default_duration,
+                               sink=sink, ruleset=ruleset, scan_end=scan_end, reminder=reminder,
+                               project_timeout=project_timeout)
+    parse_quarantine = quarantine.ParseQuarantine(spool_dir=quarantine_dir)
+    obsdoc_client = mcaf_library.ObsdocClient(controller, quarantine=parse_quarantine)
+    reloader = None
+    if rules_file is not None:
+        reloader = rules.RuleReloader(rules_file, check_interval=rules_check_interval)
+        
+    # Treat a SIGTERM from systemd like a Ctrl-C so that we leave a fresh
+    # snapshot behind
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # SIGHUP (systemctl reload) rereads the rules file.  The handler only
+    # flags the reload, which happens in the loop below between obsdocs.
+    def _reload(signum, frame):
+        if reloader is not None:
+            reloader.request()
+        else:
+            logger.warning('Got SIGHUP but there is no --rules file to reload')
+    signal.signal(signal.SIGHUP, _reload)
     try:
-        asyncore.loop()
-    except KeyboardInterrupt:
+        # Wake up at least every LOOP_TIMEOUT seconds, and in time for the
+        # next timer, to pick up new rules and do the housekeeping that
+        # would otherwise wait for an obsdoc, including the quarantine
+        # report
+        while asyncore.socket_map:
+            timeout = controller.next_timeout()
+            if timeout is None or timeout > LOOP_TIMEOUT:
+                timeout = LOOP_TIMEOUT
+            asyncore.loop(timeout=timeout, count=1)
+            if reloader is not None:
+                ruleset = reloader.check()
+                if ruleset is not None:
+                    try:
+                        controller.set_rules(ruleset)
+                    except ValueError as e:
+                        logger.error("Not using the rules from '%s': %s", rules_file, str(e))
+            controller.poll()
+            parse_quarantine.maybe_report()
+    except (KeyboardInterrupt, SystemExit):
         # Just exit without the trace barf
         logger.info('Escaping monitor')
+    finally:
+        parse_quarantine.maybe_report(force=True)
+        sink.close()
+        if state is not None:
+            state.close()
 
 
 if __name__ == '__main__':
@@ -224,11 +849,76 @@ if __name__ == '__main__':
                         help='Trigger on what intent substring?')
     parser.add_argument('-p', '--project', type=str, default='',
                         help='Trigger on what project substring?')
+    parser.add_argument('-r', '--rules', type=str, default=None,
+                        help='JSON file of trigger rules, each with its own sinks, to use instead of --intent/--project')
+    parser.add_argument('--rules-check-interval', type=float, default=5.0,
+                        help='seconds between checks of the rules file for changes')
     parser.add_argument('-d', '--dispatch', action='store_true',
                         help="Actually run dispatcher; don't just listen to multicast") 
     parser.add_argument('-c', '--command-file', type=str, default='incoming.json',
                         help='filename to write commands to')
+    parser.add_argument('-u', '--push', type=str, default=None,
+                        help="push commands over a socket, 'unix:/path' or 'host:port', instead of writing files")
+    parser.add_argument('--push-buffer', type=int, default=1000,
+                        help='maximum number of unacknowledged commands to keep for resending')
+    parser.add_argument('-S', '--station', type=fanout.parse_station, action='append', default=[],
+                        help='also send commands directly to a station, as NAME=URL with a udp:, mcast:, tcp:, unix: or legacy:host:port URL; may be repeated')
+    parser.add_argument('--station-queue', type=int, default=100,
+                        help='maximum number of commands queued for each station')
+    parser.add_argument('--stale', type=str, default='drop', choices=command_queue.STALE_POLICIES,
+                        help="what to do with queued ELWA_SESSION commands whose scan is over: drop them, mark them stale and send them last, or keep them")
+    parser.add_argument('--stale-grace', type=float, default=60.0,
+                        help='seconds after the end of a scan before its ELWA_SESSION counts as stale')
+    parser.add_argument('-o', '--spool-dir', type=str, default=None,
+                        help='write each command to its own file in this directory instead of --command-file')
+    parser.add_argument('--spool-retention', type=float, default=86400.0,
+                        help='seconds to keep acknowledged commands in the spool')
+    parser.add_argument('--spool-fsync', action='store_true',
+                        help='sync each spooled command to disk before it becomes visible')
+    parser.add_argument('-x', '--xml-backend', type=str, default=None,
+                        choices=obsdocxml_parser.XML_backend_names,
+                        help="XML library to parse obsdocs with; defaults to $%s or 'auto'" % obsdocxml_parser.XML_backend_env_)
+    parser.add_argument('-l', '--lookahead', action='store_true',
+                        help='dispatch SESSION when a scan starts with a provisional duration and follow up with UPDATE/CANCEL')
+    parser.add_argument('--default-duration', type=float, default=300.0,
+                        help='provisional scan duration in seconds for lookahead mode before any scans have been timed')
+    parser.add_argument('--scan-end', action='store_true',
+                        help='send ELWA_SCAN_END when the window of a dispatched ELWA_SESSION ends')
+    parser.add_argument('--reminder', type=float, default=None,
+                        help='send ELWA_REMINDER this many seconds before a matching scan starts')
+    parser.add_argument('--project-timeout', type=float, default=None,
+                        help='forget a project, sending ELWA_DONE with --done-on-evict, after this many seconds without an obsdoc')
+    parser.add_argument('-m', '--full-metadata', action='store_true',
+                        help='include the full scan metadata in each command')
+    parser.add_argument('-k', '--config-cache-dir', type=str, default=None,
+                        help='directory to prefetch and cache configuration documents in')
+    parser.add_argument('--config-cache-size', type=int, default=64,
+                        help='maximum size of the configuration cache in MB')
+    parser.add_argument('--state-ttl', type=float, default=86400.0,
+                        help='seconds without an obsdoc after which a project is forgotten')
+    parser.add_argument('--state-max-entries', type=int, default=1000,
+                        help='maximum number of projects to keep state for')
+    parser.add_argument('--done-on-evict', action='store_true',
+                        help='send an ELWA_DONE when a project is forgotten without its FINISH scan')
+    parser.add_argument('-s', '--state-file', type=str, default=None,
+                        help='file to checkpoint the project state to so that it survives a restart')
+    parser.add_argument('--checkpoint-interval', type=float, default=60.0,
+                        help='seconds between full snapshots of the state file')
+    parser.add_argument('-q', '--quarantine-dir', type=str, default=None,
+                        help='directory to save obsdocs that fail to parse to')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='verbose output')
     args = parser.parse_args()
-    monitor(args.intent, args.project, args.dispatch, args.command_file, args.verbose)
+    monitor(args.intent, args.project, args.dispatch, args.command_file, args.verbose,
+            xml_backend=args.xml_backend, quarantine_dir=args.quarantine_dir,
+            full_metadata=args.full_metadata, config_cache_dir=args.config_cache_dir,
+            config_cache_size=args.config_cache_size, state_ttl=args.state_ttl,
+            state_max_entries=args.state_max_entries, done_on_evict=args.done_on_evict,
+            state_file=args.state_file, checkpoint_interval=args.checkpoint_interval,
+            lookahead=args.lookahead, default_duration=args.default_duration,
+            spool_dir=args.spool_dir, spool_retention=args.spool_retention, spool_fsync=args.spool_fsync,
+            push=args.push, push_buffer=args.push_buffer, stations=args.station,
+            station_queue=args.station_queue, rules_file=args.rules,
+            rules_check_interval=args.rules_check_interval, stale=args.stale,
+            stale_grace=args.stale_grace, scan_end=args.scan_end, reminder=args.reminder,
+            project_timeout=args.project_timeout)
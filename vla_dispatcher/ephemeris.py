@@ -0,0 +1,147 @@
+"""
+Evaluation of the ephemeris polynomials carried by obsdoc documents for
+moving targets (planets, comets, ...).
+
+The <ephemeris> block of an obsdoc gives RA, Dec and distance as
+polynomials in time expanded about referenceTime (MJD).  Each
+<coeff order="n"> is the coefficient of (t - referenceTime)**n with t in
+MJD days.  RA and Dec come out in radians, like the static <ra> and <dec>
+elements of the obsdoc.
+
+Times can be given as a single MJD or as a sequence of MJDs.  With NumPy
+available a sequence is evaluated in one vectorized Horner pass and
+NumPy arrays are returned; without it the evaluation falls back to a
+per-element loop and lists are returned.
+"""
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SECS_IN_DAY = 86400.0
+TWO_PI = 2.0*math.pi
+
+
+def poly_coefficients(poly):
+    """
+    Return the coefficients of a polyType as a dense list, lowest order
+    first.  Orders that are not listed are taken to be zero and coeffs
+    without an order attribute are placed by their position.
+    """
+
+    if poly is None or not poly.coeff:
+        return []
+
+    orders = []
+    for i,coeff in enumerate(poly.coeff):
+        orders.append(i if coeff.order is None else coeff.order)
+    coeffs = [0.0]*(max(orders) + 1)
+    for order,coeff in zip(orders, poly.coeff):
+        coeffs[order] = float(coeff.valueOf_)
+    return coeffs
+
+
+def horner(coeffs, dt):
+    """
+    Evaluate the polynomial with the given coefficients (lowest order
+    first) at dt using Horner's scheme.  dt can be a float or a NumPy
+    array.
+    """
+
+    if not coeffs:
+        return dt*0.0
+    value = coeffs[-1]
+    for c in coeffs[-2::-1]:
+        value = value*dt + c
+    return value + dt*0.0
+
+
+def _is_sequence(value):
+    return hasattr(value, '__len__')
+
+
+def to_degrees(value):
+    """Convert radians to degrees for a float, list or NumPy array."""
+
+    if isinstance(value, list):
+        return [math.degrees(v) for v in value]
+    return value*(180.0/math.pi)
+
+
+class Ephemeris(object):
+    """
+    Pre-parsed form of an obsdoc ephemerisType, ready to be evaluated at
+    arbitrary times.
+    """
+
+    def __init__(self, ephem):
+        self.referenceTime = float(ephem.referenceTime or 0.0)
+        self.origin = ephem.origin
+        self.ra_coeffs = poly_coefficients(ephem.ra_polynomial)
+        self.dec_coeffs = poly_coefficients(ephem.dec_polynomial)
+        self.dist_coeffs = poly_coefficients(ephem.dist_polynomial)
+
+    @classmethod
+    def from_obsdoc(cls, obsdoc):
+        """
+        Return an Ephemeris for the obsdoc, or None if it does not carry
+        usable RA/Dec polynomials.
+        """
+
+        ephem = getattr(obsdoc, 'ephemeris', None)
+        if ephem is None or ephem.ra_polynomial is None or ephem.dec_polynomial is None:
+            return None
+        self = cls(ephem)
+        if not self.ra_coeffs or not self.dec_coeffs:
+            return None
+        return self
+
+    def _evaluate(self, coeffs, mjd):
+        if _is_sequence(mjd):
+            if numpy is None:
+                return [horner(coeffs, t - self.referenceTime) for t in mjd]
+            mjd = numpy.asarray(mjd, dtype=numpy.float64)
+        return horner(coeffs, mjd - self.referenceTime)
+
+    def ra(self, mjd):
+        """RA in radians, wrapped to [0, 2pi), at the given MJD(s)."""
+
+        value = self._evaluate(self.ra_coeffs, mjd)
+        if isinstance(value, list):
+            return [v % TWO_PI for v in value]
+        return value % TWO_PI
+
+    def dec(self, mjd):
+        """Dec in radians at the given MJD(s)."""
+
+        return self._evaluate(self.dec_coeffs, mjd)
+
+    def dist(self, mjd):
+        """Distance at the given MJD(s), or None if no polynomial was sent."""
+
+        if not self.dist_coeffs:
+            return None
+        return self._evaluate(self.dist_coeffs, mjd)
+
+    def position(self, mjd):
+        """Return an (ra, dec) tuple in radians at the given MJD(s)."""
+
+        return self.ra(mjd), self.dec(mjd)
+
+    def track(self, start_mjd, duration_sec, step_sec=10.0):
+        """
+        Sample the track from start_mjd over duration_sec seconds every
+        step_sec seconds (the end point is always included).  Returns a
+        three-element tuple of MJD, RA and Dec (radians).
+        """
+
+        nstep = max(1, int(math.ceil(duration_sec / float(step_sec))))
+        if numpy is not None:
+            mjd = start_mjd + numpy.minimum(numpy.arange(nstep + 1)*step_sec, duration_sec)/SECS_IN_DAY
+        else:
+            mjd = [start_mjd + min(i*step_sec, duration_sec)/SECS_IN_DAY for i in range(nstep + 1)]
+        ra, dec = self.position(mjd)
+        return mjd, ra, dec
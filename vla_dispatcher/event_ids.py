@@ -0,0 +1,146 @@
+"""
+Monotonic event IDs that do not repeat across restarts.
+
+IDs come from a counter in memory.  To survive a restart the allocator
+reserves them in blocks of block_size: before the first ID of a block is
+handed out the end of the block is written to the state checkpoint (see
+checkpoint.StateCheckpoint), and after a restart the counter carries on
+from the end of the last block reserved.  Whatever was left of that block
+is skipped, so an ID is never issued twice even after a crash, and there
+is only one checkpoint write per block_size IDs.
+
+The counter also never starts below the number of seconds since
+ID_EPOCH, which keeps the IDs increasing if the state file is lost as long
+as fewer than one ID a second was issued on average.  The IDs stay above
+the MMDDHHMM IDs used before and fit in the signed 32-bit event field of
+the legacy packet until 2088.
+"""
+
+import time
+import calendar
+import threading
+
+"""
+Start of the time floor, 2020-01-01 UTC.
+"""
+ID_EPOCH = calendar.timegm((2020, 1, 1, 0, 0, 0))
+"""
+Number of IDs reserved with each checkpoint write.
+"""
+ID_BLOCK_SIZE = 1000
+"""
+Checkpoint table and key that the end of the reserved block is kept under.
+"""
+CHECKPOINT_TABLE = 'event_ids'
+CHECKPOINT_KEY = 'reserved'
+
+
+class EventIdAllocator(object):
+    """
+    Hands out increasing integer event IDs.
+    """
+
+    def __init__(self, checkpoint=None, block_size=ID_BLOCK_SIZE, now=None):
+        if now is None:
+            now = time.time()
+        self.checkpoint = checkpoint
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._next = max(int(now - ID_EPOCH), 1)
+        self._reserved = self._next
+        self.reservations = 0
+
+    def restore(self, reserved):
+        """
+        Carry on after the block that ended at reserved, as recorded in
+        the checkpoint before a restart.
+        """
+
+        with self._lock:
+            self._next = max(self._next, int(reserved))
+            self._reserved = self._next
+
+    def _reserve(self):
+        self._reserved = self._next + self.block_size
+        self.reservations += 1
+        if self.checkpoint is not None:
+            self.checkpoint.set(CHECKPOINT_TABLE, CHECKPOINT_KEY, self._reserved)
+
+    def next(self):
+        """Return a new event ID."""
+
+        with self._lock:
+            if self._next >= self._reserved:
+                self._reserve()
+            eventID = self._next
+            self._next += 1
+            return eventID
+
+    __next__ = next
+
+    def __iter__(self):
+        return self
+
+    @property
+    def last(self):
+        """The most recent ID handed out."""
+
+        return self._next - 1
+
+
+# Some tests.
+def _test_event_ids():
+    """IDs increase within a run, across restarts, and without a checkpoint."""
+    import os
+    import shutil
+    import tempfile
+
+    import checkpoint
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'state.json')
+        state = checkpoint.StateCheckpoint(path, fsync=False)
+        ids = EventIdAllocator(state, block_size=100)
+        issued = [ids.next() for i in range(250)]
+        assert issued == list(range(issued[0], issued[0] + 250))
+        assert ids.reservations == 3
+        state.close()
+
+        # A restart skips the rest of the last block
+        state = checkpoint.StateCheckpoint(path, fsync=False)
+        ids = EventIdAllocator(state, block_size=100)
+        for key,value,updated in state.load().get(CHECKPOINT_TABLE, []):
+            ids.restore(value)
+        assert ids.next() == issued[0] + 300
+        state.close()
+
+        # Without the checkpoint the clock still keeps us ahead
+        later = EventIdAllocator(now=time.time() + 3600)
+        assert later.next() > issued[-1] + 3000
+        assert EventIdAllocator(now=calendar.timegm((2088, 1, 1, 0, 0, 0))).next() < 2**31
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _bench_event_ids(count=1000000):
+    """IDs per second with a checkpoint write every ID_BLOCK_SIZE."""
+    import os
+    import shutil
+    import tempfile
+
+    import checkpoint
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        state = checkpoint.StateCheckpoint(os.path.join(tmpdir, 'state.json'))
+        ids = EventIdAllocator(state)
+        t0 = time.time()
+        for i in range(count):
+            ids.next()
+        elapsed = time.time() - t0
+        print("%i IDs in %.2f s, %.0f per second, %i reservations" % (count, elapsed, count/elapsed,
+                                                                       ids.reservations))
+        state.close()
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,252 @@
+"""
+Configuration model of a VLA scan built from its obsdoc and, when
+available, the VCI configuration document that configUrl points to.
+
+MCAST_Config only knows the basebands through the obsdoc sslo entries.
+The VCI document adds the WIDAR setup: the subbands (spectral windows) of
+each baseband with their bandwidth, central frequency and number of
+channels.  Everything is held as parallel columns, NumPy arrays if NumPy
+is available and lists if not, so that trigger rules can ask questions
+like "does the observation overlap the LWA band?" with array operations.
+
+Frequencies are sky frequencies in MHz.  A baseband covers from its SSLO
+frequency to SSLO + sideband*bandwidth; a subband is centered at
+SSLO + sideband*centralFreq within its baseband.
+"""
+
+import logging
+
+import obsdocxml_parser
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+"""
+Frequency range in MHz covered by the LWA stations.
+"""
+LWA_BAND = (10.0, 88.0)
+"""
+Baseband width in MHz assumed when there is no VCI document to say.
+"""
+DEFAULT_BASEBAND_BW = 1024.0
+"""
+Hz to MHz.
+"""
+HZ_TO_MHZ = 1e-6
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _children(node, name):
+    return [child for child in node if _local_name(child.tag) == name]
+
+
+def _find_all(node, name):
+    return [child for child in node.iter() if _local_name(child.tag) == name]
+
+
+def _float_attr(node, name, default=None):
+    value = node.get(name)
+    if value is None:
+        return default
+    return float(value)
+
+
+def parse_vci(vci):
+    """
+    Parse a VCI document (a string or an open file) and return a list of
+    baseband dictionaries with the keys 'name', 'swbbName', 'bw' (MHz) and
+    'subbands'.  'subbands' is a list of dictionaries with 'sbid', 'bw'
+    (MHz), 'centralFreq' (MHz, relative to the baseband edge) and
+    'nchan'.  Only the first stationInputOutput is used since the
+    basebands are the same for every station.
+    """
+
+    if hasattr(vci, 'read'):
+        vci = vci.read()
+    root = obsdocxml_parser.parsexmlstring_(vci)
+
+    stations = _find_all(root, 'stationInputOutput')
+    if stations:
+        basebands = _children(stations[0], 'baseBand')
+    else:
+        basebands = _find_all(root, 'baseBand')
+
+    result = []
+    seen = set()
+    for bb in basebands:
+        swbbName = bb.get('swbbName') or bb.get('name')
+        if swbbName in seen:
+            continue
+        seen.add(swbbName)
+
+        subbands = []
+        for sb in _children(bb, 'subBand'):
+            nchan = 0
+            for node in sb.iter():
+                value = node.get('spectralChannels')
+                if value is not None:
+                    nchan = max(nchan, int(value))
+            subbands.append({'sbid': int(sb.get('sbid', len(subbands))),
+                             'bw': _float_attr(sb, 'bw', 0.0)*HZ_TO_MHZ,
+                             'centralFreq': _float_attr(sb, 'centralFreq', 0.0)*HZ_TO_MHZ,
+                             'nchan': nchan})
+
+        result.append({'name': bb.get('name'),
+                       'swbbName': swbbName,
+                       'bw': _float_attr(bb, 'bw', 0.0)*HZ_TO_MHZ or None,
+                       'subbands': subbands})
+    return result
+
+
+def _column(values, dtype):
+    if numpy is None:
+        return list(values)
+    return numpy.array(values, dtype=dtype)
+
+
+def baseband_edges(sslo, sideband, bw):
+    """
+    Return the (low, high) sky frequency columns of basebands that run
+    from sslo to sslo + sideband*bw MHz.  bw can be a column or a single
+    width, and a sideband of 0 (not known) counts as +1.
+    """
+
+    if numpy is not None:
+        sslo = numpy.asarray(sslo, dtype='float64')
+        sideband = numpy.asarray(sideband)
+        other = sslo + numpy.where(sideband == 0, 1, sideband)*bw
+        return numpy.minimum(sslo, other), numpy.maximum(sslo, other)
+    if not isinstance(bw, (list, tuple)):
+        bw = [bw]*len(sslo)
+    low, high = [], []
+    for freq,sense,width in zip(sslo, sideband, bw):
+        other = freq + (sense or 1)*width
+        low.append(min(freq, other))
+        high.append(max(freq, other))
+    return low, high
+
+
+class EVLAConfig(object):
+    """
+    Basebands and spectral windows of a scan as columns.
+
+    Basebands (one entry per sslo in the obsdoc):
+      bb_IFid, bb_swbbName, bb_receiver, bb_sslo, bb_sideband, bb_bw,
+      bb_freq_lo, bb_freq_hi
+    Spectral windows (one entry per VCI subband, empty without a VCI):
+      spw_IFid, spw_sbid, spw_bw, spw_nchan, spw_center, spw_freq_lo,
+      spw_freq_hi
+    """
+
+    def __init__(self, config, vci=None):
+        """
+        Build the model for an mcaf_library.MCAST_Config, optionally with a
+        VCI document given as a string, open file, or the result of
+        parse_vci().
+        """
+
+        self.config = config
+        if vci is not None and not isinstance(vci, list):
+            vci = parse_vci(vci)
+        self.has_vci = vci is not None
+
+        # Basebands come from the obsdoc, with the VCI filling in widths
+        vci_by_IFid = {}
+        for bb in (vci or []):
+            vci_by_IFid[config.swbbName_to_IFid(bb['swbbName'])] = bb
+
+        bb_IFid, bb_swbbName, bb_receiver, bb_sslo, bb_sideband, bb_bw = [], [], [], [], [], []
+        spw_IFid, spw_sbid, spw_bw, spw_nchan, spw_center = [], [], [], [], []
+        for sslo in (config.obsdoc.sslo if config.obsdoc is not None else []):
+            bb = vci_by_IFid.get(sslo.IFid)
+            sideband = sslo.Sideband or 1
+            bb_IFid.append(sslo.IFid)
+            bb_swbbName.append(bb['swbbName'] if bb is not None else '')
+            bb_receiver.append(sslo.Receiver)
+            bb_sslo.append(sslo.freq)
+            bb_sideband.append(sideband)
+            bb_bw.append((bb['bw'] if bb is not None else None) or DEFAULT_BASEBAND_BW)
+
+            for sb in (bb['subbands'] if bb is not None else []):
+                spw_IFid.append(sslo.IFid)
+                spw_sbid.append(sb['sbid'])
+                spw_bw.append(sb['bw'])
+                spw_nchan.append(sb['nchan'])
+                spw_center.append(sslo.freq + sideband*sb['centralFreq'])
+
+        self.bb_IFid = _column(bb_IFid, str)
+        self.bb_swbbName = _column(bb_swbbName, str)
+        self.bb_receiver = _column(bb_receiver, str)
+        self.bb_sslo = _column(bb_sslo, 'float64')
+        self.bb_sideband = _column(bb_sideband, 'int8')
+        self.bb_bw = _column(bb_bw, 'float64')
+
+        self.spw_IFid = _column(spw_IFid, str)
+        self.spw_sbid = _column(spw_sbid, 'int32')
+        self.spw_bw = _column(spw_bw, 'float64')
+        self.spw_nchan = _column(spw_nchan, 'int32')
+        self.spw_center = _column(spw_center, 'float64')
+
+        self.bb_freq_lo, self.bb_freq_hi = baseband_edges(self.bb_sslo, self.bb_sideband, self.bb_bw)
+        if numpy is not None:
+            self.spw_freq_lo = self.spw_center - self.spw_bw/2.0
+            self.spw_freq_hi = self.spw_center + self.spw_bw/2.0
+        else:
+            self.spw_freq_lo = [c - bw/2.0 for c,bw in zip(spw_center, spw_bw)]
+            self.spw_freq_hi = [c + bw/2.0 for c,bw in zip(spw_center, spw_bw)]
+
+    @classmethod
+    def from_file(cls, config, filename):
+        """Build the model with the VCI document read from filename."""
+
+        with open(filename, 'rb') as fh:
+            return cls(config, fh.read())
+
+    @property
+    def nspw(self):
+        return len(self.spw_sbid)
+
+    def _ranges(self):
+        # Use the spectral windows when the VCI gave us any
+        if self.nspw:
+            return self.spw_freq_lo, self.spw_freq_hi
+        return self.bb_freq_lo, self.bb_freq_hi
+
+    def overlaps(self, fmin, fmax):
+        """
+        Return a boolean column with one entry per spectral window (per
+        baseband without a VCI document) that is True where it overlaps
+        the range fmin to fmax MHz.
+        """
+
+        lo, hi = self._ranges()
+        if numpy is not None:
+            return (lo < fmax) & (hi > fmin)
+        return [l < fmax and h > fmin for l,h in zip(lo, hi)]
+
+    def overlaps_band(self, fmin, fmax):
+        """True if any part of the observation overlaps fmin to fmax MHz."""
+
+        return bool(any(self.overlaps(fmin, fmax)))
+
+    def overlaps_lwa(self):
+        """True if any part of the observation falls in the LWA band."""
+
+        return self.overlaps_band(*LWA_BAND)
+
+    def channel_freqs(self, index):
+        """Return the channel center frequencies in MHz of spectral window index."""
+
+        nchan = int(self.spw_nchan[index])
+        lo = float(self.spw_freq_lo[index])
+        width = float(self.spw_bw[index]) / max(nchan, 1)
+        if numpy is not None:
+            return lo + width*(numpy.arange(nchan) + 0.5)
+        return [lo + width*(i + 0.5) for i in range(nchan)]
@@ -0,0 +1,440 @@
+"""
+Fan-out of commands to a set of LWA station endpoints.
+
+Every station has its own queue and worker thread, so a station that is
+slow or unreachable only ever holds up its own commands.  Stations are
+given as URLs:
+ * udp:host:port     one JSON datagram per command
+ * mcast:group:port  the same, sent to a multicast group
+ * tcp:host:port     a socket_sink.SocketSink connection with
+   acknowledgements and resending
+ * unix:/path        the same over a Unix domain socket
+ * legacy:host:port  the 160-byte packets of legacy_packet over TCP, for
+   receivers like client_tools/client_software.py
+
+Each station's queue is a command_queue.CommandQueue, so a station that
+has fallen behind gets the most actionable commands first and is not sent
+sessions that are already over.  For each station we keep the number of
+commands queued, delivered, failed, dropped (queue full), dropped as
+stale and skipped because the station has no use for them (ELWA_READY and
+ELWA_REMINDER for legacy: stations), and the delivery latency, i.e. the
+time from the command being queued to it being written out (UDP) or
+acknowledged (TCP/Unix/legacy).
+"""
+
+import time
+import socket
+import logging
+import threading
+
+import json_backend
+import socket_sink
+import command_queue
+from sinks import stamp_command, DEFAULT_SINK
+
+logger = logging.getLogger(__name__)
+
+"""
+Multicast TTL for the mcast: stations.
+"""
+MCAST_TTL = 16
+"""
+Station URL schemes understood by make_station_sink().
+"""
+STATION_SCHEMES = ('udp', 'mcast', 'tcp', 'unix', 'legacy')
+
+
+class DatagramSink(object):
+    """
+    Sends each command as a single UDP datagram of JSON.
+    """
+
+    def __init__(self, address, multicast=False):
+        self.address = address
+        host, port = address.rsplit(':', 1)
+        self.sockaddr = (host, int(port, 10))
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if multicast:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MCAST_TTL)
+
+    def send(self, command):
+        data = json_backend.dumps(stamp_command(command)).encode('utf-8')
+        self.sock.sendto(data, self.sockaddr)
+        return len(data)
+
+    def close(self):
+        self.sock.close()
+
+
+def check_station_url(url):
+    """
+    Raise ValueError if url is not a station URL.
+    """
+
+    scheme, sep, address = url.partition(':')
+    if scheme not in STATION_SCHEMES or not address:
+        raise ValueError("unknown station URL '%s'" % url)
+
+
+def make_station_sink(url):
+    """
+    Return the sink for a station URL.
+    """
+
+    check_station_url(url)
+    scheme, _, address = url.partition(':')
+    if scheme == 'udp':
+        return DatagramSink(address)
+    if scheme == 'mcast':
+        return DatagramSink(address, multicast=True)
+    # Connecting is left to the station's worker thread
+    if scheme in ('tcp', 'unix'):
+        return socket_sink.SocketSink(url, connect=False)
+    return socket_sink.LegacyPacketSink('tcp:' + address, connect=False)
+
+
+class StationWorker(object):
+    """
+    Queue and thread feeding one station's sink.
+    """
+
+    def __init__(self, name, sink, max_queue=100, poll_interval=0.5, stale='drop', stale_grace=60.0, queue=None):
+        self.name = name
+        self.sink = sink
+        self.poll_interval = poll_interval
+        self._queue = queue
+        if self._queue is None:
+            self._queue = command_queue.CommandQueue(max_size=max_queue, stale=stale, grace=stale_grace)
+        self._ready = threading.Condition()
+        self._closing = False
+
+        self.queued = 0
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.latency_last = 0.0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+        self._thread = threading.Thread(target=self._run, name='station-%s' % name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, command):
+        with self._ready:
+            dropped = self._queue.push(command)
+            self._ready.notify()
+        self.queued += 1
+        if dropped is not None:
+            self.dropped += 1
+            logger.warning("Queue for station %s is full, dropping %s serial# %s", self.name,
+                           dropped['notice_type'], dropped['event_id'])
+
+    def take_queue(self):
+        """
+        Hand over the commands not sent yet, e.g. to the worker replacing
+        this one, leaving this one with an empty queue.
+        """
+
+        with self._ready:
+            queue = self._queue
+            self._queue = command_queue.CommandQueue(max_size=queue.max_size, stale=queue.stale,
+                                                     grace=queue.grace)
+        return queue
+
+    def _get(self, timeout):
+        """
+        Wait up to timeout seconds for the next command.  Returns (time
+        queued, command), () if there is none, or None once closed.
+        """
+
+        with self._ready:
+            if not self._queue and not self._closing:
+                self._ready.wait(timeout)
+            item = self._queue.pop()
+            if item is None:
+                return None if self._closing else ()
+            return item
+
+    def _delivered(self, queued):
+        latency = time.time() - queued
+        self.delivered += 1
+        self.latency_last = latency
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def _run(self):
+        try:
+            self._loop()
+        finally:
+            self.sink.close()
+
+    def _loop(self):
+        waiting = []        # queue times of commands waiting on an acknowledgement
+        acked = getattr(self.sink, 'acked', 0)
+        dropped = getattr(self.sink, 'dropped', 0)
+        # Connect straight away rather than with the first command
+        if hasattr(self.sink, 'poll'):
+            try:
+                self.sink.poll()
+            except Exception as e:
+                logger.warning("Failed to connect to station %s: %s", self.name, str(e))
+        while True:
+            # Check for acknowledgements often while we are expecting them
+            timeout = self.poll_interval
+            if waiting and getattr(self.sink, 'mode', None) == 'connected':
+                timeout = 0.005
+            item = self._get(timeout)
+            if item is None:
+                break
+
+            try:
+                if item:
+                    queued, command = item
+                    size = self.sink.send(command)
+                    if not size:
+                        # Nothing the station understands, e.g. ELWA_READY
+                        # for a legacy receiver, so nothing to acknowledge
+                        self.skipped += 1
+                    elif hasattr(self.sink, 'unacked'):
+                        waiting.append(queued)
+                    else:
+                        self._delivered(queued)
+                elif hasattr(self.sink, 'poll'):
+                    self.sink.poll()
+            except Exception as e:
+                self.failed += 1
+                logger.warning("Failed to send to station %s: %s", self.name, str(e))
+
+            # Sinks with acknowledgements count as delivered once acknowledged
+            if waiting:
+                while dropped < self.sink.dropped and waiting:
+                    dropped += 1
+                    self.failed += 1
+                    waiting.pop(0)
+                while acked < self.sink.acked and waiting:
+                    acked += 1
+                    self._delivered(waiting.pop(0))
+
+    def metrics(self):
+        return {'queued': self.queued,
+                'delivered': self.delivered,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'skipped': self.skipped,
+                'dropped_stale': self._queue.dropped_stale,
+                'backlog': len(self._queue),
+                'latency_last': self.latency_last,
+                'latency_mean': self.latency_total / self.delivered if self.delivered else 0.0,
+                'latency_max': self.latency_max}
+
+    def close(self, timeout=2.0):
+        """
+        Stop the worker, waiting up to timeout seconds for it to send what
+        is queued.  The worker closes the sink itself, so a station that
+        does not answer never holds up the caller for longer than that.
+        """
+
+        with self._ready:
+            self._closing = True
+            self._ready.notify()
+        self._thread.join(timeout)
+
+
+class FanoutSink(object):
+    """
+    Sends each command to a primary sink, e.g. the command file for
+    fcn_server, and queues a copy for every station.  send() can be
+    limited to some of them with targets, a set of station names that
+    includes sinks.DEFAULT_SINK for the primary.
+    """
+
+    def __init__(self, primary, stations, max_queue=100, stale='drop', stale_grace=60.0):
+        self.primary = primary
+        self.max_queue = max_queue
+        self.stale = stale
+        self.stale_grace = stale_grace
+        self.workers = []
+        self.urls = {}
+        for name,url in stations:
+            self.add_station(name, url)
+
+    @property
+    def station_names(self):
+        return [worker.name for worker in self.workers]
+
+    def add_station(self, name, url, queue=None):
+        """
+        Start sending to another station, optionally picking up the queue
+        of commands that an earlier one had not sent yet.
+        """
+
+        if name in self.station_names:
+            raise ValueError("station '%s' already exists" % name)
+        self.workers.append(StationWorker(name, make_station_sink(url), max_queue=self.max_queue,
+                                          stale=self.stale, stale_grace=self.stale_grace, queue=queue))
+        self.urls[name] = url
+
+    def remove_station(self, name):
+        """
+        Stop sending to a station.  Returns its queue of the commands it
+        had not sent yet.
+        """
+
+        worker = [worker for worker in self.workers if worker.name == name][0]
+        self.workers.remove(worker)
+        del self.urls[name]
+        queue = worker.take_queue()
+        worker.close(timeout=0)
+        return queue
+
+    def send(self, command, targets=None):
+        if self.primary is not None and (targets is None or DEFAULT_SINK in targets):
+            size = self.primary.send(command)
+        else:
+            size = len(json_backend.dumps(stamp_command(command)))
+        for worker in self.workers:
+            if targets is None or worker.name in targets:
+                worker.put(dict(command))
+        return size
+
+    def wakeup_fd(self):
+        if hasattr(self.primary, 'wakeup_fd'):
+            return self.primary.wakeup_fd()
+        return None
+
+    def poll(self):
+        if hasattr(self.primary, 'poll'):
+            self.primary.poll()
+
+    def metrics(self):
+        """
+        Return the metrics of the primary sink, if it has any, with the
+        per-station metrics under 'stations'.
+        """
+
+        metrics = {}
+        if hasattr(self.primary, 'metrics'):
+            metrics.update(self.primary.metrics())
+        metrics['stations'] = dict((worker.name, worker.metrics()) for worker in self.workers)
+        return metrics
+
+    def close(self):
+        if self.primary is not None:
+            self.primary.close()
+        for worker in self.workers:
+            worker.close()
+
+
+def parse_station(value):
+    """
+    Parse a NAME=URL station definition from the command line.
+    """
+
+    name, sep, url = value.partition('=')
+    if not sep or not name or not url:
+        raise ValueError("station must be given as NAME=URL, not '%s'" % value)
+    return name, url
+
+
+# Some tests.
+def _test_fanout():
+    """A dead station does not hold up a UDP and a TCP station."""
+
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp.bind(('127.0.0.1', 0))
+    udp.settimeout(5.0)
+    consumer = socket_sink.CommandConsumer('tcp:127.0.0.1:0')
+    dead = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    dead.bind(('127.0.0.1', 0))
+    dead_port = dead.getsockname()[1]
+    dead.close()
+    try:
+        sink = FanoutSink(None, [('lwa1', 'udp:127.0.0.1:%i' % udp.getsockname()[1]),
+                                 ('lwasv', consumer.address),
+                                 ('lwana', 'tcp:127.0.0.1:%i' % dead_port)])
+        t0 = time.time()
+        for i in range(3):
+            sink.send({'notice_type': 'ELWA_SESSION', 'event_id': i, 'event_t': time.time(),
+                       'event_duration': 60})
+        assert time.time() - t0 < 0.5
+        for i in range(3):
+            data, _ = udp.recvfrom(65536)
+            assert json_backend.loads(data.decode('utf-8'))['event_id'] == i
+
+        t0 = time.time()
+        while len(consumer.commands) < 3 and time.time() - t0 < 5:
+            time.sleep(0.01)
+        assert [c['event_id'] for c in consumer.commands] == [0, 1, 2]
+        time.sleep(0.1)
+
+        metrics = sink.metrics()['stations']
+        assert metrics['lwa1']['delivered'] == 3, metrics
+        assert metrics['lwasv']['delivered'] == 3, metrics
+        assert metrics['lwana']['delivered'] == 0, metrics
+
+        # Station sinks are made without connecting, so a host that never
+        # answers cannot hold up the caller; the worker connects
+        for url in (consumer.address, 'legacy:' + consumer.address[4:]):
+            station = make_station_sink(url)
+            assert station.mode == 'disconnected' and station.connects == 0
+            station.close()
+        sink.add_station('late', consumer.address)
+        t0 = time.time()
+        while sink.workers[-1].sink.connects == 0 and time.time() - t0 < 5:
+            time.sleep(0.01)
+        assert sink.workers[-1].sink.mode == 'connected'
+        sink.remove_station('late')
+        sink.close()
+    finally:
+        udp.close()
+        consumer.stop()
+
+
+def _test_legacy_station():
+    """Commands a legacy station skips are not waited on for an acknowledgement."""
+    import legacy_packet
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    def echo():
+        conn, _ = server.accept()
+        while True:
+            data = conn.recv(legacy_packet.PACKET_SIZE)
+            if not data:
+                break
+            conn.sendall(data)
+        conn.close()
+
+    thread = threading.Thread(target=echo)
+    thread.daemon = True
+    thread.start()
+    try:
+        sink = FanoutSink(None, [('lwa1', 'legacy:127.0.0.1:%i' % server.getsockname()[1])])
+        worker = sink.workers[0]
+        t = time.time()
+        sink.send({'notice_type': 'ELWA_READY', 'event_id': 1, 'event_t': t})
+        time.sleep(0.3)
+        sink.send({'notice_type': 'ELWA_SESSION', 'event_id': 2, 'event_t': t, 'event_ra': 53.285,
+                   'event_dec': 54.431, 'event_duration': 300.0})
+        t0 = time.time()
+        while worker.delivered < 1 and time.time() - t0 < 5:
+            time.sleep(0.01)
+        metrics = worker.metrics()
+        assert metrics['delivered'] == 1 and metrics['skipped'] == 1, metrics
+        assert metrics['latency_last'] < 0.2, metrics
+
+        # With nothing left to acknowledge the worker goes back to waiting
+        # poll_interval between wakeups
+        wakeups = []
+        get = worker._get
+        worker._get = lambda timeout: wakeups.append(timeout) or get(timeout)
+        time.sleep(1.0)
+        assert len(wakeups) <= 4, len(wakeups)
+        sink.close()
+        thread.join(5.0)
+    finally:
+        server.close()
@@ -0,0 +1,191 @@
+"""
+Wait for a file to go away without polling for it.
+
+On Linux the directory holding the file is watched with inotify, through
+ctypes so that nothing needs to be installed, for IN_DELETE and
+IN_MOVED_FROM events.  The waiter wakes up as soon as the file is deleted
+or renamed away.  Anywhere inotify is not available it falls back to
+checking for the file every poll_interval seconds.
+"""
+
+import os
+import time
+import errno
+import select
+import logging
+import asyncore
+import ctypes
+import ctypes.util
+
+logger = logging.getLogger(__name__)
+
+"""
+inotify flags from <sys/inotify.h>.
+"""
+IN_MOVED_FROM = 0x00000040
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o0004000
+IN_CLOEXEC = 0o2000000
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        for name in ('inotify_init1', 'inotify_add_watch', 'inotify_rm_watch'):
+            getattr(libc, name)
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc = libc
+    return _libc
+
+
+class RemovalWaiter(object):
+    """
+    Waits for a file to be deleted or moved away.
+    """
+
+    def __init__(self, filename, poll_interval=1.0, use_inotify=True):
+        self.filename = os.path.abspath(filename)
+        self.poll_interval = poll_interval
+
+        self._fd = None
+        self._wd = None
+        if use_inotify:
+            self._watch()
+
+    @property
+    def mode(self):
+        return 'inotify' if self._fd is not None else 'polling'
+
+    def fileno(self):
+        """The inotify file descriptor, or None when polling."""
+
+        return self._fd
+
+    def _watch(self):
+        try:
+            libc = _get_libc()
+        except (OSError, AttributeError) as e:
+            logger.info("inotify is not available (%s), polling for '%s' every %.1f s", str(e),
+                        self.filename, self.poll_interval)
+            return
+
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            logger.warning("inotify_init1 failed (%s), polling for '%s'", os.strerror(ctypes.get_errno()),
+                           self.filename)
+            return
+        dirname = os.path.dirname(self.filename)
+        wd = libc.inotify_add_watch(fd, dirname.encode('utf-8'), IN_DELETE | IN_MOVED_FROM)
+        if wd < 0:
+            logger.warning("Cannot watch '%s' (%s), polling for '%s'", dirname, os.strerror(ctypes.get_errno()),
+                           self.filename)
+            os.close(fd)
+            return
+        self._fd, self._wd = fd, wd
+
+    def _drain(self):
+        # The events themselves do not matter, only that something left
+        # the directory
+        while True:
+            try:
+                if not os.read(self._fd, 4096):
+                    break
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+    def wait(self, timeout=None):
+        """
+        Block until the file does not exist or timeout seconds have passed.
+        Returns True if the file is gone.
+        """
+
+        if not os.path.exists(self.filename):
+            return True
+
+        t0 = time.time()
+        while True:
+            remaining = self.poll_interval
+            if timeout is not None:
+                remaining = t0 + timeout - time.time()
+                if remaining <= 0:
+                    break
+            if self._fd is not None:
+                try:
+                    ready, _, _ = select.select([self._fd], [], [], remaining)
+                except (OSError, select.error) as e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    ready = []
+                if ready:
+                    self._drain()
+            else:
+                time.sleep(min(remaining, self.poll_interval))
+            if not os.path.exists(self.filename):
+                return True
+        return False
+
+    def close(self):
+        if self._fd is not None:
+            try:
+                _get_libc().inotify_rm_watch(self._fd, self._wd)
+            finally:
+                os.close(self._fd)
+            self._fd = self._wd = None
+
+
+class WakeupDispatcher(asyncore.file_dispatcher):
+    """
+    Calls callback() from the asyncore loop whenever the file descriptor
+    of a RemovalWaiter, as given by fileno(), becomes readable.
+    """
+
+    def __init__(self, fd, callback, map=None):
+        asyncore.file_dispatcher.__init__(self, fd, map=map)
+        self.callback = callback
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        # The events themselves do not matter, only that something left
+        # the directory
+        try:
+            while self.recv(4096):
+                pass
+        except (OSError, IOError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        self.callback()
+
+
+# Some tests.
+def _test_removal_waiter():
+    """The file is removed from another thread while we wait on it."""
+    import shutil
+    import tempfile
+    import threading
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'incoming.json')
+        for use_inotify in (True, False):
+            waiter = RemovalWaiter(filename, poll_interval=0.5, use_inotify=use_inotify)
+            assert waiter.wait(0.1)
+            with open(filename, 'w') as fh:
+                fh.write('{}')
+            assert not waiter.wait(0.1)
+            timer = threading.Timer(0.2, os.unlink, args=(filename,))
+            timer.start()
+            t0 = time.time()
+            assert waiter.wait(5.0)
+            if use_inotify:
+                assert waiter.mode == 'inotify'
+                assert time.time() - t0 < 0.3
+            waiter.close()
+    finally:
+        shutil.rmtree(tmpdir)
@@ -49,12 +49,32 @@ MJD_JD2000 = 51544.5
 
 # Current MJD func 2015/02/19 PBD
 import time
+MJD_UNIX_EPOCH = 40587
+NS_IN_DAY = 86400 * 10**9
+
+if hasattr(time, 'time_ns'):
+    _time_ns = time.time_ns
+else:
+    def _time_ns():
+        # Python < 3.7; time.time() is still good to about a microsecond
+        return int(time.time() * 1e9)
+
+
+def mjd_now_dd():
+    """Current MJD as a two-element tuple of (day, fraction of day).
+
+    The day is integral and the fraction is in [0, 1), so the pair keeps
+    the full resolution of the system clock (sub-microsecond) where a
+    single double would only hold about a microsecond at current MJDs.
+    """
+    days, ns = divmod(_time_ns(), NS_IN_DAY)
+    return float(MJD_UNIX_EPOCH + days), ns / float(NS_IN_DAY)
+
+
 def mjd_now():
-    # Note, only good to 1 sec
-    gt = time.gmtime()
-    mjd = gcal2jd(gt.tm_year, gt.tm_mon, gt.tm_mday)[1]
-    mjd += gt.tm_hour/24.0 + gt.tm_min/(24.0*60.0) + gt.tm_sec/(24.0*3600.0)
-    return mjd
+    """Current MJD as a single float."""
+    day, frac = mjd_now_dd()
+    return day + frac
 
 
 def fpart(x):
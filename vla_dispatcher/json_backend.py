@@ -0,0 +1,41 @@
+"""
+JSON serialization through the fastest library available.
+
+orjson is used if it is installed, then ujson, then the standard library
+json module.  All three produce standard JSON, so consumers can read the
+output with whatever they have.
+"""
+
+try:
+    import orjson as _json
+    JSON_backend_name = 'orjson'
+
+    def dumps(obj):
+        return _json.dumps(obj).decode('utf-8')
+
+    loads = _json.loads
+
+except ImportError:
+    try:
+        import ujson as _json
+        JSON_backend_name = 'ujson'
+
+        def dumps(obj):
+            return _json.dumps(obj)
+
+        loads = _json.loads
+
+    except ImportError:
+        import json as _json
+        JSON_backend_name = 'json'
+
+        def dumps(obj):
+            return _json.dumps(obj, separators=(',', ':'))
+
+        loads = _json.loads
+
+
+def dump(obj, fh):
+    """Serialize obj as JSON to the open file fh."""
+
+    fh.write(dumps(obj))
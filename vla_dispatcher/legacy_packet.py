@@ -0,0 +1,252 @@
+"""
+Encoder and decoder for the legacy binary notification packet read by
+client_tools/client_software.py.
+
+A packet is 40 big-endian signed 32-bit integers (160 bytes), laid out
+like a GCN socket packet:
+   0  notification type (see TYPE_NAMES)
+   1  packet serial number
+   2  hop count (always 0)
+   3  time the packet was made, centiseconds of the UTC day
+   4  event number
+   5  event date as a truncated Julian day, MJD - 40000
+   6  event time, centiseconds of the UTC day
+   7  RA in degrees x 10^4
+   8  Dec in degrees x 10^4
+   9  duration in seconds; zero or negative ends a session
+  39  terminator, always 10
+The rest are zero.
+
+Single packets go through struct.  Batches go through a NumPy structured
+array with the same layout when NumPy is available, and through lists of
+dictionaries when it is not.
+"""
+
+import time
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+Packet layout.
+"""
+PACKET_FORMAT = '>40l'
+PACKET_SIZE = struct.calcsize(PACKET_FORMAT)
+PACKET_TERMINATOR = 10
+"""
+Notification types.
+"""
+TYPE_TEST = 2
+TYPE_IAMALIVE = 3
+TYPE_KILL = 4
+TYPE_SESSION = 11
+TYPE_TRIGGER = 12
+TYPE_NAMES = {TYPE_TEST: 'Test',
+              TYPE_IAMALIVE: 'Iamalive',
+              TYPE_KILL: 'Kill',
+              TYPE_SESSION: 'VLA_FRB_SESSION',
+              TYPE_TRIGGER: 'VLA_FRB_TRIGGER'}
+"""
+Offset between MJD and the truncated Julian day used in the packet.
+"""
+TJD_OFFSET = 40000
+"""
+MJD of the UNIX epoch.
+"""
+MJD_UNIX_EPOCH = 40587
+"""
+Scale of the RA and Dec fields.
+"""
+RADEC_SCALE = 1e4
+"""
+Centiseconds in a day.
+"""
+CS_IN_DAY = 8640000
+
+if numpy is not None:
+    PACKET_DTYPE = numpy.dtype([('type', '>i4'), ('serial', '>i4'), ('hop_count', '>i4'),
+                                ('pkt_sod', '>i4'), ('event', '>i4'), ('tjd', '>i4'), ('sod', '>i4'),
+                                ('ra', '>i4'), ('dec', '>i4'), ('duration', '>i4'), ('spare', '>i4', (29,)),
+                                ('terminator', '>i4')])
+else:
+    PACKET_DTYPE = None
+
+
+def unix_to_tjd_sod(unix_time):
+    """
+    Convert a UNIX time into a (truncated Julian day, centiseconds of the
+    day) tuple.
+    """
+
+    day, sod = divmod(int(round(unix_time*100)), CS_IN_DAY)
+    return day + MJD_UNIX_EPOCH - TJD_OFFSET, sod
+
+
+def tjd_sod_to_unix(tjd, sod):
+    """
+    Convert a truncated Julian day and centiseconds of the day into a UNIX
+    time.
+    """
+
+    return (tjd + TJD_OFFSET - MJD_UNIX_EPOCH)*86400.0 + sod/100.0
+
+
+def encode_packet(notify_type, serial, event, unix_time, ra, dec, duration, now=None):
+    """
+    Build a single packet.  ra and dec are in degrees and duration in
+    seconds.
+    """
+
+    if now is None:
+        now = time.time()
+    tjd, sod = unix_to_tjd_sod(unix_time)
+    fields = [0]*40
+    fields[0] = notify_type
+    fields[1] = serial
+    fields[3] = unix_to_tjd_sod(now)[1]
+    fields[4] = event
+    fields[5] = tjd
+    fields[6] = sod
+    fields[7] = int(round(ra*RADEC_SCALE))
+    fields[8] = int(round(dec*RADEC_SCALE))
+    fields[9] = int(round(duration))
+    fields[39] = PACKET_TERMINATOR
+    return struct.pack(PACKET_FORMAT, *fields)
+
+
+def decode_packet(data):
+    """
+    Unpack a single packet into a dictionary with the keys 'type',
+    'type_name', 'serial', 'event', 'event_t' (UNIX time), 'ra' and 'dec'
+    (degrees), 'duration' (seconds) and 'valid', which is False if the
+    terminator is wrong.
+    """
+
+    fields = struct.unpack(PACKET_FORMAT, data[:PACKET_SIZE])
+    return {'type': fields[0],
+            'type_name': TYPE_NAMES.get(fields[0], 'Unknown'),
+            'serial': fields[1],
+            'event': fields[4],
+            'event_t': tjd_sod_to_unix(fields[5], fields[6]),
+            'ra': fields[7] / RADEC_SCALE,
+            'dec': fields[8] / RADEC_SCALE,
+            'duration': fields[9],
+            'valid': fields[39] == PACKET_TERMINATOR}
+
+
+def encode_packets(notify_type, serial, event, unix_time, ra, dec, duration, now=None):
+    """
+    Build a batch of packets from equal length sequences (scalars are
+    broadcast) and return them concatenated.
+    """
+
+    if now is None:
+        now = time.time()
+    if numpy is None:
+        columns = [notify_type, serial, event, unix_time, ra, dec, duration]
+        count = max(len(c) if hasattr(c, '__len__') else 1 for c in columns)
+        columns = [c if hasattr(c, '__len__') else [c]*count for c in columns]
+        return b''.join(encode_packet(*(list(row) + [now])) for row in zip(*columns))
+
+    unix_time = numpy.asarray(unix_time, dtype=numpy.float64)
+    count = numpy.broadcast(notify_type, serial, event, unix_time, ra, dec, duration).size
+    packets = numpy.zeros(count, dtype=PACKET_DTYPE)
+    centisec = numpy.round(unix_time*100).astype(numpy.int64)
+    packets['type'] = notify_type
+    packets['serial'] = serial
+    packets['pkt_sod'] = unix_to_tjd_sod(now)[1]
+    packets['event'] = event
+    packets['tjd'] = centisec // CS_IN_DAY + (MJD_UNIX_EPOCH - TJD_OFFSET)
+    packets['sod'] = centisec % CS_IN_DAY
+    packets['ra'] = numpy.round(numpy.asarray(ra)*RADEC_SCALE)
+    packets['dec'] = numpy.round(numpy.asarray(dec)*RADEC_SCALE)
+    packets['duration'] = numpy.round(duration)
+    packets['terminator'] = PACKET_TERMINATOR
+    return packets.tobytes()
+
+
+def decode_packets(data):
+    """
+    Unpack a batch of concatenated packets.  Returns a NumPy structured
+    array with the PACKET_DTYPE fields if NumPy is available and a list
+    of decode_packet() dictionaries if not.  Use packet_times() to get
+    UNIX times from the array.
+    """
+
+    count = len(data) // PACKET_SIZE
+    if numpy is None:
+        return [decode_packet(data[i*PACKET_SIZE:(i+1)*PACKET_SIZE]) for i in range(count)]
+    return numpy.frombuffer(data[:count*PACKET_SIZE], dtype=PACKET_DTYPE)
+
+
+def packet_times(packets):
+    """Return the event UNIX times of a decode_packets() array."""
+
+    return (packets['tjd'].astype(numpy.float64) + TJD_OFFSET - MJD_UNIX_EPOCH)*86400.0 + packets['sod']/100.0
+
+
+"""
+How the dispatcher notices map onto the legacy packet.  A session is
+started with a positive duration and ended with a zero one using the same
+event number.  ELWA_READY and ELWA_REMINDER have no legacy equivalent and
+are not sent.
+"""
+NOTICE_TYPES = {'ELWA_SESSION': TYPE_SESSION,
+                'ELWA_UPDATE': TYPE_SESSION,
+                'ELWA_CANCEL': TYPE_SESSION,
+                'ELWA_SCAN_END': TYPE_SESSION,
+                'ELWA_DONE': TYPE_SESSION}
+
+
+def command_to_packet(command, serial, now=None):
+    """
+    Build the packet for a dispatcher command, or return None if it has no
+    legacy equivalent.
+    """
+
+    notify_type = NOTICE_TYPES.get(command['notice_type'])
+    if notify_type is None:
+        return None
+    duration = command['event_duration']
+    if command['notice_type'] in ('ELWA_CANCEL', 'ELWA_SCAN_END', 'ELWA_DONE') or duration < 0:
+        duration = 0
+    return encode_packet(notify_type, serial, command['event_id'], command['event_t'],
+                         command['event_ra'], command['event_dec'], duration, now=now)
+
+
+# Some tests.
+def _test_legacy_packet():
+    """Round trips through the single and batch paths."""
+
+    t = 1677327264.37
+    data = encode_packet(TYPE_SESSION, 7, 2251530, t, 53.2851, 54.431, 834.2)
+    assert len(data) == PACKET_SIZE == 160
+    packet = decode_packet(data)
+    assert packet['type_name'] == 'VLA_FRB_SESSION' and packet['valid']
+    assert packet['serial'] == 7 and packet['event'] == 2251530
+    assert abs(packet['event_t'] - t) < 0.006, packet['event_t']
+    assert packet['ra'] == 53.2851 and packet['dec'] == 54.431 and packet['duration'] == 834
+
+    # The same fields client_software.py reads
+    fields = struct.unpack(PACKET_FORMAT, data)
+    assert fields[5] == int(t // 86400) + MJD_UNIX_EPOCH - TJD_OFFSET and fields[39] == 10
+
+    batch = encode_packets(TYPE_SESSION, [1, 2, 3], 2251530, [t, t+60, t+86400], 10.0, -5.5, [60, 0, -1], now=t)
+    assert batch[:PACKET_SIZE] == encode_packet(TYPE_SESSION, 1, 2251530, t, 10.0, -5.5, 60, now=t)
+    packets = decode_packets(batch)
+    assert len(packets) == 3
+    if numpy is not None:
+        assert list(packets['serial']) == [1, 2, 3]
+        assert numpy.allclose(packet_times(packets), [t, t+60, t+86400], atol=0.006)
+        assert list(packets['duration']) == [60, 0, -1]
+    for i in range(3):
+        single = decode_packet(batch[i*PACKET_SIZE:(i+1)*PACKET_SIZE])
+        assert single['serial'] == i + 1 and single['valid'] and single['dec'] == -5.5
+
+    assert command_to_packet({'notice_type': 'ELWA_READY'}, 1) is None
+    done = decode_packet(command_to_packet({'notice_type': 'ELWA_DONE', 'event_id': 5, 'event_t': t,
+                                            'event_ra': -1, 'event_dec': -1, 'event_duration': -1}, 2))
+    assert done['duration'] == 0 and done['ra'] == -1.0
@@ -1,11 +1,18 @@
 import os
+import ast
 import struct
 import logging
 import asyncore, socket
 import obsdocxml_parser
-import ast
 import angles
-from jdcal import mjd_now
+import ephemeris
+import evla_config
+from jdcal import mjd_now_dd
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +29,59 @@ SECS_IN_DAY = 86400.0
 Offset in days between standary Julian day and modified Julian day.
 """
 MJD_OFFSET = 2400000.5
+"""
+VCI baseBand.swbbName prefixes that do not match the OBS sslo.IFid
+"""
+SWBB_TO_IFID = {'A1C1': 'AC1',
+                'A2C2': 'AC2',
+                'B1D1': 'BD1',
+                'B2D2': 'BD2'}
+"""
+Backslash escapes understood in quoted intent values; values with any
+other escape (\\x41, \\u00e9, \\101, ...) go to ast.literal_eval
+"""
+INTENT_ESCAPES = {'\\': '\\', "'": "'", '"': '"', 'n': '\n', 'r': '\r', 't': '\t', '0': '\0'}
+
+def unquote_intent(value):
+        """
+        Strip the matching quotes from a quoted intent value and resolve
+        any backslash escapes in it, giving the same result as
+        ast.literal_eval.
+        Param: value - The quoted value, including the quotes (str).
+        Returns: The unquoted string
+        """
+        quote = value[0]
+        if len(value) < 2 or value[-1] != quote:
+            raise ValueError("Unterminated quoted intent value: %s" % value)
+        body = value[1:-1]
+        if '\\' not in body:
+            if quote in body:
+                raise ValueError("Unescaped quote in intent value: %s" % value)
+            return body
+
+        chars = []
+        i, n = 0, len(body)
+        while i < n:
+            c = body[i]
+            if c == '\\':
+                if i + 1 == n:
+                    # The closing quote was escaped
+                    raise ValueError("Unterminated quoted intent value: %s" % value)
+                e = body[i+1]
+                if e not in INTENT_ESCAPES or (e == '0' and body[i+2:i+3].isdigit()):
+                    # Rare escapes are left to the real thing
+                    try:
+                        return ast.literal_eval(value)
+                    except SyntaxError as err:
+                        raise ValueError("Bad quoted intent value %s: %s" % (value, err))
+                chars.append(INTENT_ESCAPES[e])
+                i += 2
+            elif c == quote:
+                raise ValueError("Unescaped quote in intent value: %s" % value)
+            else:
+                chars.append(c)
+                i += 1
+        return ''.join(chars)
 def utcjd_to_unix(utcJD):
         """
         Get UNIX time value for a given UTC JD value.
@@ -35,9 +95,10 @@ def utcjd_to_unix(utcJD):
 class McastClient(asyncore.dispatcher):
     """Generic class to receive the multicast XML docs."""
 
-    def __init__(self, group, port, name=""):
+    def __init__(self, group, port, name="", quarantine=None):
         asyncore.dispatcher.__init__(self)
         self.name = name
+        self.quarantine = quarantine
         self.group = group
         self.port = port
         addrinfo = socket.getaddrinfo(group, None)[0]
@@ -63,6 +124,8 @@ class McastClient(asyncore.dispatcher):
 
     def handle_read(self):
         self.read = self.recv(100000)
+        if self.quarantine is not None and self.quarantine.is_known_bad(self.read):
+            return
         logger.debug('read ' + self.name + ' ' + self.read)
         try:
             self.parse()
@@ -80,14 +143,23 @@ class ObsdocClient(McastClient):
     controller.add_obsdoc(obsdoc) method will be called for every
     document received. Controller is defined as a class in the main
     controller script, and runs job launching.
+
+    If a quarantine.ParseQuarantine is given, documents that fail to
+    parse are handed to it instead of being logged with a traceback.
     """
 
-    def __init__(self,controller=None):
-        McastClient.__init__(self,'239.192.3.2',53001,'obsdoc')
+    def __init__(self,controller=None,quarantine=None):
+        McastClient.__init__(self,'239.192.3.2',53001,'obsdoc',quarantine=quarantine)
         self.controller = controller
 
     def parse(self):
-        obsdoc = obsdocxml_parser.parseString(self.read)
+        try:
+            obsdoc = obsdocxml_parser.parseString(self.read)
+        except Exception as e:
+            if self.quarantine is None:
+                raise
+            self.quarantine.record_failure(self.read, e, self.name)
+            return
         logger.info("Read obsdoc for project %s scan %s subscan %s." % (obsdoc.datasetID,str(obsdoc.scanNo),str(obsdoc.subscanNo)))
         if self.controller is not None:
             self.controller.add_obsdoc(obsdoc)
@@ -102,6 +174,17 @@ class MCAST_Config(object):
     SPWs, antenna config, and so forth).
     """
 
+    # Everything is computed once in set_obsdoc(); treat instances as
+    # read-only records and call set_obsdoc() to load a new document.
+    __slots__ = ('obsdoc', 'intents', 'ephemeris',
+                 'projectID', 'subarrayId', 'scan', 'subscan', 'intentString', 'Id',
+                 'datasetId', 'observer', 'projid', 'scan_intent', 'source',
+                 'ra_rad', 'dec_rad', 'ra_deg', 'ra_hrs', 'dec_deg',
+                 'startLST', 'startTime', 'startTime_unix', 'seq',
+                 'sslo_index', '_ra_str', '_dec_str', '_spectral_setup')
+
+    telescope = "VLA"
+
     def __init__(self, obsdoc=None):
         self.set_obsdoc(obsdoc)
 
@@ -110,51 +193,98 @@ class MCAST_Config(object):
 
     def set_obsdoc(self,obsdoc):
         self.obsdoc = obsdoc
+        self._ra_str = None
+        self._dec_str = None
+        self._spectral_setup = None
+        self.sslo_index = {}
         if self.obsdoc is None:
             self.intents = {}
+            self.ephemeris = None
+            self.projectID = self.subarrayId = self.scan = self.subscan = None
+            self.intentString = self.Id = self.datasetId = None
+            self.source = self.seq = self.startLST = None
+            self.ra_rad = self.dec_rad = None
+            self.ra_deg = self.ra_hrs = self.dec_deg = None
+            self.startTime = 0.0
         else:
             self.intents = self.parse_intents(obsdoc.intent)        
+            self.ephemeris = ephemeris.Ephemeris.from_obsdoc(obsdoc)
 
-    # July 2015:
-    # Rich will soon switch from datasetID to datasetId. This takes
-    # into account both possibilities
-    @property
-    def projectID(self):
-        if self.obsdoc.datasetId is not None:
-            return self.obsdoc.datasetId
-        else:
-            return self.obsdoc.datasetID
-
-    @property
-    def telescope(self):
-        return "VLA"
-
-    @property
-    def scan(self):
-        return self.obsdoc.scanNo
+            # July 2015:
+            # Rich will soon switch from datasetID to datasetId. This takes
+            # into account both possibilities
+            if obsdoc.datasetId is not None:
+                self.projectID = obsdoc.datasetId
+            else:
+                self.projectID = obsdoc.datasetID
+
+            self.subarrayId = obsdoc.subarrayId
+            self.scan = obsdoc.scanNo
+            self.subscan = obsdoc.subscanNo
+            self.intentString = obsdoc.intent
+            self.Id = obsdoc.configId
+            self.datasetId = obsdoc.datasetId
+            self.source = obsdoc.name
+            self.seq = obsdoc.seq
+            self.startLST = obsdoc.startLST * 86400.0 if obsdoc.startLST is not None else None
+
+            # IFid -> sslo, keeping the first entry if an IFid is repeated
+            for sslo in obsdoc.sslo:
+                self.sslo_index.setdefault(sslo.IFid, sslo)
+
+            try:
+                self.startTime = float(obsdoc.startTime)
+            except (AttributeError, TypeError):
+                self.startTime = 0.0
+
+            # Moving targets are evaluated from the ephemeris at the scan start
+            if self.ephemeris is not None and self.startTime != 0.0:
+                self.ra_rad = self.ephemeris.ra(self.startTime)
+                self.dec_rad = self.ephemeris.dec(self.startTime)
+            else:
+                self.ra_rad = obsdoc.ra
+                self.dec_rad = obsdoc.dec
+            if self.ra_rad is not None:
+                self.ra_deg = angles.r2d(self.ra_rad)
+                self.ra_hrs = angles.r2h(self.ra_rad)
+            else:
+                self.ra_deg = self.ra_hrs = None
+            self.dec_deg = angles.r2d(self.dec_rad) if self.dec_rad is not None else None
 
-    @property
-    def subscan(self):
-        return self.obsdoc.subscanNo
-
-    @property
-    def intentString(self):
-        return self.obsdoc.intent
+        self.startTime_unix = utcjd_to_unix(self.startTime + MJD_OFFSET)
+        self.observer = self.get_intent("ObserverName","Unknown")
+        self.projid = self.get_intent("ProjectID","Unknown")
+        self.scan_intent = self.get_intent("ScanIntent","None")
 
 
 
 #-------------
+    # Parsed intents keyed on the tuple of raw intent strings.  These
+    # rarely change within an SB so the cache stays small; it is simply
+    # emptied if it ever grows past _intent_cache_size.
+    _intent_cache = {}
+    _intent_cache_size = 256
+
     @staticmethod
     def parse_intents(intents):
+        key = tuple(intents)
+        try:
+            return dict(MCAST_Config._intent_cache[key])
+        except KeyError:
+            pass
+
         d = {}
         for item in intents:
-            k, v = item.split("=")
-            if v[0] is "'" or v[0] is '"':
-                d[k] = ast.literal_eval(v)
-                # Or maybe we should just strip quotes?
+            k, v = item.split("=", 1)
+            if v[:1] in ("'", '"'):
+                d[k] = unquote_intent(v)
             else:
                 d[k] = v
-        return d
+
+        if len(MCAST_Config._intent_cache) >= MCAST_Config._intent_cache_size:
+            MCAST_Config._intent_cache.clear()
+        MCAST_Config._intent_cache[key] = d
+        return dict(d)
 
     
     def get_intent(self,key,default=None):
@@ -164,98 +294,135 @@ class MCAST_Config(object):
             return default
 
     @property
-    def Id(self):
-        return self.obsdoc.configId
-
-    @property
-    def datasetId(self):
-        return self.obsdoc.datasetId
-    @property
-    def observer(self):
-        return self.get_intent("ObserverName","Unknown")
-
-    @property
-    def projid(self):
-        return self.get_intent("ProjectID","Unknown")
-
-    @property
-    def scan_intent(self):
-        return self.get_intent("ScanIntent","None")
-
-    @property
-    def source(self):
-        return self.obsdoc.name
-
-    @property
-    def ra_deg(self):
-        return angles.r2d(self.obsdoc.ra)
-
-    @property
-    def ra_hrs(self):
-        return angles.r2h(self.obsdoc.ra)
+    def is_moving(self):
+        return self.ephemeris is not None
 
+    # The sexagesimal strings are only needed for logging so they are
+    # formatted on first use and kept
     @property
     def ra_str(self):
-        return angles.fmt_angle(self.ra_hrs, ":", ":").lstrip('+-').rstrip()
-
-    @property
-    def dec_deg(self):
-        return angles.r2d(self.obsdoc.dec)
+        if self._ra_str is None:
+            self._ra_str = angles.fmt_angle(self.ra_hrs, ":", ":").lstrip('+-').rstrip()
+        return self._ra_str
 
     @property
     def dec_str(self):
-        return angles.fmt_angle(self.dec_deg, ":", ":").rstrip()
-
-    @property
-    def startLST(self):
-        return self.obsdoc.startLST * 86400.0
-
-    @property
-    def startTime(self):
-        try:
-            return float(self.obsdoc.startTime)
-        except AttributeError:
-            return 0.0
-            
-    @property
-    def startTime_unix(self):
-        return utcjd_to_unix(self.startTime + MJD_OFFSET)
+        if self._dec_str is None:
+            self._dec_str = angles.fmt_angle(self.dec_deg, ":", ":").rstrip()
+        return self._dec_str
         
     @property
     def wait_time_sec(self):
         if self.startTime==0.0:
             return None
         else:
-            return 86400.0*(self.startTime - mjd_now())
-
-    @property
-    def seq(self):
-        return self.obsdoc.seq
+            # Subtract the whole days first so that the fraction of the day
+            # keeps its precision
+            day, frac = mjd_now_dd()
+            return 86400.0*((self.startTime - day) - frac)
+
+    def to_dict(self):
+        """Return the scan metadata, derived values as well as the full
+        obsdoc, as a dictionary of plain Python types ready for JSON."""
+        return {'projectID':      self.projectID,
+                'subarrayId':     self.subarrayId,
+                'scan':           self.scan,
+                'subscan':        self.subscan,
+                'source':         self.source,
+                'scan_intent':    self.scan_intent,
+                'intents':        dict(self.intents),
+                'configId':       self.Id,
+                'configUrl':      self.obsdoc.configUrl,
+                'ra_deg':         self.ra_deg,
+                'dec_deg':        self.dec_deg,
+                'ra_str':         self.ra_str,
+                'dec_str':        self.dec_str,
+                'is_moving':      self.is_moving,
+                'startTime':      self.startTime,
+                'startTime_unix': self.startTime_unix,
+                'obsdoc':         self.obsdoc.to_dict()}
+
+    def position_at(self, mjd):
+        """Return the (RA, Dec) in degrees at the given MJD(s).  Static
+        targets return their fixed position."""
+        if self.ephemeris is None:
+            return self.ra_deg, self.dec_deg
+        ra, dec = self.ephemeris.position(mjd)
+        return ephemeris.to_degrees(ra), ephemeris.to_degrees(dec)
+
+    def track(self, duration_sec, step_sec=10.0):
+        """Sample the position every step_sec seconds over duration_sec
+        seconds from the scan start.  Returns a three-element tuple of MJD,
+        RA (degrees) and Dec (degrees)."""
+        if self.ephemeris is None:
+            return [self.startTime], [self.ra_deg], [self.dec_deg]
+        mjd, ra, dec = self.ephemeris.track(self.startTime, duration_sec, step_sec)
+        return mjd, ephemeris.to_degrees(ra), ephemeris.to_degrees(dec)
 
     def get_sslo(self,IFid):
         """Return the SSLO frequency in MHz for the given IFid.  This will
         correspond to the edge of the baseband.  Uses IFid naming convention 
         as in OBS XML."""
-        for sslo in self.obsdoc.sslo:
-            if sslo.IFid == IFid:
-                return sslo.freq # These are in MHz
-        return None
+        try:
+            return self.sslo_index[IFid].freq # These are in MHz
+        except KeyError:
+            return None
 
     def get_sideband(self,IFid):
         """Return the sideband sense (int; +1 or -1) for the given IFid.
         Uses IFid naming convention as in OBS XML."""
-        for sslo in self.obsdoc.sslo:
-            if sslo.IFid == IFid:
-                return sslo.Sideband # 1 or -1
-        return None
+        try:
+            return self.sslo_index[IFid].Sideband # 1 or -1
+        except KeyError:
+            return None
 
     def get_receiver(self,IFid):
         """Return the receiver name for the given IFid.
         Uses IFid naming convention as in OBS XML."""
-        for sslo in self.obsdoc.sslo:
-            if sslo.IFid == IFid:
-                return sslo.Receiver
-        return None
+        try:
+            return self.sslo_index[IFid].Receiver
+        except KeyError:
+            return None
+
+    def get_sslo_for_swbbName(self,swbbName):
+        """Return the sslo entry that matches the given VCI
+        baseBand.swbbName, or None if there is none."""
+        return self.sslo_index.get(self.swbbName_to_IFid(swbbName))
+
+    @property
+    def spectral_setup(self):
+        """Columnar view of the spectral setup with one entry per sslo:
+        a dictionary of 'IFid', 'freq' (MHz), 'sideband' (0 where the
+        obsdoc does not give it) and 'receiver'.  The columns are NumPy
+        arrays if NumPy is available, lists if not.  Built on first use."""
+        if self._spectral_setup is None:
+            ssloes = self.obsdoc.sslo if self.obsdoc is not None else []
+            columns = {'IFid':     [sslo.IFid for sslo in ssloes],
+                       'freq':     [sslo.freq for sslo in ssloes],
+                       'sideband': [0 if sslo.Sideband is None else sslo.Sideband for sslo in ssloes],
+                       'receiver': [sslo.Receiver for sslo in ssloes]}
+            if numpy is not None:
+                columns['IFid'] = numpy.array(columns['IFid'], dtype=str)
+                columns['freq'] = numpy.array(columns['freq'], dtype=numpy.float64)
+                columns['sideband'] = numpy.array(columns['sideband'], dtype=numpy.int8)
+                columns['receiver'] = numpy.array(columns['receiver'], dtype=str)
+            self._spectral_setup = columns
+        return self._spectral_setup
+
+    def baseband_edges(self,bandwidth):
+        """Return the sky frequency range (low, high) in MHz of each
+        baseband for a baseband width of bandwidth MHz, in the order of
+        spectral_setup.  The SSLO frequency is one edge of the baseband
+        and the sideband gives the direction to the other edge, upwards
+        if it is not known."""
+        setup = self.spectral_setup
+        return evla_config.baseband_edges(setup['freq'], setup['sideband'], bandwidth)
+
+    def full_config(self,vci=None):
+        """Return the evla_config.EVLAConfig model of this scan, with the
+        spectral windows filled in from the VCI document if one is given
+        (as a string, open file or parsed with evla_config.parse_vci)."""
+        return evla_config.EVLAConfig(self, vci)
 
     @staticmethod
     def swbbName_to_IFid(swbbName):
@@ -265,19 +432,90 @@ class MCAST_Config(object):
         swbbNames are like AC_8BIT, A1C1_3BIT, etc.
         IFids are like AC, AC1, etc."""
 
-        conversions = {
-                'A1C1': 'AC1',
-                'A2C2': 'AC2',
-                'B1D1': 'BD1',
-                'B2D2': 'BD2'
-                }
+        bbname = swbbName.split('_', 1)[0]
+        return SWBB_TO_IFID.get(bbname, bbname)
 
-        (bbname, bits) = swbbName.split('_')
 
-        if bbname in conversions:
-            return conversions[bbname]
-
-        return bbname
+# Some tests.
+def _parse_intents_literal_eval(intents):
+    """The original ast.literal_eval based intent parser, kept as a
+    reference for the tests below."""
+    import ast
+    d = {}
+    for item in intents:
+        k, v = item.split("=", 1)
+        if v[:1] in ("'", '"'):
+            d[k] = ast.literal_eval(v)
+        else:
+            d[k] = v
+    return d
+
+
+def _test_parse_intents():
+    """Check parse_intents against ast.literal_eval."""
+    MCAST_Config._intent_cache.clear()
+    cases = [["ScanIntent='OBSERVE_PULSAR_RAW'"],
+             ['ScanIntent="OBSERVE_TARGET"', "ProjectID='23A-123'"],
+             ["SubscanIntent=UNSPECIFIED", "Empty=''", 'Empty2=""'],
+             ["ObserverName='Jane O\\'Doe'", 'Note="say \\"hi\\""'],
+             ["Path='C:\\\\data\\\\new'", "Tab='a\\tb'", "Line='a\\nb'"],
+             ["Mixed='it\"s'", 'Mixed2="it\'s"'],
+             ["Equation='a=b'", "Bare=x=y"],
+             ["Other='\\q'"],
+             ["Hex='\\x41'", "Unicode='\\u00e9'", "Octal='\\101\\012'", "Bell='a\\ab'",
+              "Mixed='O\\'Doe \\x41'"]]
+    for intents in cases:
+        expected = _parse_intents_literal_eval(intents)
+        assert MCAST_Config.parse_intents(intents) == expected, intents
+        # Second call comes from the cache and must match too
+        assert MCAST_Config.parse_intents(intents) == expected, intents
+
+    for bad in (["Bad='abc"], ["Bad='abc\\'"], ["Bad='a'b'"], ["Bad='"]):
+        try:
+            MCAST_Config.parse_intents(bad)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("%s should not parse" % bad)
+
+    # Callers get their own copy of the cached result
+    d = MCAST_Config.parse_intents(cases[0])
+    d['ScanIntent'] = 'changed'
+    assert MCAST_Config.parse_intents(cases[0])['ScanIntent'] == 'OBSERVE_PULSAR_RAW'
+
+
+def _test_spectral_setup():
+    """Baseband edges agree with evla_config and tolerate a missing sideband."""
+    obs = obsdocxml_parser.Observation(
+        subarrayId='1', configId='TEST.sb1.eb1.60000.0_0001', datasetId='TEST.sb1.eb1.60000.0',
+        startTime=60000.0, intent=["ScanIntent='OBSERVE_TARGET'", "ProjectID='TEST'"], scanNo=1,
+        sslo=[obsdocxml_parser.ssloType(IFid='AC', Sideband=1, Receiver='L', freq=1000.0),
+              obsdocxml_parser.ssloType(IFid='BD', Sideband=-1, Receiver='L', freq=2000.0),
+              obsdocxml_parser.ssloType(IFid='A1C1', Receiver='L', freq=3000.0)])
+    config = MCAST_Config(obs)
+    assert list(config.spectral_setup['sideband']) == [1, -1, 0]
+    low, high = config.baseband_edges(1024.0)
+    assert list(low) == [1000.0, 976.0, 3000.0] and list(high) == [2024.0, 2000.0, 4024.0]
+    full = config.full_config()
+    assert list(full.bb_freq_lo) == list(low) and list(full.bb_freq_hi) == list(high)
+
+
+def _bench_parse_intents(n=20000):
+    """Time parse_intents, with and without its cache, against the
+    ast.literal_eval implementation."""
+    import timeit
+    intents = ["ScanIntent='OBSERVE_PULSAR_RAW'", "ProjectID='23A-123'",
+               "ObserverName='Jane Doe'", "SubscanIntent=UNSPECIFIED"]
+
+    def uncached():
+        MCAST_Config._intent_cache.clear()
+        MCAST_Config.parse_intents(intents)
+
+    for label,func in (('ast.literal_eval', lambda: _parse_intents_literal_eval(intents)),
+                       ('tokenizer', uncached),
+                       ('tokenizer+cache', lambda: MCAST_Config.parse_intents(intents))):
+        t = min(timeit.repeat(func, number=n, repeat=3)) / n
+        print("%-18s %8.2f us per call" % (label, t*1e6))
 
 
 # This is how comms would be used in a program.  Note that no controller
@@ -9,58 +9,114 @@ import sys
 import getopt
 import re as re_
 
+import os
+import time
+
 etree_ = None
 Verbose_import_ = False
 (   XMLParser_import_none, XMLParser_import_lxml,
     XMLParser_import_elementtree
     ) = range(3)
 XMLParser_import_library = None
-try:
-    # lxml
-    from lxml import etree as etree_
-    XMLParser_import_library = XMLParser_import_lxml
-    if Verbose_import_:
-        print("running with lxml.etree")
-except ImportError:
-    try:
-        # cElementTree from Python 2.5+
-        import xml.etree.cElementTree as etree_
-        XMLParser_import_library = XMLParser_import_elementtree
-        if Verbose_import_:
-            print("running with cElementTree on Python 2.5+")
-    except ImportError:
+XMLParser_backend_name = None
+XMLParser_cache_ = None
+
+#
+# XML backends in order of preference for 'auto'.  Each entry is the
+# backend name, the module to import and the parser family it belongs to.
+#
+XML_backends_ = (
+    ('lxml', 'lxml.etree', XMLParser_import_lxml),
+    ('cElementTree', 'xml.etree.cElementTree', XMLParser_import_elementtree),
+    ('ElementTree', 'xml.etree.ElementTree', XMLParser_import_elementtree),
+    ('cElementTree', 'cElementTree', XMLParser_import_elementtree),
+    ('ElementTree', 'elementtree.ElementTree', XMLParser_import_elementtree),
+    )
+XML_backend_names = ('auto', 'lxml', 'cElementTree', 'ElementTree')
+XML_backend_env_ = 'VLA_DISPATCHER_XML_BACKEND'
+
+def select_xml_backend(name=None):
+    """
+    Select the XML library used for parsing.  name is one of 'auto',
+    'lxml', 'cElementTree' or 'ElementTree'; if it is None the value of
+    the VLA_DISPATCHER_XML_BACKEND environment variable is used, falling
+    back to 'auto'.  'auto' picks the fastest library that imports.
+    Returns the name of the backend selected.
+    """
+    global etree_, XMLParser_import_library, XMLParser_backend_name, XMLParser_cache_
+    if name is None:
+        name = os.environ.get(XML_backend_env_, 'auto')
+    if name not in XML_backend_names:
+        raise ValueError("Unknown XML backend '%s', expected one of %s" % (name, ', '.join(XML_backend_names)))
+    for backend, modname, library in XML_backends_:
+        if name != 'auto' and backend != name:
+            continue
         try:
-            # ElementTree from Python 2.5+
-            import xml.etree.ElementTree as etree_
-            XMLParser_import_library = XMLParser_import_elementtree
-            if Verbose_import_:
-                print("running with ElementTree on Python 2.5+")
+            module = __import__(modname, fromlist=['parse'])
         except ImportError:
-            try:
-                # normal cElementTree install
-                import cElementTree as etree_
-                XMLParser_import_library = XMLParser_import_elementtree
-                if Verbose_import_:
-                    print("running with cElementTree")
-            except ImportError:
-                try:
-                    # normal ElementTree install
-                    import elementtree.ElementTree as etree_
-                    XMLParser_import_library = XMLParser_import_elementtree
-                    if Verbose_import_:
-                        print("running with ElementTree")
-                except ImportError:
-                    raise ImportError("Failed to import ElementTree from any known place")
+            continue
+        etree_ = module
+        XMLParser_import_library = library
+        XMLParser_backend_name = backend
+        XMLParser_cache_ = None
+        if Verbose_import_:
+            print("running with %s" % modname)
+        return backend
+    raise ImportError("Failed to import XML backend '%s' from any known place" % name)
+
+select_xml_backend()
+
+def get_xml_parser_():
+    """
+    Return the parser object to hand to etree_.  lxml parsers can be
+    reused so one is built per backend selection; ElementTree parsers are
+    single use and None lets the library make its own.
+    """
+    global XMLParser_cache_
+    if XMLParser_import_library == XMLParser_import_lxml:
+        if XMLParser_cache_ is None:
+            # Use the lxml ElementTree compatible parser so that, e.g.,
+            #   we ignore comments.
+            XMLParser_cache_ = etree_.ETCompatXMLParser()
+        return XMLParser_cache_
+    return None
 
 def parsexml_(*args, **kwargs):
-    if (XMLParser_import_library == XMLParser_import_lxml and
-        'parser' not in kwargs):
-        # Use the lxml ElementTree compatible parser so that, e.g.,
-        #   we ignore comments.
-        kwargs['parser'] = etree_.ETCompatXMLParser()
+    if 'parser' not in kwargs:
+        parser = get_xml_parser_()
+        if parser is not None:
+            kwargs['parser'] = parser
     doc = etree_.parse(*args, **kwargs)
     return doc
 
+def parsexmlstring_(inString):
+    parser = get_xml_parser_()
+    if parser is not None:
+        return etree_.fromstring(inString, parser)
+    return etree_.fromstring(inString)
+
+def benchmark_xml_backend(inString=None, repeat=200):
+    """
+    Return the mean wall time in seconds that parseString() takes on a
+    document with the current backend.  If no document is given a
+    representative obsdoc is generated.
+    """
+    if inString is None:
+        obs = Observation(subarrayId='1', seq=1, configUrl='http://localhost/config',
+                          datasetId='TEST.sb1.eb1.60000.0', startTime=60000.0,
+                          configId='TEST.sb1.eb1.60000.0_0001', name='J0000+0000',
+                          ra=0.0, dec=0.0, startLST=0.0,
+                          intent=["ScanIntent='OBSERVE_TARGET'", "ProjectID='TEST'"],
+                          state=0, scanNo=1, subscanNo=1, correlator='WIDAR',
+                          sslo=[ssloType(SolarCal=0, IFid=ifid, Sideband=1, Receiver='L', freq=1000.0)
+                                for ifid in ('AC', 'BD')])
+        inString = obs.to_bytes()
+    repeat = max(1, repeat)
+    t0 = time.time()
+    for i in range(repeat):
+        parseString(inString)
+    return (time.time() - t0) / repeat
+
 #
 # User methods
 #
@@ -106,7 +162,8 @@ except ImportError, exp:
                     raise_parse_error(node, 'Requires sequence of floats')
             return input_data
         def gds_format_double(self, input_data, input_name=''):
-            return '%e' % input_data
+            # repr() round-trips, '%e' would truncate MJD startTime to ~10 s
+            return repr(float(input_data))
         def gds_validate_double(self, input_data, node, input_name=''):
             return input_data
         def gds_format_double_list(self, input_data, input_name=''):
@@ -190,8 +247,28 @@ Namespace_extract_pat_ = re_.compile(r'{(.*)}(.*)')
 #
 
 def showIndent(outfile, level):
-    for idx in range(level):
-        outfile.write('    ')
+    if level > 0:
+        outfile.write('    ' * level)
+
+
+class ExportBuffer_(object):
+    """
+    File-like sink for the export() methods that collects the many small
+    writes in a list and joins them once, rather than paying for a
+    file/StringIO write per field.
+    """
+    def __init__(self):
+        self.parts_ = []
+        self.write = self.parts_.append
+    def getvalue(self):
+        return ''.join(self.parts_)
+
+XML_declaration_ = '<?xml version="1.0" ?>\n'
+
+def export_to_string_(obj, level=0, namespace_='', name_=None, namespacedef_=''):
+    buf = ExportBuffer_()
+    obj.export(buf, level, namespace_, name_=name_, namespacedef_=namespacedef_)
+    return buf.getvalue()
 
 def quote_xml(inStr):
     if not inStr:
@@ -469,6 +546,39 @@ class Observation(GeneratedsSuper):
             outfile.write('</%s%s>\n' % (namespace_, name_))
         else:
             outfile.write('/>\n')
+    def to_xml(self, level=0, namespace_='', name_='Observation', namespacedef_=''):
+        return export_to_string_(self, level, namespace_, name_, namespacedef_)
+    def to_bytes(self, namespace_='', name_='Observation', namespacedef_='', xml_declaration=True):
+        xml = self.to_xml(0, namespace_, name_, namespacedef_)
+        if xml_declaration:
+            xml = XML_declaration_ + xml
+        return xml
+    def to_dict(self):
+        return {
+            'subarrayId': self.subarrayId,
+            'seq': self.seq,
+            'configUrl': self.configUrl,
+            'datasetID': self.datasetID,
+            'startTime': self.startTime,
+            'configId': self.configId,
+            'datasetId': self.datasetId,
+            'name': self.name,
+            'ra': self.ra,
+            'dec': self.dec,
+            'dra': self.dra,
+            'ddec': self.ddec,
+            'ephemeris': self.ephemeris.to_dict() if self.ephemeris is not None else None,
+            'azoffs': self.azoffs,
+            'eloffs': self.eloffs,
+            'startLST': self.startLST,
+            'intent': list(self.intent),
+            'state': self.state,
+            'scanNo': self.scanNo,
+            'subscanNo': self.subscanNo,
+            'modifier': list(self.modifier),
+            'correlator': self.correlator,
+            'sslo': [sslo_.to_dict() for sslo_ in self.sslo],
+            }
     def exportAttributes(self, outfile, level, already_processed, namespace_='', name_='Observation'):
         if self.subarrayId is not None and 'subarrayId' not in already_processed:
             already_processed.append('subarrayId')
@@ -845,6 +955,17 @@ class polyType(GeneratedsSuper):
             outfile.write('</%s%s>\n' % (namespace_, name_))
         else:
             outfile.write('/>\n')
+    def to_xml(self, level=0, namespace_='', name_='polyType', namespacedef_=''):
+        return export_to_string_(self, level, namespace_, name_, namespacedef_)
+    def to_bytes(self, namespace_='', name_='polyType', namespacedef_='', xml_declaration=True):
+        xml = self.to_xml(0, namespace_, name_, namespacedef_)
+        if xml_declaration:
+            xml = XML_declaration_ + xml
+        return xml
+    def to_dict(self):
+        return {
+            'coeff': [coeff_.to_dict() for coeff_ in self.coeff],
+            }
     def exportAttributes(self, outfile, level, already_processed, namespace_='', name_='polyType'):
         pass
     def exportChildren(self, outfile, level, namespace_='', name_='polyType', fromsubclass_=False):
@@ -929,6 +1050,21 @@ class ephemerisType(GeneratedsSuper):
             outfile.write('</%s%s>\n' % (namespace_, name_))
         else:
             outfile.write('/>\n')
+    def to_xml(self, level=0, namespace_='', name_='ephemerisType', namespacedef_=''):
+        return export_to_string_(self, level, namespace_, name_, namespacedef_)
+    def to_bytes(self, namespace_='', name_='ephemerisType', namespacedef_='', xml_declaration=True):
+        xml = self.to_xml(0, namespace_, name_, namespacedef_)
+        if xml_declaration:
+            xml = XML_declaration_ + xml
+        return xml
+    def to_dict(self):
+        return {
+            'referenceTime': self.referenceTime,
+            'ra_polynomial': self.ra_polynomial.to_dict() if self.ra_polynomial is not None else None,
+            'dec_polynomial': self.dec_polynomial.to_dict() if self.dec_polynomial is not None else None,
+            'dist_polynomial': self.dist_polynomial.to_dict() if self.dist_polynomial is not None else None,
+            'origin': self.origin,
+            }
     def exportAttributes(self, outfile, level, already_processed, namespace_='', name_='ephemerisType'):
         pass
     def exportChildren(self, outfile, level, namespace_='', name_='ephemerisType', fromsubclass_=False):
@@ -1059,6 +1195,21 @@ class ssloType(GeneratedsSuper):
             outfile.write('</%s%s>\n' % (namespace_, name_))
         else:
             outfile.write('/>\n')
+    def to_xml(self, level=0, namespace_='', name_='ssloType', namespacedef_=''):
+        return export_to_string_(self, level, namespace_, name_, namespacedef_)
+    def to_bytes(self, namespace_='', name_='ssloType', namespacedef_='', xml_declaration=True):
+        xml = self.to_xml(0, namespace_, name_, namespacedef_)
+        if xml_declaration:
+            xml = XML_declaration_ + xml
+        return xml
+    def to_dict(self):
+        return {
+            'SolarCal': self.SolarCal,
+            'IFid': self.IFid,
+            'Sideband': self.Sideband,
+            'Receiver': self.Receiver,
+            'freq': self.freq,
+            }
     def exportAttributes(self, outfile, level, already_processed, namespace_='', name_='ssloType'):
         if self.SolarCal is not None and 'SolarCal' not in already_processed:
             already_processed.append('SolarCal')
@@ -1177,6 +1328,18 @@ class coeffType(GeneratedsSuper):
             outfile.write('</%s%s>\n' % (namespace_, name_))
         else:
             outfile.write('/>\n')
+    def to_xml(self, level=0, namespace_='', name_='coeffType', namespacedef_=''):
+        return export_to_string_(self, level, namespace_, name_, namespacedef_)
+    def to_bytes(self, namespace_='', name_='coeffType', namespacedef_='', xml_declaration=True):
+        xml = self.to_xml(0, namespace_, name_, namespacedef_)
+        if xml_declaration:
+            xml = XML_declaration_ + xml
+        return xml
+    def to_dict(self):
+        return {
+            'order': self.order,
+            'valueOf_': self.valueOf_,
+            }
     def exportAttributes(self, outfile, level, already_processed, namespace_='', name_='coeffType'):
         if self.order is not None and 'order' not in already_processed:
             already_processed.append('order')
@@ -1256,9 +1419,7 @@ def parse(inFileName):
 
 
 def parseString(inString):
-    from StringIO import StringIO
-    doc = parsexml_(StringIO(inString))
-    rootNode = doc.getroot()
+    rootNode = parsexmlstring_(inString)
     rootTag, rootClass = get_root_tag(rootNode)
     if rootClass is None:
         rootTag = 'Observation'
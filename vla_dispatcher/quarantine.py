@@ -0,0 +1,170 @@
+"""
+Quarantine for multicast payloads that fail to parse.
+
+Every payload that fails is hashed.  The first failure for a given hash is
+logged as a single line (the traceback only goes to DEBUG) and, if a
+spool directory is configured, the payload is written there as
+<unix time>_<sha1>.xml for later inspection.  The spool is rotated so that
+only the newest max_files payloads are kept.  Repeats of a known-bad hash
+are rejected before they reach the XML parser and only show up in the
+aggregated counters, which are logged at most once per report_interval
+seconds.
+
+A sender whose bad payloads all differ (e.g. by a timestamp) defeats the
+hash, so first failures are also limited per report_interval: only the
+first max_logged are logged and the first max_spooled saved, and the rest
+are only counted.
+"""
+
+import os
+import sys
+import time
+import hashlib
+import logging
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+
+class ParseQuarantine(object):
+    """
+    Tracks payloads that failed to parse so that repeats can be dropped
+    cheaply and errors are logged in aggregate rather than per datagram.
+    """
+
+    def __init__(self, spool_dir=None, max_files=100, max_known=1024, report_interval=60.0,
+                 max_logged=5, max_spooled=10):
+        self.spool_dir = spool_dir
+        self.max_files = max_files
+        self.max_known = max_known
+        self.report_interval = report_interval
+        self.max_logged = max_logged
+        self.max_spooled = max_spooled
+
+        self._known = OrderedDict()     # digest -> number of times seen
+        self._spooled = deque()
+        self._last_report = time.time()
+
+        self.total_failures = 0
+        self.total_rejected = 0
+        self.interval_failures = {}     # exception name -> count
+        self.interval_rejected = 0
+        self.interval_logged = 0
+        self.interval_spooled = 0
+        self.interval_suppressed = 0
+
+        if self.spool_dir is not None:
+            self._load_spool()
+
+    def _load_spool(self):
+        """
+        Create the spool directory if needed and seed the known-bad set
+        from anything already in it so that it survives a restart.
+        """
+
+        if not os.path.exists(self.spool_dir):
+            os.makedirs(self.spool_dir)
+
+        names = sorted(name for name in os.listdir(self.spool_dir) if name.endswith('.xml'))
+        for name in names:
+            digest = name[:-4].split('_', 1)[-1]
+            self._remember(digest)
+            self._spooled.append(os.path.join(self.spool_dir, name))
+        self._rotate()
+
+    @staticmethod
+    def digest(data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return hashlib.sha1(data).hexdigest()
+
+    def _remember(self, digest):
+        self._known[digest] = self._known.pop(digest, 0) + 1
+        while len(self._known) > self.max_known:
+            self._known.popitem(last=False)
+
+    def _rotate(self):
+        while len(self._spooled) > self.max_files:
+            filename = self._spooled.popleft()
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+
+    def _spool(self, digest, data):
+        filename = os.path.join(self.spool_dir, '%.6f_%s.xml' % (time.time(), digest))
+        try:
+            with open(filename, 'wb') as fh:
+                fh.write(data if isinstance(data, bytes) else data.encode('utf-8'))
+        except (IOError, OSError) as e:
+            logger.warning("Cannot write quarantined payload to '%s': %s", filename, str(e))
+            return None
+        self._spooled.append(filename)
+        self._rotate()
+        return filename
+
+    def is_known_bad(self, data):
+        """
+        Return True if the payload matches one that has already failed to
+        parse.  This is a no-op until the first failure.
+        """
+
+        if not self._known:
+            return False
+        digest = self.digest(data)
+        if digest not in self._known:
+            return False
+        self._remember(digest)
+        self.total_rejected += 1
+        self.interval_rejected += 1
+        self.maybe_report()
+        return True
+
+    def record_failure(self, data, error, name=''):
+        """
+        Record a payload that failed to parse with the given exception.
+        """
+
+        digest = self.digest(data)
+        kind = type(error).__name__
+        self.total_failures += 1
+        self.interval_failures[kind] = self.interval_failures.get(kind, 0) + 1
+
+        if digest not in self._known:
+            filename = None
+            if self.spool_dir is not None and self.interval_spooled < self.max_spooled:
+                self.interval_spooled += 1
+                filename = self._spool(digest, data)
+            if self.interval_logged < self.max_logged:
+                self.interval_logged += 1
+                logger.error("error handling '%s' message (sha1 %s, %i B): %s: %s%s", name, digest,
+                             len(data), kind, str(error),
+                             '; saved to %s' % filename if filename else '')
+                logger.debug("parse failure traceback", exc_info=sys.exc_info())
+            else:
+                self.interval_suppressed += 1
+        self._remember(digest)
+        self.maybe_report()
+
+    def maybe_report(self, force=False):
+        """
+        Log the counters accumulated since the last report if at least
+        report_interval seconds have passed.
+        """
+
+        now = time.time()
+        if not force and now - self._last_report < self.report_interval:
+            return False
+        if self.interval_failures or self.interval_rejected:
+            logger.warning("Quarantine: %i parse failures (%s, %i new ones not logged) and %i known-bad rejections in the last %.0f s; %i failures/%i rejections total, %i known-bad hashes",
+                           sum(self.interval_failures.values()),
+                           ', '.join('%s=%i' % item for item in sorted(self.interval_failures.items())),
+                           self.interval_suppressed, self.interval_rejected, now - self._last_report,
+                           self.total_failures, self.total_rejected, len(self._known))
+        self.interval_failures = {}
+        self.interval_rejected = 0
+        self.interval_logged = 0
+        self.interval_spooled = 0
+        self.interval_suppressed = 0
+        self._last_report = now
+        return True
@@ -0,0 +1,532 @@
+"""
+Trigger rules: which scans to tell the stations about, and which sinks to
+tell.
+
+A rule set is read from a JSON file like
+
+  {"stations": {"lwa1": "udp:lwa1.example.org:5000"},
+   "rules": [{"name": "pulsars",
+              "project": ["23A-123", "24A-007"],
+              "intent": "PULSAR",
+              "sinks": ["default", "lwa1"]},
+             {"name": "galactic-center",
+              "cone": [266.417, -29.008, 2.0],
+              "band": "lwa",
+              "sinks": ["lwa1"]}]}
+
+Every predicate of a rule is optional and a scan matches the rule when it
+passes all of the predicates the rule has:
+ * project, intent, source: a substring, or a list of substrings any of
+   which will do, of the project ID, scan intent and source name
+ * cone: [ra, dec, radius] in degrees that the scan position must fall in
+ * band: [fmin, fmax] in MHz, or "lwa" for evla_config.LWA_BAND, that the
+   scan's basebands must overlap (see evla_config.EVLAConfig)
+sinks names where the commands for a matching scan go: "default" is the
+dispatcher's own hand-off (command file, spool or push socket) and
+anything else is a station, either from the "stations" section of the
+file or from --station.  A rule without sinks uses "default".
+
+The substring predicates are compiled into one Aho-Corasick automaton per
+field whose outputs are bit masks of the rules, so a single pass over the
+project ID, intent and source finds every rule they satisfy no matter how
+many rules there are.  Positions are checked for all cone rules at once
+with NumPy when it is available, and the band is only looked at for the
+rules that are left after that.
+
+RuleReloader watches the rules file so that the dispatcher can pick up
+changes, or reload on request (SIGHUP), without restarting.  A file that
+does not load is reported and the rules in use are kept.
+"""
+
+import os
+import time
+import math
+import logging
+from collections import deque
+
+import json_backend
+import evla_config
+from sinks import DEFAULT_SINK
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+"""
+Scan fields matched by substring, and the MCAST_Config attribute for each.
+"""
+SUBSTRING_FIELDS = (('project', 'projectID'),
+                    ('intent', 'scan_intent'),
+                    ('source', 'source'))
+"""
+Keys allowed in a rule.
+"""
+RULE_KEYS = ('name', 'project', 'intent', 'source', 'cone', 'band', 'sinks')
+
+
+class SubstringMatcher(object):
+    """
+    Aho-Corasick automaton over a set of substrings.  Each substring
+    carries a bit mask and search() returns the OR of the masks of all of
+    the substrings found in a string.
+    """
+
+    def __init__(self, patterns):
+        self._goto = [{}]
+        self._out = [0]
+        for pattern,mask in patterns:
+            node = 0
+            for char in pattern:
+                child = self._goto[node].get(char)
+                if child is None:
+                    child = len(self._goto)
+                    self._goto.append({})
+                    self._out.append(0)
+                    self._goto[node][char] = child
+                node = child
+            self._out[node] |= mask
+
+        # Failure links, breadth first so that a node's link is always
+        # shallower than the node
+        self._fail = [0]*len(self._goto)
+        pending = deque(self._goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for char,child in self._goto[node].items():
+                pending.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[child] = fail if fail != child else 0
+                self._out[child] |= self._out[self._fail[child]]
+
+    def search(self, text):
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        found = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            found |= out[node]
+        return found
+
+
+def _substrings(rule, key):
+    value = rule.get(key)
+    if value is None:
+        return []
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    for item in value:
+        if not isinstance(item, (type(''), type(u''))):
+            raise ValueError("rule '%s': %s must be a string or a list of strings" % (rule.get('name'), key))
+    return list(value)
+
+
+class Rule(object):
+    """
+    A single trigger rule.
+    """
+
+    def __init__(self, name, project=None, intent=None, source=None, cone=None, band=None, sinks=None):
+        self.name = name
+        self.project = project or []
+        self.intent = intent or []
+        self.source = source or []
+        self.cone = cone
+        self.band = band
+        self.sinks = sinks or [DEFAULT_SINK]
+
+    @classmethod
+    def from_dict(cls, rule):
+        """Build a rule from its JSON form, checking it as we go."""
+
+        name = rule.get('name')
+        if not name:
+            raise ValueError("every rule needs a name")
+        unknown = sorted(set(rule) - set(RULE_KEYS))
+        if unknown:
+            raise ValueError("rule '%s': unknown keys %s" % (name, ', '.join(unknown)))
+
+        cone = rule.get('cone')
+        if cone is not None:
+            if len(cone) != 3:
+                raise ValueError("rule '%s': cone must be [ra, dec, radius] in degrees" % name)
+            cone = tuple(float(value) for value in cone)
+        band = rule.get('band')
+        if band == 'lwa':
+            band = evla_config.LWA_BAND
+        elif band is not None:
+            if len(band) != 2 or float(band[0]) >= float(band[1]):
+                raise ValueError("rule '%s': band must be [fmin, fmax] in MHz or \"lwa\"" % name)
+            band = (float(band[0]), float(band[1]))
+        sinks = rule.get('sinks')
+        if sinks is not None and (not isinstance(sinks, list) or not sinks):
+            raise ValueError("rule '%s': sinks must be a non-empty list" % name)
+
+        return cls(name, project=_substrings(rule, 'project'), intent=_substrings(rule, 'intent'),
+                   source=_substrings(rule, 'source'), cone=cone, band=band, sinks=sinks)
+
+    def to_dict(self):
+        rule = {'name': self.name, 'sinks': list(self.sinks)}
+        for key in ('project', 'intent', 'source'):
+            if getattr(self, key):
+                rule[key] = list(getattr(self, key))
+        if self.cone is not None:
+            rule['cone'] = list(self.cone)
+        if self.band is not None:
+            rule['band'] = list(self.band)
+        return rule
+
+    def __repr__(self):
+        return 'Rule(%s)' % ', '.join('%s=%r' % item for item in sorted(self.to_dict().items()))
+
+
+def _separation(ra1, dec1, ra2, dec2):
+    """Angular separation in degrees, by the haversine formula."""
+
+    ra1, dec1, ra2, dec2 = [math.radians(value) for value in (ra1, dec1, ra2, dec2)]
+    a = math.sin((dec2 - dec1)/2)**2 + math.cos(dec1)*math.cos(dec2)*math.sin((ra2 - ra1)/2)**2
+    return math.degrees(2*math.asin(min(1.0, math.sqrt(a))))
+
+
+class RuleSet(object):
+    """
+    A compiled set of rules.
+    """
+
+    def __init__(self, rules, stations=None):
+        self.rules = list(rules)
+        self.stations = list(stations or [])
+        self.by_name = {}
+        for rule in self.rules:
+            if rule.name in self.by_name:
+                raise ValueError("rule '%s' is defined more than once" % rule.name)
+            self.by_name[rule.name] = rule
+        self._all = (1 << len(self.rules)) - 1
+
+        # One automaton per substring field.  Rules without the field
+        # match any value of it.
+        self._matchers = {}
+        self._wildcard = {}
+        for key,attr in SUBSTRING_FIELDS:
+            patterns = []
+            wildcard = 0
+            for i,rule in enumerate(self.rules):
+                values = getattr(rule, key)
+                if not values or '' in values:
+                    wildcard |= 1 << i
+                else:
+                    patterns.extend((value, 1 << i) for value in values)
+            self._matchers[key] = SubstringMatcher(patterns)
+            self._wildcard[key] = wildcard
+
+        self._cone_rules = [i for i,rule in enumerate(self.rules) if rule.cone is not None]
+        self._cone_mask = sum(1 << i for i in self._cone_rules)
+        if numpy is not None and self._cone_rules:
+            cones = numpy.radians([self.rules[i].cone for i in self._cone_rules])
+            self._cone_ra, self._cone_dec, self._cone_radius = cones.T
+            self._cone_bits = numpy.array([1 << i for i in self._cone_rules], dtype=object)
+        self._band_mask = sum(1 << i for i,rule in enumerate(self.rules) if rule.band is not None)
+
+    def __len__(self):
+        return len(self.rules)
+
+    @classmethod
+    def from_dict(cls, data):
+        stations = sorted((data.get('stations') or {}).items())
+        return cls([Rule.from_dict(rule) for rule in data.get('rules', [])], stations=stations)
+
+    @classmethod
+    def from_file(cls, filename):
+        """Load a rule set from a JSON file."""
+
+        with open(filename, 'r') as fh:
+            return cls.from_dict(json_backend.loads(fh.read()))
+
+    @classmethod
+    def from_filter(cls, intent='', project=''):
+        """
+        The single rule equivalent to the original --intent/--project
+        filter, sending to the default sink.
+        """
+
+        return cls([Rule(DEFAULT_SINK, project=[project] if project else [],
+                         intent=[intent] if intent else [])])
+
+    def check_sinks(self, names):
+        """
+        Raise ValueError if a rule sends to a sink that is neither
+        DEFAULT_SINK nor in names.
+        """
+
+        known = set(names) | set([DEFAULT_SINK])
+        for rule in self.rules:
+            unknown = sorted(set(rule.sinks) - known)
+            if unknown:
+                raise ValueError("rule '%s' sends to unknown sinks %s" % (rule.name, ', '.join(unknown)))
+
+    @staticmethod
+    def _indices(mask):
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
+
+    def _rules(self, mask):
+        return [self.rules[i] for i in self._indices(mask)]
+
+    def _substring_mask(self, key, text):
+        return self._wildcard[key] | self._matchers[key].search(text or '')
+
+    def match_project(self, projectID):
+        """
+        Return the rules that could match a scan of projectID, i.e. the
+        rules whose project predicate it passes.
+        """
+
+        return self._rules(self._substring_mask('project', projectID))
+
+    def _cone_pass(self, mask, ra, dec):
+        """The bits of the cone rules in mask that contain ra, dec."""
+
+        if ra is None or dec is None:
+            return 0
+        if numpy is not None:
+            ra, dec = math.radians(ra), math.radians(dec)
+            a = numpy.sin((self._cone_dec - dec)/2)**2 \
+                + numpy.cos(dec)*numpy.cos(self._cone_dec)*numpy.sin((self._cone_ra - ra)/2)**2
+            inside = 2*numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0))) <= self._cone_radius
+            return sum(self._cone_bits[inside]) & mask
+        passed = 0
+        for i in self._indices(mask):
+            cone = self.rules[i].cone
+            if _separation(ra, dec, cone[0], cone[1]) <= cone[2]:
+                passed |= 1 << i
+        return passed
+
+    def match(self, config):
+        """
+        Return the rules that an mcaf_library.MCAST_Config matches, in the
+        order they were defined.
+        """
+
+        mask = self._all
+        for key,attr in SUBSTRING_FIELDS:
+            mask &= self._substring_mask(key, getattr(config, attr))
+            if not mask:
+                return []
+
+        cones = mask & self._cone_mask
+        if cones:
+            mask = (mask & ~self._cone_mask) | self._cone_pass(cones, config.ra_deg, config.dec_deg)
+
+        bands = mask & self._band_mask
+        if bands:
+            evla = config.full_config()
+            overlaps = {}
+            for i in self._indices(bands):
+                band = self.rules[i].band
+                if band not in overlaps:
+                    overlaps[band] = evla.overlaps_band(*band)
+                if not overlaps[band]:
+                    mask &= ~(1 << i)
+        return self._rules(mask)
+
+    def sinks_for(self, names):
+        """
+        Return the set of sinks that the rules called names send to.
+        Names that are not in the rule set are ignored.
+        """
+
+        targets = set()
+        for name in names:
+            rule = self.by_name.get(name)
+            if rule is not None:
+                targets.update(rule.sinks)
+        return targets
+
+
+class RuleReloader(object):
+    """
+    Reloads a rules file when it changes or when asked to.
+    """
+
+    def __init__(self, filename, check_interval=5.0):
+        self.filename = filename
+        self.check_interval = check_interval
+        self._requested = False
+        self._last_check = time.time()
+        self._signature = self._stat()
+
+        self.reloads = 0
+        self.failures = 0
+
+    def _stat(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def request(self):
+        """
+        Reload on the next check whether or not the file has changed.
+        Only sets a flag so it is safe to call from a signal handler.
+        """
+
+        self._requested = True
+
+    def check(self, now=None):
+        """
+        Return a new RuleSet if a reload was requested or the file has
+        changed since it was last loaded, and None otherwise.  The file is
+        looked at no more than every check_interval seconds unless a
+        reload was requested.
+        """
+
+        if now is None:
+            now = time.time()
+        requested = self._requested
+        if not requested and now - self._last_check < self.check_interval:
+            return None
+        self._last_check = now
+        signature = self._stat()
+        if not requested and (signature is None or signature == self._signature):
+            return None
+        self._requested = False
+        self._signature = signature
+
+        try:
+            ruleset = RuleSet.from_file(self.filename)
+        except (IOError, OSError, ValueError) as e:
+            self.failures += 1
+            logger.error("Cannot reload rules from '%s', keeping the current rules: %s", self.filename, str(e))
+            return None
+        self.reloads += 1
+        return ruleset
+
+
+# Some tests.
+class _Scan(object):
+    def __init__(self, projectID, scan_intent, source, ra_deg, dec_deg, freqs=()):
+        self.projectID = projectID
+        self.scan_intent = scan_intent
+        self.source = source
+        self.ra_deg = ra_deg
+        self.dec_deg = dec_deg
+        self.freqs = freqs
+
+    def full_config(self):
+        scan = self
+
+        class _Config(object):
+            def overlaps_band(self, fmin, fmax):
+                return any(fmin < freq < fmax for freq in scan.freqs)
+        return _Config()
+
+
+def _test_substring_matcher():
+    """Overlapping patterns all report, as with a naive scan."""
+
+    patterns = ['he', 'she', 'his', 'hers', 'A-1', '23A-123', 'x']
+    matcher = SubstringMatcher([(p, 1 << i) for i,p in enumerate(patterns)])
+    for text in ('ushers', 'this', '23A-123.sb1', 'she', '', 'xhe'):
+        expected = sum(1 << i for i,p in enumerate(patterns) if p in text)
+        assert matcher.search(text) == expected, (text, matcher.search(text), expected)
+
+
+def _test_rules():
+    """Every predicate, with and without the default sink."""
+
+    ruleset = RuleSet.from_dict({
+        'stations': {'lwa1': 'udp:127.0.0.1:5000'},
+        'rules': [{'name': 'pulsars', 'intent': 'PULSAR', 'project': ['23A-123', '24A-007']},
+                  {'name': 'crab', 'source': ['3C144', 'J0534'], 'sinks': ['lwa1']},
+                  {'name': 'gc', 'cone': [266.417, -29.008, 2.0], 'band': 'lwa', 'sinks': ['default', 'lwa1']},
+                  {'name': 'pole', 'cone': [0.0, 89.5, 1.0], 'intent': 'OBSERVE'}]})
+    ruleset.check_sinks(['lwa1'])
+    try:
+        RuleSet.from_dict({'rules': [{'name': 'a', 'sinks': ['lwa9']}]}).check_sinks([])
+        assert False
+    except ValueError:
+        pass
+
+    def names(scan):
+        return [rule.name for rule in ruleset.match(scan)]
+
+    assert names(_Scan('23A-123.sb1', 'OBSERVE_PULSAR', 'J0332+5434', 53.2, 54.4)) == ['pulsars']
+    assert names(_Scan('23A-124.sb1', 'OBSERVE_PULSAR', 'J0332+5434', 53.2, 54.4)) == []
+    assert names(_Scan('22B-001', 'CALIBRATE', 'J0534+2200', 83.6, 22.0)) == ['crab']
+    assert names(_Scan('22B-001', 'OBSERVE', 'SgrA', 266.0, -28.5, freqs=[74.0])) == ['gc']
+    assert names(_Scan('22B-001', 'OBSERVE', 'SgrA', 266.0, -28.5, freqs=[1500.0])) == []
+    assert names(_Scan('22B-001', 'OBSERVE', 'SgrA', 270.0, -28.5, freqs=[74.0])) == []
+    assert names(_Scan('22B-001', 'OBSERVE_TARGET', 'NCP', 180.0, 89.9)) == ['pole']
+    assert names(_Scan('22B-001', 'OBSERVE_TARGET', 'NCP', None, None)) == []
+    assert [rule.name for rule in ruleset.match_project('24A-007.sb2')] == ['pulsars', 'crab', 'gc', 'pole']
+    assert ruleset.sinks_for(['crab', 'gc', 'gone']) == set(['default', 'lwa1'])
+
+    single = RuleSet.from_filter(intent='PULSAR', project='23A')
+    assert [rule.name for rule in single.match(_Scan('23A-1', 'OBSERVE_PULSAR', 'x', 0, 0))] == [DEFAULT_SINK]
+    assert single.match(_Scan('23B-1', 'OBSERVE_PULSAR', 'x', 0, 0)) == []
+    assert len(RuleSet.from_filter().match(_Scan('', '', '', None, None))) == 1
+
+
+def _test_rule_reloader():
+    """Changes are picked up, bad files are not, requests always are."""
+    import shutil
+    import tempfile
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'rules.json')
+
+        def write(data):
+            with open(filename + '.tmp', 'w') as fh:
+                fh.write(data)
+            os.rename(filename + '.tmp', filename)
+
+        write('{"rules": [{"name": "a"}]}')
+        reloader = RuleReloader(filename, check_interval=5.0)
+        now = time.time()
+        assert reloader.check(now + 10) is None
+
+        write('{"rules": [{"name": "a"}, {"name": "b"}]}')
+        assert reloader.check(now + 11) is None        # too soon
+        assert len(reloader.check(now + 20)) == 2
+
+        write('{"rules": [{"name": "a"}, {"name": "a"}]}')
+        assert reloader.check(now + 30) is None and reloader.failures == 1
+
+        reloader.request()
+        write('{"rules": []}')
+        assert len(reloader.check(now + 31)) == 0 and reloader.reloads == 2
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _bench_rules(counts=(1, 10, 100, 1000), repeat=2000):
+    """Time per match() as the number of rules grows."""
+    import random
+    import timeit
+
+    random.seed(42)
+    for count in counts:
+        rules = []
+        for i in range(count):
+            rule = {'name': 'rule%i' % i,
+                    'project': '%02i%s-%03i' % (random.randint(10, 25), random.choice('AB'), random.randint(0, 999)),
+                    'intent': random.choice(['PULSAR', 'TARGET', 'CALIBRATE_FLUX', 'CALIBRATE_PHASE'])}
+            if i % 10 == 0:
+                rule['cone'] = [random.uniform(0, 360), random.uniform(-40, 90), 5.0]
+            rules.append(rule)
+        ruleset = RuleSet.from_dict({'rules': rules})
+        scan = _Scan(rules[-1]['project'] + '.sb1.eb2.60000.1', 'OBSERVE_' + rules[-1]['intent'],
+                     'J0332+5434', 53.2, 54.4)
+        elapsed = timeit.timeit(lambda: ruleset.match(scan), number=repeat) / repeat
+        print("%5i rules: %.1f us per match" % (count, elapsed*1e6))
@@ -0,0 +1,369 @@
+"""
+Destinations for the commands generated by the dispatcher.
+
+Every sink has a send(command) method that stamps the command with the
+time it was handed over (dispatch_t) and the resulting lead time, writes
+it out, and returns the number of bytes written.  close() releases
+anything the sink holds.
+
+CommandFileSink is the original hand-off to fcn_server: a single JSON file
+that the server deletes once it has read it.  Only one command can be in
+flight so the others wait in a command_queue.CommandQueue, which hands
+over the most actionable command first and drops sessions that are
+already over.  poll() writes the next command once the file has gone;
+file_waiter tells us when that is, and WakeupDispatcher gets the receive
+loop to call poll() right away.  The time commands spend waiting is kept
+as a metric.  Since send() may only queue the command, on_written, if set,
+is called with the command and its size once it has actually been written.
+
+SpoolSink writes each command to its own sequence-numbered file in a
+spool directory and never blocks.  Consumers take the files in name order
+and acknowledge each one by moving it into the ack/ subdirectory (see
+spool_pending() and spool_ack()), or simply delete it.  Acknowledged files
+are kept for retention seconds.
+"""
+
+import os
+import time
+import logging
+
+import json_backend
+import file_waiter
+import command_queue
+
+logger = logging.getLogger(__name__)
+
+"""
+Name that trigger rules and fan-out use for the dispatcher's own sink.
+"""
+DEFAULT_SINK = 'default'
+"""
+Width of the zero-padded sequence number in spool file names.
+"""
+SPOOL_SEQ_DIGITS = 12
+"""
+Subdirectory of the spool that acknowledged commands are moved to.
+"""
+SPOOL_ACK_DIR = 'ack'
+"""
+File in the spool that keeps the last sequence number used, so that
+numbering carries on after a restart even once the spool has been emptied.
+"""
+SPOOL_SEQ_FILE = '.seq'
+
+
+def stamp_command(command):
+    """
+    Record the hand-over time and how much warning the stations get in
+    the command.
+    """
+
+    dispatchTime = time.time()
+    command['dispatch_t'] = dispatchTime
+    command['lead_time'] = command['event_t'] - dispatchTime
+    return command
+
+
+def atomic_write(filename, data, fsync=False):
+    """
+    Write data to filename through a temporary file in the same directory
+    that is renamed into place, so that readers never see a partial file.
+    """
+
+    dirname, basename = os.path.split(filename)
+    tmpname = os.path.join(dirname, '.' + basename + '.tmp')
+    with open(tmpname, 'w') as fh:
+        fh.write(data)
+        if fsync:
+            fh.flush()
+            os.fsync(fh.fileno())
+    os.rename(tmpname, filename)
+
+
+class CommandFileSink(object):
+    """
+    Single-slot hand-off through one command file, with a queue in front.
+    """
+
+    def __init__(self, command_file, poll_interval=1.0, warn_interval=60.0, stale='drop', stale_grace=60.0,
+                 close_timeout=10.0):
+        self.command_file = command_file
+        self.warn_interval = warn_interval
+        self.close_timeout = close_timeout
+        self.waiter = file_waiter.RemovalWaiter(command_file, poll_interval=poll_interval)
+        self.queue = command_queue.CommandQueue(stale=stale, grace=stale_grace)
+        self._blocked = None
+        self._warned = 0.0
+        self.on_written = None
+
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_last = 0.0
+
+    def wakeup_fd(self):
+        """File descriptor that becomes readable when the command file may have gone."""
+
+        return self.waiter.fileno()
+
+    def send(self, command):
+        """
+        Queue a command and write it out straight away if the command file
+        is free.  Returns the size of the command as queued.
+        """
+
+        size = len(json_backend.dumps(stamp_command(command)))
+        self.queue.push(command)
+        self.poll()
+        return size
+
+    def poll(self):
+        """
+        Write the next queued command if the last one has been consumed
+        (i.e. the cmd file was deleted by the server).
+        """
+
+        if not self.queue:
+            return
+        now = time.time()
+        if os.path.exists(self.command_file):
+            if self._blocked is None:
+                logger.info("Waiting for cmd queue to clear...")
+                self._blocked = self._warned = now
+            elif now - self._warned >= self.warn_interval:
+                logger.warning("'%s' has not been consumed after %.0f s, %i commands waiting", self.command_file,
+                               now - self._blocked, len(self.queue))
+                self._warned = now
+            return
+        if self._blocked is not None:
+            logger.info("Cmd queue cleared after %.3f s", now - self._blocked)
+            self._blocked = None
+
+        entry = self.queue.pop(now)
+        if entry is None:
+            return
+        queued, command = entry
+        waited = now - queued
+        self.waits += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self.wait_last = waited
+
+        data = json_backend.dumps(stamp_command(command))
+        atomic_write(self.command_file, data)
+        if self.on_written is not None:
+            self.on_written(command, len(data))
+
+    def metrics(self):
+        """
+        Return a dictionary with how the sink waits, the number of
+        commands sent, the last, mean and maximum time in seconds commands
+        spent waiting for the previous one to be consumed, and the
+        command_queue.CommandQueue counters.
+        """
+
+        metrics = self.queue.metrics()
+        metrics.update({'mode': self.waiter.mode,
+                        'sent': self.waits,
+                        'wait_last': self.wait_last,
+                        'wait_mean': self.wait_total / self.waits if self.waits else 0.0,
+                        'wait_max': self.wait_max})
+        return metrics
+
+    def close(self):
+        """
+        Give the consumer up to close_timeout seconds to take what is
+        still queued, then stop.
+        """
+
+        t0 = time.time()
+        while self.queue:
+            remaining = t0 + self.close_timeout - time.time()
+            if remaining <= 0 or not self.waiter.wait(remaining):
+                break
+            self.poll()
+        if self.queue:
+            logger.warning("%i commands were never written to '%s'", len(self.queue), self.command_file)
+        self.waiter.close()
+
+
+class SpoolSink(object):
+    """
+    Queue of commands as sequence-numbered files in a spool directory.
+    """
+
+    def __init__(self, spool_dir, retention=86400.0, fsync=False, prune_interval=60.0):
+        self.spool_dir = spool_dir
+        self.ack_dir = os.path.join(spool_dir, SPOOL_ACK_DIR)
+        self.retention = retention
+        self.fsync = fsync
+        self.prune_interval = prune_interval
+        self._last_prune = 0.0
+
+        if not os.path.exists(self.ack_dir):
+            os.makedirs(self.ack_dir)
+
+        # Carry on from the highest sequence number already used, whether
+        # recorded or still in the spool
+        self.seq = 0
+        self.seq_file = os.path.join(self.spool_dir, SPOOL_SEQ_FILE)
+        try:
+            with open(self.seq_file) as fh:
+                self.seq = int(fh.read().strip() or '0', 10)
+        except IOError:
+            pass
+        except ValueError:
+            logger.warning("Ignoring the unreadable sequence number in '%s'", self.seq_file)
+        for dirname in (self.spool_dir, self.ack_dir):
+            for name in os.listdir(dirname):
+                seq = _spool_seq(name)
+                if seq is not None:
+                    self.seq = max(self.seq, seq)
+
+    def filename_for(self, seq):
+        return os.path.join(self.spool_dir, '%0*i.json' % (SPOOL_SEQ_DIGITS, seq))
+
+    def send(self, command):
+        self.seq += 1
+        data = json_backend.dumps(stamp_command(command))
+        atomic_write(self.filename_for(self.seq), data, fsync=self.fsync)
+        atomic_write(self.seq_file, '%i\n' % self.seq, fsync=self.fsync)
+        self.prune()
+        return len(data)
+
+    @property
+    def backlog(self):
+        """Number of commands not yet acknowledged."""
+
+        return len(spool_pending(self.spool_dir))
+
+    def prune(self, force=False):
+        """
+        Remove acknowledged commands older than the retention period.
+        Returns the number of files removed.
+        """
+
+        now = time.time()
+        if not force and now - self._last_prune < self.prune_interval:
+            return 0
+        self._last_prune = now
+
+        count = 0
+        for name in os.listdir(self.ack_dir):
+            filename = os.path.join(self.ack_dir, name)
+            try:
+                if now - os.path.getmtime(filename) > self.retention:
+                    os.unlink(filename)
+                    count += 1
+            except OSError:
+                pass
+        if count:
+            logger.debug("Pruned %i acknowledged commands from '%s'", count, self.ack_dir)
+        return count
+
+    def close(self):
+        pass
+
+
+def _spool_seq(name):
+    if not name.endswith('.json') or name.startswith('.'):
+        return None
+    try:
+        return int(name[:-5], 10)
+    except ValueError:
+        return None
+
+
+def spool_pending(spool_dir):
+    """
+    Return the paths of the commands waiting in spool_dir, oldest first.
+    """
+
+    names = [name for name in os.listdir(spool_dir) if _spool_seq(name) is not None]
+    names.sort()
+    return [os.path.join(spool_dir, name) for name in names]
+
+
+def spool_ack(filename):
+    """
+    Acknowledge the command in filename by moving it into the ack/
+    subdirectory of its spool.
+    """
+
+    dirname, basename = os.path.split(filename)
+    ackname = os.path.join(dirname, SPOOL_ACK_DIR, basename)
+    os.rename(filename, ackname)
+    # Start the retention clock now rather than at dispatch
+    os.utime(ackname, None)
+    return ackname
+
+
+# Some tests.
+def _test_command_file_sink():
+    """Commands queue up behind an unconsumed file and go out by priority."""
+    import shutil
+    import tempfile
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'incoming.json')
+        sink = CommandFileSink(filename)
+        now = time.time()
+        sink.send({'notice_type': 'ELWA_READY', 'event_id': 1, 'event_t': now - 600})
+        sink.send({'notice_type': 'ELWA_READY', 'event_id': 2, 'event_t': now - 500})
+        sink.send({'notice_type': 'ELWA_SESSION', 'event_id': 3, 'event_t': now - 400, 'event_duration': 60})
+        sink.send({'notice_type': 'ELWA_SESSION', 'event_id': 4, 'event_t': now, 'event_duration': 60})
+        assert len(sink.queue) == 3
+
+        seen = []
+        while os.path.exists(filename):
+            with open(filename) as fh:
+                seen.append(json_backend.loads(fh.read())['event_id'])
+            os.unlink(filename)
+            assert sink.waiter.wait(0)
+            sink.poll()
+        assert seen == [1, 4, 2], seen
+        metrics = sink.metrics()
+        assert metrics['sent'] == 3 and metrics['dropped_stale'] == 1 and metrics['backlog'] == 0
+        sink.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _test_spool_sink():
+    """Ordering, restart numbering, acknowledgement and retention."""
+    import shutil
+    import tempfile
+
+    spool = tempfile.mkdtemp()
+    try:
+        sink = SpoolSink(spool, retention=3600.0)
+        for i in range(3):
+            sink.send({'notice_type': 'ELWA_SESSION', 'event_id': i, 'event_t': time.time()})
+        pending = spool_pending(spool)
+        assert len(pending) == 3 and sink.backlog == 3
+        with open(pending[0]) as fh:
+            assert json_backend.loads(fh.read())['event_id'] == 0
+        acked = spool_ack(pending[0])
+        assert sink.backlog == 2
+
+        # A new sink picks up where the old one left off
+        sink = SpoolSink(spool, retention=3600.0)
+        sink.send({'notice_type': 'ELWA_DONE', 'event_id': 3, 'event_t': time.time()})
+        pending = spool_pending(spool)
+        assert pending[-1].endswith('%0*i.json' % (SPOOL_SEQ_DIGITS, 4)), pending
+
+        # Acknowledged commands go once they are past the retention period
+        assert sink.prune(force=True) == 0
+        os.utime(acked, (0, 0))
+        assert sink.prune(force=True) == 1
+        assert os.listdir(os.path.join(spool, SPOOL_ACK_DIR)) == []
+
+        # Numbering carries on after a restart even with an empty spool
+        for filename in spool_pending(spool):
+            os.unlink(filename)
+        sink = SpoolSink(spool, retention=3600.0)
+        sink.send({'notice_type': 'ELWA_DONE', 'event_id': 4, 'event_t': time.time()})
+        assert spool_pending(spool)[-1].endswith('%0*i.json' % (SPOOL_SEQ_DIGITS, 5)), spool_pending(spool)
+    finally:
+        shutil.rmtree(spool)
@@ -0,0 +1,514 @@
+"""
+Push commands to fcn_server over a persistent Unix domain or TCP socket.
+
+Each command is sent as a frame: a 4-byte big-endian length followed by
+that many bytes of UTF-8 JSON,
+
+    {"session": <sink session id>, "seq": <n>, "command": {...}}
+
+where seq counts up from 1 for each session, i.e. each time the
+dispatcher starts.  The consumer answers every frame with an
+acknowledgement frame, {"ack": <n>}.  Commands stay in a bounded resend
+buffer until they are acknowledged.  If the connection drops, the sink
+reconnects with exponential backoff and sends everything that is still
+unacknowledged again, so consumers should ignore (but acknowledge) any
+seq they have already seen in the same session.  When the buffer is full
+the oldest commands are dropped.
+
+Addresses are given as 'unix:/path/to/socket' (or just a path) or as
+'host:port' (optionally prefixed with 'tcp:').
+
+LegacyPacketSink speaks the same way to receivers that only understand
+the 160-byte packets of legacy_packet.
+
+CommandConsumer is a stand-in for the consumer end that is used for
+testing and benchmarking.
+"""
+
+import os
+import time
+import errno
+import select
+import socket
+import struct
+import logging
+import threading
+from collections import deque
+
+import json_backend
+import legacy_packet
+from sinks import stamp_command
+
+logger = logging.getLogger(__name__)
+
+"""
+Frame length prefix.
+"""
+FRAME_HEADER = struct.Struct('>I')
+"""
+Largest frame we are willing to accept.
+"""
+MAX_FRAME_SIZE = 16*1024**2
+
+
+def parse_address(address):
+    """
+    Convert an address string into a (socket family, address) tuple.
+    """
+
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[5:]
+    if address.startswith('tcp:'):
+        address = address[4:]
+    elif os.path.sep in address:
+        return socket.AF_UNIX, address
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host or '127.0.0.1', int(port, 10))
+
+
+def encode_frame(obj):
+    """Encode a JSON-able object as a length-prefixed frame."""
+
+    data = json_backend.dumps(obj).encode('utf-8')
+    return FRAME_HEADER.pack(len(data)) + data
+
+
+def decode_frames(buffer):
+    """
+    Decode as many complete frames as possible from buffer.  Returns a
+    list of objects and whatever is left of the buffer.
+    """
+
+    frames = []
+    offset = 0
+    while len(buffer) - offset >= FRAME_HEADER.size:
+        size, = FRAME_HEADER.unpack_from(buffer, offset)
+        if size > MAX_FRAME_SIZE:
+            raise ValueError("frame of %i B is too large" % size)
+        end = offset + FRAME_HEADER.size + size
+        if len(buffer) < end:
+            break
+        frames.append(json_backend.loads(buffer[offset+FRAME_HEADER.size:end].decode('utf-8')))
+        offset = end
+    return frames, buffer[offset:]
+
+
+class SocketSink(object):
+    """
+    Sends commands over a persistent connection and keeps them until they
+    are acknowledged.  With connect=False the first connection attempt is
+    left to the first send() or poll(), e.g. from a worker thread, since
+    connecting can block for up to timeout seconds.
+    """
+
+    def __init__(self, address, max_buffer=1000, timeout=1.0, backoff_min=0.5, backoff_max=30.0, connect=True):
+        self.address = address
+        self.family, self.sockaddr = parse_address(address)
+        self.max_buffer = max_buffer
+        self.timeout = timeout
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+
+        self.session = '%x' % int(time.time()*1e6)
+        self.seq = 0
+        self.unacked = deque()          # (seq, frame, time sent) awaiting acknowledgement
+        self._pending = deque()         # frames still to be written on this connection
+        self._in = b''
+
+        self.sock = None
+        self._backoff = backoff_min
+        self._next_attempt = 0.0
+        self._last_write = time.time()
+
+        self.sent = 0
+        self.acked = 0
+        self.resent = 0
+        self.dropped = 0
+        self.connects = 0
+        self.ack_time_last = 0.0
+        self.ack_time_total = 0.0
+        self.ack_time_max = 0.0
+
+        if connect:
+            self.poll()
+
+    @property
+    def mode(self):
+        return 'connected' if self.sock is not None else 'disconnected'
+
+    def _connect(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.sockaddr)
+        except socket.error as e:
+            sock.close()
+            self._next_attempt = time.time() + self._backoff
+            logger.debug("Cannot connect to %s (%s), retrying in %.1f s", self.address, str(e), self._backoff)
+            self._backoff = min(self._backoff*2, self.backoff_max)
+            return False
+
+        if self.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self._in = b''
+        self._backoff = self.backoff_min
+        self.connects += 1
+
+        # Anything not acknowledged on the last connection goes again
+        self._pending = deque(frame for seq,frame,sent in self.unacked)
+        self.resent += len(self._pending)
+        logger.info("Connected to %s%s", self.address,
+                    ', resending %i commands' % len(self._pending) if self._pending else '')
+        return True
+
+    def _disconnect(self, reason):
+        logger.warning("Lost connection to %s: %s", self.address, str(reason))
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        self.sock = None
+        self._pending.clear()
+        self._next_attempt = time.time() + self._backoff
+
+    def _read_acks(self):
+        while True:
+            ready, _, _ = select.select([self.sock], [], [], 0)
+            if not ready:
+                break
+            data = self.sock.recv(65536)
+            if not data:
+                raise socket.error(errno.ECONNRESET, "connection closed by peer")
+            acks, self._in = self.decode_acks(self._in + data)
+            now = time.time()
+            for ack in acks:
+                while self.unacked and self.unacked[0][0] <= ack:
+                    seq, data, sent = self.unacked.popleft()
+                    self.acked += 1
+                    self.ack_time_last = now - sent
+                    self.ack_time_total += self.ack_time_last
+                    self.ack_time_max = max(self.ack_time_max, self.ack_time_last)
+
+    def poll(self):
+        """
+        (Re)connect if needed, write any pending frames, and process the
+        acknowledgements that have arrived.  Never blocks for longer than
+        the socket timeout.
+        """
+
+        if self.sock is None:
+            if time.time() < self._next_attempt:
+                return False
+            if not self._connect():
+                return False
+        try:
+            while self._pending:
+                self.sock.sendall(self._pending[0])
+                self._pending.popleft()
+                self._last_write = time.time()
+            self._read_acks()
+        except (socket.error, ValueError) as e:
+            self._disconnect(e)
+            return False
+        return True
+
+    def encode(self, seq, command):
+        """
+        Return the frame for a command, or None if it cannot be sent.
+        """
+
+        return encode_frame({'session': self.session,
+                             'seq': seq,
+                             'command': stamp_command(command)})
+
+    def decode_acks(self, buffer):
+        """
+        Return the sequence numbers acknowledged in buffer and whatever is
+        left of it.
+        """
+
+        frames, buffer = decode_frames(buffer)
+        return [frame.get('ack', 0) for frame in frames], buffer
+
+    def send(self, command):
+        frame = self.encode(self.seq + 1, command)
+        if frame is None:
+            return 0
+        self.seq += 1
+        self.unacked.append((self.seq, frame, time.time()))
+        if len(self.unacked) > self.max_buffer:
+            seq, data, sent = self.unacked.popleft()
+            self.dropped += 1
+            logger.warning("Resend buffer for %s is full, dropping unacknowledged command #%i", self.address, seq)
+        self._pending.append(frame)
+        self.sent += 1
+        self.poll()
+        return len(frame)
+
+    def flush(self, timeout=1.0):
+        """
+        Wait up to timeout seconds for everything sent to be acknowledged.
+        Returns True if nothing is left unacknowledged.
+        """
+
+        t0 = time.time()
+        while time.time() - t0 < timeout:
+            connected = self.poll()
+            if not self.unacked:
+                break
+            if connected:
+                select.select([self.sock], [], [], 0.01)
+            else:
+                time.sleep(0.01)
+        return not self.unacked
+
+    def metrics(self):
+        """
+        Return a dictionary with the connection state and the command
+        counts, plus the last, mean and maximum time between sending a
+        command and it being acknowledged.
+        """
+
+        return {'mode': self.mode,
+                'sent': self.sent,
+                'acked': self.acked,
+                'unacked': len(self.unacked),
+                'resent': self.resent,
+                'dropped': self.dropped,
+                'connects': self.connects,
+                'wait_last': self.ack_time_last,
+                'wait_mean': self.ack_time_total / self.acked if self.acked else 0.0,
+                'wait_max': self.ack_time_max}
+
+    def close(self):
+        if self.sock is not None:
+            self.flush()
+            self.sock.close()
+            self.sock = None
+        if self.unacked:
+            logger.warning("Closing the connection to %s with %i commands unacknowledged", self.address,
+                           len(self.unacked))
+
+
+class LegacyPacketSink(SocketSink):
+    """
+    SocketSink for the legacy packet receivers, e.g.
+    client_tools/client_software.py.  The packet serial number is the
+    sequence number and the receiver echoes every packet back, which
+    serves as the acknowledgement.  Commands without a legacy equivalent
+    are skipped.  An Iamalive packet is sent after keepalive seconds
+    without traffic so that the receiver does not hang up on us.
+    """
+
+    def __init__(self, address, keepalive=300.0, **kwargs):
+        self.keepalive = keepalive
+        SocketSink.__init__(self, address, **kwargs)
+
+    def encode(self, seq, command):
+        return legacy_packet.command_to_packet(stamp_command(command), seq)
+
+    def decode_acks(self, buffer):
+        acks = []
+        size = legacy_packet.PACKET_SIZE
+        while len(buffer) >= size:
+            packet = legacy_packet.decode_packet(buffer[:size])
+            buffer = buffer[size:]
+            if packet['type'] != legacy_packet.TYPE_IAMALIVE:
+                acks.append(packet['serial'])
+        return acks, buffer
+
+    def poll(self):
+        connected = SocketSink.poll(self)
+        if connected and time.time() - self._last_write > self.keepalive:
+            self._pending.append(legacy_packet.encode_packet(legacy_packet.TYPE_IAMALIVE, 0, 0, time.time(), 0, 0, 0))
+            connected = SocketSink.poll(self)
+        return connected
+
+
+class CommandConsumer(object):
+    """
+    Stand-in for the consumer end of a SocketSink.  Every new command is
+    appended to commands and passed to handler, if given, and every frame
+    is acknowledged.  Runs in background threads.
+    """
+
+    def __init__(self, address, handler=None):
+        self.address = address
+        self.family, self.sockaddr = parse_address(address)
+        self.handler = handler
+        self.commands = []
+        self._seen = {}                 # session -> highest seq
+        self._lock = threading.Lock()
+        self._conns = []
+
+        if self.family == socket.AF_UNIX and os.path.exists(self.sockaddr):
+            os.unlink(self.sockaddr)
+        self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.sockaddr)
+        self.sock.listen(5)
+        if self.family == socket.AF_INET:
+            self.address = 'tcp:%s:%i' % self.sock.getsockname()[:2]
+
+        self._running = True
+        self._thread = threading.Thread(target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _accept(self):
+        while self._running:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                break
+            self._conns.append(conn)
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        buffer = b''
+        try:
+            while self._running:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                frames, buffer = decode_frames(buffer + data)
+                for frame in frames:
+                    with self._lock:
+                        if frame['seq'] > self._seen.get(frame['session'], 0):
+                            self._seen[frame['session']] = frame['seq']
+                            self.commands.append(frame['command'])
+                            if self.handler is not None:
+                                self.handler(frame['command'])
+                    conn.sendall(encode_frame({'ack': frame['seq']}))
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def stop(self):
+        self._running = False
+        for conn in self._conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        self._thread.join(1.0)
+        if self.family == socket.AF_UNIX and os.path.exists(self.sockaddr):
+            os.unlink(self.sockaddr)
+
+
+# Some tests.
+def _test_socket_sink():
+    """Delivery, acknowledgement, and resending across a consumer restart."""
+    import shutil
+    import tempfile
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        address = 'unix:' + os.path.join(tmpdir, 'commands.sock')
+        consumer = CommandConsumer(address)
+        sink = SocketSink(address, backoff_min=0.05, backoff_max=0.05)
+        for i in range(3):
+            sink.send({'notice_type': 'ELWA_SESSION', 'event_id': i, 'event_t': time.time()})
+        assert sink.flush(5.0)
+        assert [c['event_id'] for c in consumer.commands] == [0, 1, 2]
+
+        # The consumer goes away; the commands sent meanwhile wait in the
+        # buffer until it is back
+        consumer.stop()
+        for i in range(3, 5):
+            sink.send({'notice_type': 'ELWA_SESSION', 'event_id': i, 'event_t': time.time()})
+        assert len(sink.unacked) >= 2
+        restarted = CommandConsumer(address)
+        assert sink.flush(5.0)
+        assert [c['event_id'] for c in restarted.commands] == [3, 4], restarted.commands
+        assert sink.metrics()['connects'] == 2
+        sink.close()
+        restarted.stop()
+
+        # TCP works the same
+        consumer = CommandConsumer('tcp:127.0.0.1:0')
+        sink = SocketSink(consumer.address)
+        sink.send({'notice_type': 'ELWA_DONE', 'event_id': 5, 'event_t': time.time()})
+        assert sink.flush(5.0)
+        assert consumer.commands[0]['event_id'] == 5
+        sink.close()
+        consumer.stop()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _test_legacy_packet_sink():
+    """Packets reach an echoing legacy receiver and the echoes acknowledge them."""
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    received = []
+
+    def echo():
+        conn, _ = server.accept()
+        while True:
+            data = conn.recv(legacy_packet.PACKET_SIZE)
+            if not data:
+                break
+            received.append(data)
+            conn.sendall(data)
+        conn.close()
+
+    thread = threading.Thread(target=echo)
+    thread.daemon = True
+    thread.start()
+    try:
+        sink = LegacyPacketSink('tcp:127.0.0.1:%i' % server.getsockname()[1], keepalive=0.05)
+        t = time.time()
+        assert sink.send({'notice_type': 'ELWA_READY', 'event_id': 1, 'event_t': t}) == 0
+        for duration in (300.0, -1):
+            sink.send({'notice_type': 'ELWA_SESSION', 'event_id': 2, 'event_t': t, 'event_ra': 53.285,
+                       'event_dec': 54.431, 'event_duration': duration})
+        assert sink.flush(5.0)
+        time.sleep(0.1)
+        sink.poll()
+        sink.close()
+        thread.join(5.0)
+
+        data = b''.join(received)
+        packets = [legacy_packet.decode_packet(data[i:i+legacy_packet.PACKET_SIZE])
+                   for i in range(0, len(data), legacy_packet.PACKET_SIZE)]
+        assert [p['serial'] for p in packets[:2]] == [1, 2]
+        assert [p['duration'] for p in packets[:2]] == [300, 0]
+        assert packets[2]['type_name'] == 'Iamalive'
+    finally:
+        server.close()
+
+
+def _bench_socket_sink(count=1000):
+    """Send count commands over a Unix socket and report the time to acknowledgement."""
+    import shutil
+    import tempfile
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        address = 'unix:' + os.path.join(tmpdir, 'commands.sock')
+        consumer = CommandConsumer(address)
+        sink = SocketSink(address, max_buffer=count)
+        t0 = time.time()
+        for i in range(count):
+            sink.send({'notice_type': 'ELWA_SESSION', 'event_id': i, 'event_t': time.time()})
+            sink.flush(1.0)
+        elapsed = time.time() - t0
+        metrics = sink.metrics()
+        sink.close()
+        consumer.stop()
+        print("%i commands in %.3f s; %.1f us mean time to acknowledgement" % (count, elapsed,
+                                                                             metrics['wait_mean']*1e6))
+    finally:
+        shutil.rmtree(tmpdir)
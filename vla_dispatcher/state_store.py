@@ -0,0 +1,130 @@
+"""
+Bounded store for the per-project scan state kept by the dispatcher.
+
+Entries are kept in the order they were last updated, so both kinds of
+eviction only ever look at the oldest entries:
+ * entries not updated for more than ttl seconds are expired, and
+ * once there are more than max_entries entries the least recently
+   updated ones are dropped.
+An optional on_evict(key, value, reason) callback is called for every
+evicted entry, with reason 'ttl' or 'size'.  Entries removed explicitly
+with del or pop() are not reported.
+"""
+
+import sys
+import time
+from collections import OrderedDict
+
+
+class ScanStateStore(object):
+    """
+    Dictionary-like store with TTL- and size-based eviction.
+    """
+
+    def __init__(self, ttl=None, max_entries=None, on_evict=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.on_evict = on_evict
+
+        self._entries = OrderedDict()   # key -> (value, last update time)
+
+        self.evicted_ttl = 0
+        self.evicted_size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __iter__(self):
+        return iter(list(self._entries.keys()))
+
+    def __getitem__(self, key):
+        return self._entries[key][0]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        del self._entries[key]
+
+    def get(self, key, default=None):
+        try:
+            return self._entries[key][0]
+        except KeyError:
+            return default
+
+    def set(self, key, value, now=None):
+        """Store value under key, marking it as updated at now."""
+
+        if now is None:
+            now = time.time()
+        self._entries.pop(key, None)
+        self._entries[key] = (value, now)
+        if self.max_entries is not None:
+            while len(self._entries) > self.max_entries:
+                self._evict('size')
+
+    def pop(self, key, *default):
+        try:
+            return self._entries.pop(key)[0]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+
+    def keys(self):
+        return list(self._entries.keys())
+
+    def items(self):
+        return [(key, entry[0]) for key,entry in self._entries.items()]
+
+    def last_update(self, key):
+        """Return the time the entry for key was last updated."""
+
+        return self._entries[key][1]
+
+    def _evict(self, reason):
+        key, (value, updated) = self._entries.popitem(last=False)
+        if reason == 'ttl':
+            self.evicted_ttl += 1
+        else:
+            self.evicted_size += 1
+        if self.on_evict is not None:
+            self.on_evict(key, value, reason)
+
+    def expire(self, now=None):
+        """
+        Evict the entries that have not been updated in the last ttl
+        seconds.  Returns the number of entries evicted.
+        """
+
+        if self.ttl is None:
+            return 0
+        if now is None:
+            now = time.time()
+        count = 0
+        while self._entries:
+            key = next(iter(self._entries))
+            if now - self._entries[key][1] <= self.ttl:
+                break
+            self._evict('ttl')
+            count += 1
+        return count
+
+    def metrics(self):
+        """
+        Return a dictionary with the number of entries, an estimate of the
+        memory they use in bytes and the eviction counts.
+        """
+
+        size = sys.getsizeof(self._entries)
+        for key,(value, updated) in self._entries.items():
+            size += sys.getsizeof(key) + sys.getsizeof(value) + sys.getsizeof(updated)
+            if isinstance(value, tuple):
+                size += sum(sys.getsizeof(v) for v in value)
+        return {'entries': len(self._entries),
+                'bytes': size,
+                'evicted_ttl': self.evicted_ttl,
+                'evicted_size': self.evicted_size}
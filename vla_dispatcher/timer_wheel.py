@@ -0,0 +1,265 @@
+"""
+Hierarchical timer wheel for the time-driven events of the dispatcher.
+
+Time is counted in ticks of tick seconds (1 ms by default).  There are
+levels wheels of 2**bits slots each; a slot of level L covers 2**(bits*L)
+ticks, so with the defaults the wheels reach 2**32 ms, about 49 days, and
+anything further out waits in an overflow set.  A timer goes into the
+lowest level that can hold it.  Whenever the level below wraps around,
+the timers in the next slot of a level are moved down ("cascaded") to
+where they now belong, so every timer is handled a bounded number of
+times however many there are:
+ * schedule() and cancel() are O(1)
+ * advance() jumps straight from one occupied level 0 slot or cascade
+   to the next, so idle time costs next to nothing, and every timer is
+   cascaded at most levels - 1 times before it fires
+
+Callbacks run from advance(), which the receive loop calls; next_timeout()
+says how long the loop may sleep before the next timer is due, so timers
+fire within a tick or so of their deadline.
+"""
+
+import time
+import math
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Timer(object):
+    """
+    A scheduled callback.  Use TimerWheel.cancel() or cancel() to stop it.
+    """
+
+    __slots__ = ('deadline', 'expires', 'callback', 'args', 'wheel', 'slot')
+
+    def __init__(self, deadline, expires, callback, args, wheel):
+        self.deadline = deadline
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self.wheel = wheel
+        self.slot = None
+
+    @property
+    def active(self):
+        return self.slot is not None
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+
+class TimerWheel(object):
+    """
+    Timers kept on a set of hashed wheels, one per time scale.
+    """
+
+    def __init__(self, tick=0.001, bits=8, levels=4, now=None):
+        if now is None:
+            now = time.time()
+        self.tick = tick
+        self.bits = bits
+        self.size = 1 << bits
+        self.mask = self.size - 1
+        self.levels = levels
+        self._wheels = [[set() for i in range(self.size)] for level in range(levels)]
+        self._counts = [0]*levels
+        self._overflow = set()
+        self._due = set()
+        self._current = int(math.floor(now / tick))
+
+        self.fired = 0
+        self.cascaded = 0
+
+    def __len__(self):
+        return sum(self._counts) + len(self._overflow) + len(self._due)
+
+    def _place(self, timer):
+        delta = timer.expires - self._current
+        if delta <= 0:
+            slot = self._due
+        else:
+            slot = self._overflow
+            for level in range(self.levels):
+                if delta < 1 << (self.bits*(level + 1)):
+                    slot = self._wheels[level][(timer.expires >> (self.bits*level)) & self.mask]
+                    self._counts[level] += 1
+                    break
+        slot.add(timer)
+        timer.slot = slot
+
+    def _unplace(self, timer):
+        timer.slot.discard(timer)
+        for level in range(self.levels):
+            if timer.slot is self._wheels[level][(timer.expires >> (self.bits*level)) & self.mask]:
+                self._counts[level] -= 1
+                break
+        timer.slot = None
+
+    def schedule(self, deadline, callback, *args):
+        """Call callback(*args) at UNIX time deadline.  Returns the Timer."""
+
+        timer = Timer(deadline, int(math.ceil(deadline / self.tick)), callback, args, self)
+        self._place(timer)
+        return timer
+
+    def cancel(self, timer):
+        """Stop a timer; cancelling one that has fired or been cancelled does nothing."""
+
+        if timer is not None and timer.slot is not None:
+            self._unplace(timer)
+
+    def _cascade(self, level):
+        # Move the timers of the level slot we have just reached down to
+        # where they now belong
+        if level >= self.levels:
+            timers = self._overflow
+            self._overflow = set()
+        else:
+            slot = self._wheels[level][(self._current >> (self.bits*level)) & self.mask]
+            timers = list(slot)
+            slot.clear()
+            self._counts[level] -= len(timers)
+        for timer in timers:
+            timer.slot = None
+            self._place(timer)
+        self.cascaded += len(timers)
+
+    def _fire(self, timers):
+        for timer in sorted(timers, key=lambda t: t.deadline):
+            timer.slot = None
+            self.fired += 1
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                logger.error("Timer callback %s failed: %s", getattr(timer.callback, '__name__', timer.callback), str(e))
+
+    def _ticks_to_next(self):
+        """Ticks to the next occupied level 0 slot or the next cascade."""
+
+        ticks = self.size - (self._current & self.mask)
+        if self._counts[0]:
+            slots = self._wheels[0]
+            for offset in range(1, ticks):
+                if slots[(self._current + offset) & self.mask]:
+                    return offset
+        return ticks
+
+    def _fire_due(self):
+        if self._due:
+            due, self._due = self._due, set()
+            self._fire(due)
+
+    def advance(self, now=None):
+        """
+        Run the callbacks of every timer due by now.  Returns the number
+        of timers fired.
+        """
+
+        if now is None:
+            now = time.time()
+        target = int(math.floor(now / self.tick))
+        fired = self.fired
+
+        self._fire_due()
+        while self._current < target:
+            if not len(self):
+                self._current = target
+                break
+            step = self._ticks_to_next()
+            if self._current + step > target:
+                self._current = target
+                break
+            self._current += step
+
+            index = self._current & self.mask
+            if index == 0:
+                level = 1
+                while level < self.levels:
+                    self._cascade(level)
+                    if (self._current >> (self.bits*level)) & self.mask:
+                        break
+                    level += 1
+                else:
+                    self._cascade(self.levels)
+
+            slot = self._wheels[0][index]
+            if slot:
+                due = list(slot)
+                slot.clear()
+                self._counts[0] -= len(due)
+                self._fire(due)
+            # Cascades and callbacks can leave timers that are already due
+            self._fire_due()
+        return self.fired - fired
+
+    def next_timeout(self, now=None):
+        """
+        Seconds until advance() next needs to be called: 0 if timers are
+        due, None if there are no timers at all.
+        """
+
+        if now is None:
+            now = time.time()
+        if self._due:
+            return 0.0
+        if not len(self):
+            return None
+        return max((self._current + self._ticks_to_next())*self.tick - now, 0.0)
+
+
+# Some tests.
+def _test_timer_wheel():
+    """Timers at every scale fire once, in order, within a tick."""
+    import random
+
+    random.seed(42)
+    now = 1700000000.0
+    wheel = TimerWheel(tick=0.001, bits=4, levels=3, now=now)      # small wheels to exercise cascades
+    fired = []
+    offsets = [0.0005, 0.003, 0.0155, 0.016, 0.2, 3.9, 4.2, 5000.0] + [random.uniform(0, 10) for i in range(500)]
+    for offset in offsets:
+        wheel.schedule(now + offset, fired.append, now + offset)
+    cancelled = wheel.schedule(now + 1.0, fired.append, 'cancelled')
+    cancelled.cancel()
+    assert not cancelled.active and len(wheel) == len(offsets)
+
+    t = now
+    while len(wheel):
+        timeout = wheel.next_timeout(t)
+        t += max(min(timeout, 1.0), 0.0005)
+        before = len(fired)
+        wheel.advance(t)
+        for deadline in fired[before:]:
+            assert deadline <= t + 1e-9 and t - deadline < 0.002, (deadline, t)
+    assert fired == sorted(offsets_ + now for offsets_ in offsets), 'out of order'
+    assert wheel.next_timeout(t) is None
+
+    # A timer already due fires on the next advance, and a callback can
+    # schedule another
+    wheel.schedule(t - 5, lambda: wheel.schedule(t + 0.01, fired.append, 'again'))
+    assert wheel.next_timeout(t) == 0.0
+    assert wheel.advance(t) == 1 and wheel.advance(t + 0.02) == 1 and fired[-1] == 'again'
+
+
+def _bench_timer_wheel(count=100000):
+    """Schedule, reschedule and fire count timers spread over a day."""
+    import random
+
+    random.seed(42)
+    now = time.time()
+    wheel = TimerWheel(now=now)
+    t0 = time.time()
+    timers = [wheel.schedule(now + random.uniform(0, 86400), int) for i in range(count)]
+    t1 = time.time()
+    for i,timer in enumerate(timers):
+        timer.cancel()
+        timers[i] = wheel.schedule(timer.deadline + 60, int)
+    t2 = time.time()
+    t = now
+    while len(wheel):
+        t += 1.0
+        wheel.advance(t)
+    t3 = time.time()
+    print("%i timers: %.2f us per schedule, %.2f us per reschedule; a day in 1 s steps took %.2f s, %.2f us per timer fired" % (count,
+          (t1 - t0)/count*1e6, (t2 - t1)/count*1e6, t3 - t2, (t3 - t2)/count*1e6))